@@ -0,0 +1,156 @@
+"""Benchmark: per-client send_message vs serialize-once server.broadcast.
+
+Starts a local websocket server whose connections are registered the way
+handle_client registers them (client label for the frame counters, a
+negotiated codec; --msgpack-share of them use MessagePack), connects N
+clients and fans the same tick out to all of them: once with
+server.send_message per client, as ticks were sent before, and once with
+server.broadcast. Encoding is timed inside the connections' codecs, so
+the table shows how many encode calls one tick costs and how long they
+take next to the total fan-out time.
+
+server.broadcast encodes once per codec in use, so encode calls per tick
+stay flat as clients are added. The measured encode time of those calls
+still creeps up with the client count: between two ticks the loop services
+every connection, so the encoder starts with cold caches. The same encode
+repeated back to back (the "warm" column) costs the same at any client
+count. The fan-out itself still grows with the number of clients:
+websockets builds the frame header and writes to every transport, and
+record_frame updates each client's frame/byte counters. That part is per
+connection by nature; broadcast only removes the per-client encode and
+the await on every send.
+
+Usage: python benchmarks/bench_broadcast.py [--ticks 500] [--clients 1 10 50 200] [--msgpack-share 0.25]
+"""
+import argparse
+import asyncio
+import time
+
+import websockets
+
+from _sim import server
+
+TICK = {
+    "type": "tick",
+    "symbol": "EURUSD",
+    "bid": 1.08512,
+    "ask": 1.08519,
+    "spread": 7.0,
+    "open": 1.08377,
+    "time": 1718000000000,
+    "time_msc": 1718000000000,
+}
+
+
+class TimedCodec:
+    """Server codec that counts and times its encode calls"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.calls = 0
+        self.seconds = 0.0
+
+    def encode(self, data):
+        started = time.perf_counter()
+        frame = self.codec.encode(data)
+        self.seconds += time.perf_counter() - started
+        self.calls += 1
+        return frame
+
+    def reset(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+
+async def drain(websocket):
+    async for _ in websocket:
+        pass
+
+
+async def run_case(clients_count, ticks, msgpack_share):
+    codecs = {name: TimedCodec(codec) for name, codec in server.CODECS.items()}
+    msgpack_every = round(1 / msgpack_share) if msgpack_share and "msgpack" in codecs else 0
+    server_side = []
+    ready = asyncio.Event()
+
+    async def handler(websocket):
+        index = len(server_side)
+        server_side.append(websocket)
+        server.client_labels[websocket] = f"bench:{index}"
+        use_msgpack = msgpack_every and index % msgpack_every == msgpack_every - 1
+        server.client_codecs[websocket] = codecs["msgpack" if use_msgpack else "json"]
+        if len(server_side) == clients_count:
+            ready.set()
+        await websocket.wait_closed()
+
+    async with websockets.serve(handler, "127.0.0.1", 0) as ws_server:
+        port = ws_server.sockets[0].getsockname()[1]
+        clients = [await websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) for _ in range(clients_count)]
+        readers = [asyncio.create_task(drain(client)) for client in clients]
+        await ready.wait()
+
+        in_use = {id(codec): codec.codec for codec in server.client_codecs.values() if isinstance(codec, TimedCodec)}
+        results = {}
+        for path in ("send_message", "broadcast"):
+            for codec in codecs.values():
+                codec.reset()
+            elapsed = 0.0
+            warm = 0.0
+            for i in range(ticks):
+                data = dict(TICK, bid=TICK["bid"] + i * 1e-5)
+                started = time.perf_counter()
+                if path == "send_message":
+                    for websocket in server_side:
+                        await server.send_message(websocket, data)
+                else:
+                    server.broadcast(server_side, data)
+                elapsed += time.perf_counter() - started
+                for codec in in_use.values():
+                    # Первый вызов прогревает кэши, замеряется повтор
+                    codec.encode(data)
+                    started = time.perf_counter()
+                    codec.encode(data)
+                    warm += time.perf_counter() - started
+                # Клиенты успевают вычитать кадры, буферы не копятся между тиками
+                await asyncio.sleep(0)
+            results[path] = {
+                "encode_calls": sum(codec.calls for codec in codecs.values()) / ticks,
+                "encode_us": sum(codec.seconds for codec in codecs.values()) / ticks * 1e6,
+                "warm_us": warm / ticks * 1e6,
+                "fanout_us": elapsed / ticks * 1e6,
+            }
+
+        for client in clients:
+            await client.close()
+        for reader in readers:
+            reader.cancel()
+        for websocket in server_side:
+            server.client_labels.pop(websocket, None)
+            server.client_codecs.pop(websocket, None)
+
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ticks", type=int, default=500)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--msgpack-share", type=float, default=0.25, help="share of clients on MessagePack")
+    args = parser.parse_args()
+
+    print(f"{'':>8} {'encodes/tick':>25} {'encode/tick':>38} {'fan-out/tick':>25}")
+    print(f"{'clients':>8} {'send_message':>12} {'broadcast':>12} {'send_message':>12} {'broadcast':>12} {'warm':>12} "
+          f"{'send_message':>12} {'broadcast':>12} {'per client':>11}")
+    for clients_count in args.clients:
+        r = await run_case(clients_count, args.ticks, args.msgpack_share)
+        old, new = r["send_message"], r["broadcast"]
+        print(
+            f"{clients_count:>8} {old['encode_calls']:>12.1f} {new['encode_calls']:>12.1f} "
+            f"{old['encode_us']:>10.1f}us {new['encode_us']:>10.1f}us {new['warm_us']:>10.1f}us "
+            f"{old['fanout_us']:>10.0f}us {new['fanout_us']:>10.0f}us "
+            f"{new['fanout_us'] / clients_count:>9.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""Benchmark: per-row vs columnar vs compact chart payloads.
+
+Builds a synthetic MT5 rates array (same dtype as copy_rates_from_pos)
+and times server.build_candles (one dict per bar), server.build_candle_columns
+(bulk NumPy conversion) and server.build_compact_candles (int32 columns,
+base64 for JSON), each followed by JSON encoding as send_message() does.
+
+Usage: python benchmarks/bench_chart_payload.py [--bars 500 20000 100000] [--repeat 5]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from _sim import server
+
+RATES_DTYPE = np.dtype([
+    ("time", "<i8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("tick_volume", "<u8"),
+    ("spread", "<i4"),
+    ("real_volume", "<u8"),
+])
+
+DIGITS = 5
+POINT = 0.00001
+
+
+def make_rates(bars, seed=1):
+    rng = np.random.default_rng(seed)
+    closes = np.round(1.085 + np.cumsum(rng.normal(0, 0.0004, bars)), DIGITS)
+    opens = np.concatenate(([1.085], closes[:-1]))
+    spread = np.round(np.abs(rng.normal(0, 0.0003, bars)), DIGITS)
+
+    rates = np.zeros(bars, dtype=RATES_DTYPE)
+    rates["time"] = 1700000000 + np.arange(bars) * 60
+    rates["open"] = opens
+    rates["close"] = closes
+    rates["high"] = np.maximum(opens, closes) + spread
+    rates["low"] = np.minimum(opens, closes) - spread
+    rates["tick_volume"] = rng.integers(1, 500, bars)
+    return rates
+
+
+def measure(build, rates, repeat):
+    best_build = best_encode = float("inf")
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = build(rates)
+        built = time.perf_counter()
+        message = server.JSON_CODEC.encode({"type": "chart", **payload})
+        encoded = time.perf_counter()
+        best_build = min(best_build, built - start)
+        best_encode = min(best_encode, encoded - built)
+        size = len(message)
+    return best_build * 1000, best_encode * 1000, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bars", type=int, nargs="+", default=[500, 20000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = {
+        "rows": lambda rates: {"candles": server.build_candles(rates)},
+        "columns": lambda rates: {"format": "columns", "columns": server.build_candle_columns(rates)},
+        "compact": lambda rates: {"format": "compact", **server.build_compact_candles(rates, DIGITS, POINT)},
+    }
+
+    print(f"JSON encoder: {'orjson' if server.orjson is not None else 'json'}")
+    print(f"{'bars':>8} {'format':>8} {'build':>10} {'encode':>10} {'total':>10} {'bytes':>11}")
+    for bars in args.bars:
+        rates = make_rates(bars)
+        for name, build in cases.items():
+            build_ms, encode_ms, size = measure(build, rates, args.repeat)
+            print(
+                f"{bars:>8} {name:>8} "
+                f"{build_ms:>8.2f}ms {encode_ms:>8.2f}ms {build_ms + encode_ms:>8.2f}ms "
+                f"{size:>11,}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Benchmark: per-deal loop vs vectorized deal-to-trade aggregation.
+
+Generates a synthetic deal history (MT5 TradeDeal field order: one entry
+and one or two exit deals per position, plus balance operations) and times
+the previous per-deal dict loop against server.build_trades, which groups
+by position_id with NumPy. Totals of profit, commission and swap are checked
+to match between the two.
+
+Usage: python benchmarks/bench_history_trades.py [--deals 10000 100000] [--repeat 3]
+"""
+import argparse
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from _sim import server
+from server import mt5
+
+TradeDeal = namedtuple("TradeDeal", server.DEAL_FIELDS)
+
+SYMBOLS = ["EURUSD+", "GBPUSD+", "USDJPY+", "XAUUSD+", "BTCUSD"]
+
+
+def make_deals(count, seed=1):
+    rng = np.random.default_rng(seed)
+    deals = []
+    ticket = 1000000
+    now = 1700000000
+    while len(deals) < count:
+        ticket += 1
+        position_id = ticket
+        symbol = SYMBOLS[ticket % len(SYMBOLS)]
+        opened = now
+        now += int(rng.integers(1, 600))
+        side = int(rng.integers(0, 2))
+        volume = float(rng.choice([0.01, 0.1, 0.5, 1.0]))
+        price = round(1.08 + rng.normal(0, 0.01), 5)
+
+        if ticket % 500 == 0:
+            deals.append(TradeDeal(ticket, 0, opened, opened * 1000, mt5.DEAL_TYPE_BALANCE, mt5.DEAL_ENTRY_IN,
+                                   0, 0, mt5.DEAL_REASON_CLIENT, 0.0, 0.0, 0.0, 0.0, 1000.0, 0.0, "", "Deposit", ""))
+            continue
+
+        deals.append(TradeDeal(ticket, ticket, opened, opened * 1000, side, mt5.DEAL_ENTRY_IN, 12345, position_id,
+                               mt5.DEAL_REASON_CLIENT, volume, price, -0.5, 0.0, 0.0, 0.0, symbol,
+                               "Blueprint Market Order", ""))
+        exits = 2 if ticket % 7 == 0 else 1
+        for _ in range(exits):
+            ticket += 1
+            closed = now + int(rng.integers(60, 86400))
+            reason = int(rng.choice([mt5.DEAL_REASON_CLIENT, mt5.DEAL_REASON_SL, mt5.DEAL_REASON_TP]))
+            close_price = round(price + rng.normal(0, 0.002), 5)
+            comment = {mt5.DEAL_REASON_SL: f"[sl {close_price}]", mt5.DEAL_REASON_TP: f"[tp {close_price}]"}.get(reason, "")
+            profit = round((close_price - price) * volume / exits * 100000 * (1 if side == 0 else -1), 2)
+            deals.append(TradeDeal(ticket, ticket, closed, closed * 1000, 1 - side, mt5.DEAL_ENTRY_OUT, 12345,
+                                   position_id, reason, volume / exits, close_price, -0.5, -0.1, profit, 0.0,
+                                   symbol, comment, ""))
+    deals.sort(key=lambda deal: deal.time)
+    return deals[:count]
+
+
+def build_trades_loop(deals):
+    """The per-deal loop send_history used before the vectorized version"""
+    positions_map = {}
+    for deal in deals:
+        if deal.type not in [mt5.DEAL_TYPE_BUY, mt5.DEAL_TYPE_SELL]:
+            continue
+
+        position_id = deal.position_id
+        if position_id not in positions_map:
+            positions_map[position_id] = {
+                "id": position_id,
+                "symbol": deal.symbol,
+                "in_deal": None,
+                "out_deal": None,
+                "profit": 0,
+                "commission": 0,
+                "swap": 0,
+                "exit_type": "manual"
+            }
+
+        if deal.entry == mt5.DEAL_ENTRY_IN:
+            positions_map[position_id]["in_deal"] = deal
+            positions_map[position_id]["type"] = "buy" if deal.type == mt5.DEAL_TYPE_BUY else "sell"
+            positions_map[position_id]["volume"] = deal.volume
+            positions_map[position_id]["openTime"] = int(deal.time) * 1000
+            positions_map[position_id]["openPrice"] = deal.price
+        elif deal.entry in [mt5.DEAL_ENTRY_OUT, mt5.DEAL_ENTRY_OUT_BY]:
+            positions_map[position_id]["out_deal"] = deal
+            positions_map[position_id]["closeTime"] = int(deal.time) * 1000
+            positions_map[position_id]["closePrice"] = deal.price
+
+        positions_map[position_id]["profit"] += getattr(deal, 'profit', 0)
+        positions_map[position_id]["commission"] += getattr(deal, 'commission', 0)
+        positions_map[position_id]["swap"] += getattr(deal, 'swap', 0)
+
+        if hasattr(deal, 'comment') and deal.comment:
+            positions_map[position_id]["comment"] = deal.comment
+            comment_lower = deal.comment.lower()
+            if '[tp]' in comment_lower or 'take profit' in comment_lower or 'tp' in comment_lower:
+                positions_map[position_id]["exit_type"] = "tp"
+            elif '[sl]' in comment_lower or 'stop loss' in comment_lower or 'sl' in comment_lower:
+                positions_map[position_id]["exit_type"] = "sl"
+            elif 'so' in comment_lower:
+                positions_map[position_id]["exit_type"] = "sl"
+            else:
+                positions_map[position_id]["exit_type"] = "manual"
+
+    trades = []
+    for position_id, pos_data in positions_map.items():
+        if pos_data["in_deal"] is None:
+            continue
+        trades.append({
+            "id": position_id,
+            "ticket": position_id,
+            "symbol": pos_data["symbol"],
+            "type": pos_data.get("type", "unknown"),
+            "volume": pos_data.get("volume", 0),
+            "openTime": pos_data.get("openTime", 0),
+            "closeTime": pos_data.get("closeTime", pos_data.get("openTime", 0)),
+            "price": pos_data.get("openPrice", 0),
+            "openPrice": pos_data.get("openPrice", 0),
+            "closePrice": pos_data.get("closePrice", pos_data.get("openPrice", 0)),
+            "profit": pos_data["profit"],
+            "commission": pos_data["commission"],
+            "swap": pos_data["swap"],
+            "comment": pos_data.get("comment", ""),
+            "exit_type": pos_data.get("exit_type", "manual")
+        })
+
+    trades.sort(key=lambda x: x.get("closeTime", 0), reverse=True)
+    return trades
+
+
+def best_of(func, deals, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(deals)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def totals(trades):
+    return tuple(round(sum(trade[field] for trade in trades), 2) for field in ("profit", "commission", "swap"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--deals", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'deals':>8} {'trades':>8} {'loop':>10} {'numpy':>10} {'speedup':>8}  totals match")
+    for count in args.deals:
+        deals = make_deals(count)
+        loop_ms, loop_trades = best_of(build_trades_loop, deals, args.repeat)
+        numpy_ms, numpy_trades = best_of(server.build_trades, deals, args.repeat)
+        match = len(loop_trades) == len(numpy_trades) and totals(loop_trades) == totals(numpy_trades)
+        print(
+            f"{count:>8} {len(numpy_trades):>8} "
+            f"{loop_ms:>8.1f}ms {numpy_ms:>8.1f}ms {loop_ms / numpy_ms:>7.1f}x  {match}"
+        )
+
+
+if __name__ == "__main__":
+    main()
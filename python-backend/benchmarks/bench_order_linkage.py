@@ -0,0 +1,105 @@
+"""Benchmark: comment scan vs identifier index for pending order automation.
+
+Saves automation settings for thousands of pending orders, fills part of
+them into positions (position.identifier is the order ticket, as in MT5)
+and links settings to the new positions twice: with the previous scan of
+every saved order per new position looking for its ticket in the
+position comment, and with server.sync_position_monitors, which pops the
+settings by identifier. Also checks that every filled order's settings
+land on its own position exactly once and that nothing else is attached;
+the script exits with status 1 if the identifier index links anything
+wrong (the scan's mislinks are the bug it replaced and are only reported).
+The same checks run as assertions in tests/test_order_linkage.py.
+
+Usage: python benchmarks/bench_order_linkage.py [--orders 1000 5000 10000] [--fill 0.5]
+"""
+import argparse
+import logging
+import sys
+import time
+from collections import namedtuple
+
+from _sim import server
+
+Position = namedtuple("Position", ["ticket", "identifier", "symbol", "comment"])
+
+
+def make_case(orders, fill):
+    # Тикеты идут подряд, поэтому короткие номера встречаются подстрокой в длинных
+    tickets = list(range(1000, 1000 + orders))
+    settings = {ticket: dict(server.default_automation_settings(), trailing=True, order=ticket) for ticket in tickets}
+    step = max(1, round(1 / fill)) if fill else 0
+    filled = tickets[::step] if step else []
+    # Комментарий MT5 обрезается до 31 символа; старый код искал в нем тикет ордера
+    positions = [Position(ticket, ticket, "EURUSD", f"Blueprint Limit Order #{ticket}"[:31]) for ticket in filled]
+    return settings, positions
+
+
+def link_by_comment(positions, pending, monitors):
+    """The scan sync_position_monitors did before the identifier index"""
+    for pos in positions:
+        if pos.ticket not in monitors:
+            settings_found = False
+            for order_id, settings in list(pending.items()):
+                if str(order_id) in pos.comment:
+                    monitors[pos.ticket] = settings
+                    del pending[order_id]
+                    settings_found = True
+                    break
+            if not settings_found:
+                monitors[pos.ticket] = server.default_automation_settings()
+
+
+def link_by_identifier(positions, pending, monitors):
+    server.pending_order_automation = pending
+    server.position_monitors = monitors
+    server.positions_cache.clear()
+    server.sync_position_monitors(positions)
+
+
+def mislinked(positions, monitors):
+    return sum(1 for pos in positions if monitors[pos.ticket].get("order") != pos.identifier)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 5000, 10000])
+    parser.add_argument("--fill", type=float, default=0.5, help="share of pending orders that fill")
+    args = parser.parse_args()
+    # Логи о каждой привязке не должны попадать в замер
+    server.logger.setLevel(logging.WARNING)
+
+    failed = False
+    print(f"{'orders':>8} {'filled':>8} {'scan':>10} {'index':>10} {'speedup':>8} {'scan wrong':>11} {'index wrong':>12} {'left':>6}")
+    for orders in args.orders:
+        settings, positions = make_case(orders, args.fill)
+
+        pending, monitors = dict(settings), {}
+        start = time.perf_counter()
+        link_by_comment(positions, pending, monitors)
+        scan_ms = (time.perf_counter() - start) * 1000
+        scan_wrong = mislinked(positions, monitors)
+
+        pending, monitors = dict(settings), {}
+        start = time.perf_counter()
+        link_by_identifier(positions, pending, monitors)
+        index_ms = (time.perf_counter() - start) * 1000
+        index_wrong = mislinked(positions, monitors)
+
+        # Повторная синхронизация не должна ничего перепривязывать
+        link_by_identifier(positions, pending, monitors)
+        index_wrong += mislinked(positions, monitors)
+        left_ok = len(pending) == orders - len(positions)
+        failed = failed or index_wrong > 0 or not left_ok
+
+        print(
+            f"{orders:>8} {len(positions):>8} {scan_ms:>8.1f}ms {index_ms:>8.2f}ms "
+            f"{scan_ms / index_ms:>7.0f}x {scan_wrong:>11} {index_wrong:>12} {str(left_ok):>6}"
+        )
+
+    if failed:
+        sys.exit("identifier linkage attached settings to the wrong position")
+
+
+if __name__ == "__main__":
+    main()
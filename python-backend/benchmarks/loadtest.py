@@ -0,0 +1,370 @@
+"""Load test: hundreds of terminals against one backend on the MT5 simulator.
+
+Starts server.py --simulate as a subprocess, spreads --clients websocket
+connections over --workers processes and drives every client with a mix of
+request/subscribe/chart/history/order messages (MIX). Each tick received is
+timed against its own time_msc, giving tick-to-client latency percentiles;
+request round trips are timed per message type. Account requests carry an
+id that the reply echoes, because the same account frame is also broadcast
+to every client after each trade. The server's CPU and RSS
+are sampled from /proc (psutil when available) during the measurement
+window. Results are written as JSON so runs can be compared between commits.
+
+Usage: python benchmarks/loadtest.py [--clients 200] [--duration 30] [--workers 4] [--output loadtest.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+import websockets
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WS_URL = "ws://127.0.0.1:8080"
+METRICS_URL = "http://127.0.0.1:5000/metrics"
+
+SYMBOLS = ["EURUSD", "GBPUSD", "USDJPY", "AUDUSD", "USDCAD", "XAUUSD", "BTCUSD", "EURJPY"]
+TIMEFRAMES = ["M1", "M5", "M15", "H1"]
+
+# Доля действий клиента: в основном обновления счета и графики, сделки редки
+MIX = {
+    "request": 0.45,
+    "chart": 0.25,
+    "subscribe": 0.15,
+    "history": 0.05,
+    "order": 0.10,
+}
+
+# Типы кадров, которыми сервер отвечает только отправителю сообщения
+# (успешное исполнение ордера приходит с type = "buy"/"sell");
+# ответ на request сопоставляется по id - кадр account рассылается и всем
+REPLY_TYPES = {
+    "chart": ("chart",),
+    "history": ("history_chunk",),
+    "order": ("execution", "buy", "sell"),
+}
+
+
+def make_message(kind, rng, request_id):
+    if kind == "request":
+        return {"type": "request", "data": "account", "id": request_id}
+    if kind == "chart":
+        return {"type": "chart", "symbol": rng.choice(SYMBOLS), "timeframe": rng.choice(TIMEFRAMES),
+                "count": 500, "format": "compact"}
+    if kind == "subscribe":
+        return {"type": "subscribe", "symbols": [rng.choice(SYMBOLS)]}
+    if kind == "history":
+        return {"type": "history", "stream": True, "limit": 500}
+    return {"type": "order", "symbol": rng.choice(SYMBOLS[:4]), "action": rng.choice(["buy", "sell"]),
+            "order_type": "market", "volume": 0.01}
+
+
+class ClientStats:
+    def __init__(self):
+        self.tick_latency = []
+        self.rtt = defaultdict(list)
+        self.frames = defaultdict(int)
+        self.bytes = 0
+        self.connected = 0
+        self.failed = 0
+
+
+def tick_times(data):
+    if data["type"] == "ticks":
+        return [tick["time_msc"] for tick in data["ticks"] if "time_msc" in tick]
+    if data["type"] == "tick_stream":
+        return data["time"]
+    if data["type"] == "tick" and "time_msc" in data:
+        return [data["time_msc"]]
+    return []
+
+
+async def run_client(index, args, start, end, stats):
+    rng = random.Random(args.seed * 100003 + index)
+    # Смещение серверного времени брокера неизвестно: берем ближайшие 15 минут по первому тику
+    offset = None
+    pending = defaultdict(list)
+    requests = {}
+
+    await asyncio.sleep(max(0.0, start - args.ramp + args.ramp * index / args.clients - time.time()))
+    try:
+        websocket = await websockets.connect(WS_URL, max_size=None)
+    except OSError:
+        stats.failed += 1
+        return
+    stats.connected += 1
+
+    async def reader():
+        nonlocal offset
+        async for message in websocket:
+            received = time.time()
+            data = json.loads(message)
+            kind = data.get("type")
+            measuring = start <= received < end
+            if measuring:
+                stats.frames[kind] += 1
+                stats.bytes += len(message)
+
+            times = tick_times(data)
+            if times and offset is None:
+                offset = round((times[-1] / 1000 - received) / 900) * 900
+            if measuring:
+                for time_msc in times:
+                    stats.tick_latency.append(received - (time_msc / 1000 - offset))
+
+            if kind == "account" and data.get("id") in requests:
+                sent = requests.pop(data["id"])
+                if measuring:
+                    stats.rtt["request"].append(received - sent)
+
+            for request_kind, replies in REPLY_TYPES.items():
+                # История приходит несколькими кадрами: время ответа - до первого
+                if kind in replies and pending[request_kind] and not data.get("index"):
+                    sent = pending[request_kind].pop(0)
+                    if measuring:
+                        stats.rtt[request_kind].append(received - sent)
+
+    reader_task = asyncio.create_task(reader())
+    try:
+        mode = "full" if rng.random() < args.full_share else "conflated"
+        for message in (
+            {"type": "hello", "features": ["ticks_batch", "positions_delta", "orders_delta"]},
+            {"type": "request", "data": "initial"},
+            {"type": "subscribe", "symbols": rng.sample(SYMBOLS, rng.randint(2, 4)), "mode": mode},
+        ):
+            await websocket.send(json.dumps(message))
+
+        kinds, weights = list(MIX), list(MIX.values())
+        request_id = 0
+        while time.time() < end:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            kind = rng.choices(kinds, weights)[0]
+            request_id += 1
+            if kind == "request":
+                requests[request_id] = time.time()
+            elif kind in REPLY_TYPES:
+                pending[kind].append(time.time())
+            await websocket.send(json.dumps(make_message(kind, rng, request_id)))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        reader_task.cancel()
+        await websocket.close()
+
+
+async def run_worker(indices, args, start, end):
+    stats = ClientStats()
+    await asyncio.gather(*(run_client(index, args, start, end, stats) for index in indices))
+    return {
+        "tick_latency": stats.tick_latency,
+        "rtt": dict(stats.rtt),
+        "frames": dict(stats.frames),
+        "bytes": stats.bytes,
+        "connected": stats.connected,
+        "failed": stats.failed,
+    }
+
+
+def worker_main(indices, args, start, end, results):
+    results.put(asyncio.run(run_worker(indices, args, start, end)))
+
+
+def read_process(pid):
+    """(cpu seconds, rss bytes) of the server process"""
+    if psutil is not None:
+        process = psutil.Process(pid)
+        cpu = process.cpu_times()
+        return cpu.user + cpu.system, process.memory_info().rss
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+    return cpu, rss
+
+
+def sample_server(process, start, end, interval=0.5):
+    while time.time() < start:
+        time.sleep(0.05)
+    samples = []
+    previous_cpu, _ = read_process(process.pid)
+    previous = time.time()
+    while time.time() < end:
+        time.sleep(interval)
+        if process.poll() is not None:
+            sys.exit(f"server.py exited with code {process.returncode} during the run")
+        cpu, rss = read_process(process.pid)
+        now = time.time()
+        samples.append(((cpu - previous_cpu) / (now - previous) * 100, rss))
+        previous_cpu, previous = cpu, now
+    return samples
+
+
+def port_open(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_server(process, port, timeout=30):
+    """Waits until the spawned server listens on port; fails if it exits first"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"server.py exited with code {process.returncode} before listening on {port}")
+        if port_open(port):
+            return
+        time.sleep(0.2)
+    sys.exit(f"server.py did not start listening on {port}")
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ms = np.asarray(values) * 1000
+    return {
+        "count": len(values),
+        "mean": round(float(ms.mean()), 2),
+        "p50": round(float(np.percentile(ms, 50)), 2),
+        "p90": round(float(np.percentile(ms, 90)), 2),
+        "p99": round(float(np.percentile(ms, 99)), 2),
+        "max": round(float(ms.max()), 2),
+    }
+
+
+def loop_lag_ms():
+    # Средняя задержка цикла событий сервера за весь прогон
+    try:
+        text = urllib.request.urlopen(METRICS_URL, timeout=5).read().decode()
+    except OSError:
+        return None
+    values = {}
+    for line in text.splitlines():
+        if line.startswith("event_loop_lag_seconds_sum") or line.startswith("event_loop_lag_seconds_count"):
+            name, value = line.split("{")[0], float(line.rsplit(" ", 1)[1])
+            values[name] = value
+    count = values.get("event_loop_lag_seconds_count")
+    return round(values["event_loop_lag_seconds_sum"] / count * 1000, 2) if count else None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4, help="client processes")
+    parser.add_argument("--duration", type=float, default=30, help="measurement window, seconds")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds to spread connections over before measuring")
+    parser.add_argument("--rate", type=float, default=0.2, help="actions per second per client")
+    parser.add_argument("--full-share", type=float, default=0.1, help="share of clients in full tick mode")
+    parser.add_argument("--sim-latency", type=float, default=0.0005, help="simulated MT5 call latency, seconds")
+    parser.add_argument("--sim-history", type=int, default=2000, help="historical deals seeded in the simulator")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest.json")
+    args = parser.parse_args()
+
+    # Иначе клиенты подключились бы к чужому серверу, а замер шел бы по нашему
+    for port in (8080, 5000):
+        if port_open(port):
+            sys.exit(f"port {port} is already in use - stop the running server first")
+
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    server = subprocess.Popen(
+        [sys.executable, "server.py", "--simulate", "--sim-latency", str(args.sim_latency),
+         "--sim-history", str(args.sim_history)],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_server(server, 8080)
+
+        start = time.time() + args.ramp + 1
+        end = start + args.duration
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=worker_main, args=(list(range(w, args.clients, args.workers)), args, start, end, results))
+            for w in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        samples = sample_server(server, start, end)
+        lag = loop_lag_ms()
+        parts = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latency = [value for part in parts for value in part["tick_latency"]]
+    rtt = defaultdict(list)
+    frames = defaultdict(int)
+    for part in parts:
+        for kind, values in part["rtt"].items():
+            rtt[kind].extend(values)
+        for kind, count in part["frames"].items():
+            frames[kind] += count
+    cpu = [sample[0] for sample in samples]
+    rss = [sample[1] for sample in samples]
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "clients": {
+            "connected": sum(part["connected"] for part in parts),
+            "failed": sum(part["failed"] for part in parts),
+        },
+        "tick_latency_ms": percentiles(latency),
+        "rtt_ms": {kind: percentiles(values) for kind, values in sorted(rtt.items())},
+        "frames_per_s": round(sum(frames.values()) / args.duration, 1),
+        "bytes_per_s": round(sum(part["bytes"] for part in parts) / args.duration),
+        "frames_by_type": dict(sorted(frames.items(), key=lambda item: str(item[0]))),
+        "server": {
+            "cpu_percent_mean": round(float(np.mean(cpu)), 1) if cpu else None,
+            "cpu_percent_max": round(float(np.max(cpu)), 1) if cpu else None,
+            "rss_mb_max": round(max(rss) / 2 ** 20, 1) if rss else None,
+            "loop_lag_ms_mean": lag,
+        },
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    ticks = report["tick_latency_ms"]
+    print(f"clients {report['clients']['connected']}/{args.clients}, {report['frames_per_s']} frames/s, "
+          f"{report['bytes_per_s'] / 1024:.0f} KiB/s")
+    print(f"tick latency ms: p50 {ticks.get('p50')} p90 {ticks.get('p90')} p99 {ticks.get('p99')} max {ticks.get('max')}")
+    for kind, stats in report["rtt_ms"].items():
+        print(f"{kind:>8} rtt ms: p50 {stats['p50']} p99 {stats['p99']} ({stats['count']})")
+    server_stats = report["server"]
+    print(f"server: cpu {server_stats['cpu_percent_mean']}% (max {server_stats['cpu_percent_max']}%), "
+          f"rss {server_stats['rss_mb_max']} MiB, loop lag {server_stats['loop_lag_ms_mean']} ms")
+    print(f"written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
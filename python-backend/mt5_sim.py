@@ -0,0 +1,822 @@
+"""Simulated MetaTrader5 module for offline runs and benchmarks.
+
+Implements the subset of the MetaTrader5 package used by server.py on top of
+a deterministic broker: seeded random-walk quotes, stateful positions,
+pending orders and deal history, and an optional per-call latency that
+mimics terminal IPC. Start the backend against it with
+``python server.py --simulate`` or import it in place of MetaTrader5.
+"""
+import calendar
+import math
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+# ---------------------------------------------------------------------------
+# Constants (same values as the MetaTrader5 package)
+# ---------------------------------------------------------------------------
+TIMEFRAME_M1 = 1
+TIMEFRAME_M5 = 5
+TIMEFRAME_M15 = 15
+TIMEFRAME_M30 = 30
+TIMEFRAME_H1 = 16385
+TIMEFRAME_H4 = 16388
+TIMEFRAME_D1 = 16408
+TIMEFRAME_W1 = 32769
+TIMEFRAME_MN1 = 49153
+
+ORDER_TYPE_BUY = 0
+ORDER_TYPE_SELL = 1
+ORDER_TYPE_BUY_LIMIT = 2
+ORDER_TYPE_SELL_LIMIT = 3
+ORDER_TYPE_BUY_STOP = 4
+ORDER_TYPE_SELL_STOP = 5
+
+POSITION_TYPE_BUY = 0
+POSITION_TYPE_SELL = 1
+
+TRADE_ACTION_DEAL = 1
+TRADE_ACTION_PENDING = 5
+TRADE_ACTION_SLTP = 6
+TRADE_ACTION_MODIFY = 7
+TRADE_ACTION_REMOVE = 8
+
+ORDER_FILLING_FOK = 0
+ORDER_FILLING_IOC = 1
+ORDER_FILLING_RETURN = 2
+
+ORDER_TIME_GTC = 0
+
+TRADE_RETCODE_REQUOTE = 10004
+TRADE_RETCODE_REJECT = 10006
+TRADE_RETCODE_DONE = 10009
+TRADE_RETCODE_INVALID = 10013
+TRADE_RETCODE_INVALID_VOLUME = 10014
+TRADE_RETCODE_INVALID_PRICE = 10015
+TRADE_RETCODE_INVALID_STOPS = 10016
+TRADE_RETCODE_PRICE_CHANGED = 10020
+TRADE_RETCODE_PRICE_OFF = 10021
+TRADE_RETCODE_INVALID_FILL = 10030
+TRADE_RETCODE_POSITION_CLOSED = 10036
+
+DEAL_TYPE_BUY = 0
+DEAL_TYPE_SELL = 1
+DEAL_TYPE_BALANCE = 2
+
+DEAL_ENTRY_IN = 0
+DEAL_ENTRY_OUT = 1
+DEAL_ENTRY_INOUT = 2
+DEAL_ENTRY_OUT_BY = 3
+
+DEAL_REASON_CLIENT = 0
+DEAL_REASON_MOBILE = 1
+DEAL_REASON_WEB = 2
+DEAL_REASON_EXPERT = 3
+DEAL_REASON_SL = 4
+DEAL_REASON_TP = 5
+DEAL_REASON_SO = 6
+
+ORDER_STATE_PLACED = 1
+ORDER_STATE_CANCELED = 2
+ORDER_STATE_FILLED = 4
+
+COPY_TICKS_ALL = -1
+COPY_TICKS_INFO = 1
+COPY_TICKS_TRADE = 2
+
+# ---------------------------------------------------------------------------
+# Result records (field order follows the MetaTrader5 package)
+# ---------------------------------------------------------------------------
+AccountInfo = namedtuple("AccountInfo", [
+    "login", "trade_mode", "leverage", "limit_orders", "margin_so_mode",
+    "trade_allowed", "trade_expert", "margin_mode", "currency_digits",
+    "fifo_close", "balance", "credit", "profit", "equity", "margin",
+    "margin_free", "margin_level", "margin_so_call", "margin_so_so",
+    "margin_initial", "margin_maintenance", "assets", "liabilities",
+    "commission_blocked", "name", "server", "currency", "company",
+])
+
+SymbolInfo = namedtuple("SymbolInfo", [
+    "name", "description", "visible", "select", "digits", "point", "spread",
+    "filling_mode", "trade_contract_size", "trade_tick_value",
+    "trade_tick_value_profit", "trade_tick_value_loss", "trade_tick_size",
+    "volume_min", "volume_max", "volume_step", "currency_base",
+    "currency_profit", "currency_margin", "bid", "ask", "time",
+])
+
+Tick = namedtuple("Tick", [
+    "time", "bid", "ask", "last", "volume", "time_msc", "flags", "volume_real",
+])
+
+TradePosition = namedtuple("TradePosition", [
+    "ticket", "time", "time_msc", "time_update", "time_update_msc", "type",
+    "magic", "identifier", "reason", "volume", "price_open", "sl", "tp",
+    "price_current", "swap", "profit", "symbol", "comment", "external_id",
+])
+
+TradeOrder = namedtuple("TradeOrder", [
+    "ticket", "time_setup", "time_setup_msc", "time_done", "time_done_msc",
+    "time_expiration", "type", "type_time", "type_filling", "state", "magic",
+    "position_id", "position_by_id", "reason", "volume_initial",
+    "volume_current", "price_open", "sl", "tp", "price_current",
+    "price_stoplimit", "symbol", "comment", "external_id",
+])
+
+TradeDeal = namedtuple("TradeDeal", [
+    "ticket", "order", "time", "time_msc", "type", "entry", "magic",
+    "position_id", "reason", "volume", "price", "commission", "swap",
+    "profit", "fee", "symbol", "comment", "external_id",
+])
+
+OrderSendResult = namedtuple("OrderSendResult", [
+    "retcode", "deal", "order", "volume", "price", "bid", "ask", "comment",
+    "request_id", "retcode_external", "request",
+])
+
+RATES_DTYPE = np.dtype([
+    ("time", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"),
+    ("close", "<f8"), ("tick_volume", "<u8"), ("spread", "<i4"),
+    ("real_volume", "<u8"),
+])
+
+TICKS_DTYPE = np.dtype([
+    ("time", "<i8"), ("bid", "<f8"), ("ask", "<f8"), ("last", "<f8"),
+    ("volume", "<u8"), ("time_msc", "<i8"), ("flags", "<u4"),
+    ("volume_real", "<f8"),
+])
+
+# name: (digits, start price, contract size, profit currency, volatility per tick, spread points)
+SYMBOLS = {
+    "EURUSD": (5, 1.0850, 100000, "USD", 0.00003, 8),
+    "GBPUSD": (5, 1.2650, 100000, "USD", 0.00004, 10),
+    "USDJPY": (3, 150.20, 100000, "JPY", 0.004, 9),
+    "AUDUSD": (5, 0.6550, 100000, "USD", 0.00003, 9),
+    "USDCAD": (5, 1.3550, 100000, "CAD", 0.00003, 11),
+    "USDCHF": (5, 0.8850, 100000, "CHF", 0.00003, 12),
+    "NZDUSD": (5, 0.6050, 100000, "USD", 0.00003, 12),
+    "EURJPY": (3, 163.10, 100000, "JPY", 0.005, 14),
+    "GBPJPY": (3, 190.30, 100000, "JPY", 0.006, 18),
+    "EURGBP": (5, 0.8580, 100000, "GBP", 0.00002, 10),
+    "XAUUSD": (2, 2350.00, 100, "USD", 0.08, 25),
+    "XAGUSD": (3, 28.500, 5000, "USD", 0.004, 30),
+    "BTCUSD": (2, 65000.00, 1, "USD", 6.0, 2500),
+    "ETHUSD": (2, 3400.00, 1, "USD", 0.6, 300),
+}
+
+TIMEFRAME_SECONDS = {
+    TIMEFRAME_M1: 60,
+    TIMEFRAME_M5: 300,
+    TIMEFRAME_M15: 900,
+    TIMEFRAME_M30: 1800,
+    TIMEFRAME_H1: 3600,
+    TIMEFRAME_H4: 14400,
+    TIMEFRAME_D1: 86400,
+    TIMEFRAME_W1: 604800,
+    TIMEFRAME_MN1: 2592000,
+}
+
+_config = {
+    "seed": 42,
+    "latency": 0.0,           # seconds per call, or {function name: seconds}
+    "tick_interval": 0.25,    # simulated seconds between ticks per symbol
+    "tick_history": 3600,     # seconds of ticks kept for copy_ticks_from
+    "server_offset": 7200,    # broker server time = UTC + offset
+    "balance": 10000.0,
+    "leverage": 100,
+    "login": 10000001,
+    "server": "Blueprint-Sim",
+    "commission_per_lot": 0.0,
+    "suffix": "",
+    "clock": None,            # callable returning UTC seconds; wall clock when None
+}
+
+_lock = threading.RLock()
+_state = None
+_last_error = (1, "Success")
+
+
+def configure(**options):
+    """Update simulator settings; call reset() to apply seed/balance changes."""
+    unknown = set(options) - set(_config)
+    if unknown:
+        raise ValueError(f"Unknown simulator options: {', '.join(sorted(unknown))}")
+    _config.update(options)
+
+
+def reset():
+    """Drop all simulated state (quotes, positions, orders, history)."""
+    global _state
+    with _lock:
+        _state = None
+
+
+def _now():
+    clock = _config["clock"]
+    return (clock() if clock else time.time()) + _config["server_offset"]
+
+
+def _latency(name):
+    latency = _config["latency"]
+    if isinstance(latency, dict):
+        latency = latency.get(name, latency.get("default", 0.0))
+    if latency:
+        time.sleep(latency)
+
+
+def _api(func):
+    """Wrap a public call with the configured latency and the global lock."""
+    def wrapper(*args, **kwargs):
+        _latency(func.__name__)
+        with _lock:
+            _ensure_state()
+            return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def _to_seconds(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return calendar.timegm(value.utctimetuple()) + _config["server_offset"]
+        return calendar.timegm(value.timetuple())
+    return int(value)
+
+
+class _Symbol:
+    """Quote stream and bar history of one simulated instrument."""
+
+    def __init__(self, name, base, spec, seed, start):
+        digits, price, contract, profit_ccy, vol, spread = spec
+        self.name = name
+        self.base = base
+        self.digits = digits
+        self.point = 10 ** -digits
+        self.contract = contract
+        self.profit_ccy = profit_ccy
+        self.vol = vol
+        self.spread = spread * self.point
+        self.rng = np.random.default_rng([seed, sum(map(ord, base))])
+        self.start = start
+        self.anchor = price
+        self.bid = price
+        self.last_time = start
+        # Последние tick_history секунд тиков; бары копятся отдельно, поэтому стоимость
+        # вызовов не растет со временем работы
+        self.tick_time = np.zeros(0, dtype=np.int64)   # time_msc
+        self.tick_bid = np.zeros(0)
+        self.tick_ask = np.zeros(0)
+        self.bars = {timeframe: {} for timeframe in TIMEFRAME_SECONDS}   # timeframe -> {open time: [o, h, l, c, ticks]}
+        self.back = {}    # timeframe -> (closes, noise) generated backwards from start
+
+    def advance(self, now):
+        interval = _config["tick_interval"]
+        steps = int((now - self.last_time) / interval)
+        if steps <= 0:
+            return
+        steps = min(steps, 200000)
+        moves = self.rng.standard_normal(steps) * self.vol
+        prices = np.round(self.bid + np.cumsum(moves), self.digits)
+        prices = np.maximum(prices, self.point)
+        time_msc = ((self.last_time + np.arange(1, steps + 1) * interval) * 1000).astype(np.int64)
+        self._add_bars(time_msc // 1000, prices)
+
+        keep = np.searchsorted(self.tick_time, time_msc[-1] - int(_config["tick_history"] * 1000))
+        self.tick_time = np.concatenate([self.tick_time[keep:], time_msc])
+        self.tick_bid = np.concatenate([self.tick_bid[keep:], prices])
+        self.tick_ask = np.concatenate([self.tick_ask[keep:], np.round(prices + self.spread, self.digits)])
+        self.last_time += steps * interval
+        self.bid = float(prices[-1])
+
+    def _add_bars(self, times, bids):
+        """Folds new ticks into the live bars of every timeframe."""
+        for timeframe, seconds in TIMEFRAME_SECONDS.items():
+            opens = times // seconds * seconds
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(opens)) + 1))
+            ends = np.append(starts[1:], len(opens))
+            highs = np.maximum.reduceat(bids, starts)
+            lows = np.minimum.reduceat(bids, starts)
+            first_live = int(self.start // seconds) * seconds
+            bars = self.bars[timeframe]
+            for start, end, high, low in zip(starts.tolist(), ends.tolist(), highs.tolist(), lows.tolist()):
+                open_time = int(opens[start])
+                close = float(bids[end - 1])
+                bar = bars.get(open_time)
+                if bar is None:
+                    # Первый живой бар открывается закрытием сгенерированной истории
+                    first = self.anchor if open_time == first_live else float(bids[start])
+                    bars[open_time] = [first, max(high, first), min(low, first), close, end - start]
+                else:
+                    bar[1] = max(bar[1], high)
+                    bar[2] = min(bar[2], low)
+                    bar[3] = close
+                    bar[4] += end - start
+
+    def tick(self):
+        if len(self.tick_time):
+            time_msc, bid, ask = int(self.tick_time[-1]), float(self.tick_bid[-1]), float(self.tick_ask[-1])
+        else:
+            time_msc, bid, ask = int(self.start * 1000), self.bid, round(self.bid + self.spread, self.digits)
+        return Tick(time_msc // 1000, bid, ask, 0.0, 0, time_msc, 6, 0.0)
+
+    def _history(self, timeframe, count):
+        closes, noise = self.back.get(timeframe, (np.array([self.anchor]), np.zeros(1)))
+        if len(closes) < count + 1:
+            extra = count + 1 - len(closes) + 1024
+            vol = self.vol * math.sqrt(TIMEFRAME_SECONDS[timeframe] / _config["tick_interval"])
+            steps = self.rng.standard_normal(extra) * vol
+            more = np.maximum(closes[-1] - np.cumsum(steps), self.point)
+            closes = np.concatenate([closes, more])
+            noise = np.concatenate([noise, np.abs(self.rng.standard_normal(extra)) * vol * 0.5])
+            self.back[timeframe] = (closes, noise)
+        return closes, noise
+
+    def rates(self, timeframe, end_time, count):
+        seconds = TIMEFRAME_SECONDS[timeframe]
+        first_live = int(self.start // seconds) * seconds
+        end_bar = int(end_time // seconds) * seconds
+        opens = np.arange(end_bar - (count - 1) * seconds, end_bar + 1, seconds, dtype=np.int64)
+        rates = np.zeros(len(opens), dtype=RATES_DTYPE)
+        rates["time"] = opens
+        rates["spread"] = int(round(self.spread / self.point))
+
+        history = opens < first_live
+        if history.any():
+            ago = ((first_live - opens[history]) // seconds).astype(np.int64)
+            closes, noise = self._history(timeframe, int(ago.max()) + 1)
+            close = closes[ago - 1]
+            open_ = closes[ago]
+            rates["open"][history] = open_
+            rates["close"][history] = close
+            rates["high"][history] = np.maximum(open_, close) + noise[ago]
+            rates["low"][history] = np.minimum(open_, close) - noise[ago]
+            rates["tick_volume"][history] = 100 + (noise[ago] / max(self.vol, 1e-12)).astype(np.uint64) % 900
+
+        live_idx = np.nonzero(~history)[0]
+        if len(live_idx):
+            bars = self.bars[timeframe]
+            prev_close = self.anchor
+            for i in live_idx:
+                bar = bars.get(int(opens[i]))
+                if bar is not None:
+                    rates["open"][i], rates["high"][i], rates["low"][i], rates["close"][i], rates["tick_volume"][i] = bar
+                    prev_close = bar[3]
+                else:
+                    rates["open"][i] = rates["high"][i] = rates["low"][i] = rates["close"][i] = prev_close
+        rates = rates[(rates["open"] > 0) & (opens <= self.last_time)]
+        for field in ("open", "high", "low", "close"):
+            rates[field] = np.round(rates[field], self.digits)
+        return rates
+
+
+class _Broker:
+    def __init__(self):
+        seed = _config["seed"]
+        self.start = _now()
+        self.symbols = {}
+        for base, spec in SYMBOLS.items():
+            name = base + _config["suffix"]
+            self.symbols[name] = _Symbol(name, base, spec, seed, self.start)
+        self.balance = float(_config["balance"])
+        self.positions = {}
+        self.orders = {}
+        self.history_orders = {}
+        self.deals = []
+        self.next_ticket = 1000000
+        self.connected = False
+
+    def ticket(self):
+        self.next_ticket += 1
+        return self.next_ticket
+
+    def advance(self):
+        now = _now()
+        for sym in self.symbols.values():
+            sym.advance(now)
+        self._match_orders()
+        self._check_stops()
+
+    def rate(self, ccy):
+        """Conversion rate from ccy to the USD account currency."""
+        if ccy == "USD":
+            return 1.0
+        direct = self.symbols.get(ccy + "USD" + _config["suffix"])
+        if direct:
+            return direct.tick().bid
+        inverse = self.symbols.get("USD" + ccy + _config["suffix"])
+        if inverse:
+            return 1.0 / inverse.tick().ask
+        return 1.0
+
+    def position_profit(self, pos, tick=None):
+        sym = self.symbols[pos["symbol"]]
+        tick = tick or sym.tick()
+        if pos["type"] == POSITION_TYPE_BUY:
+            diff = tick.bid - pos["price_open"]
+        else:
+            diff = pos["price_open"] - tick.ask
+        return diff * pos["volume"] * sym.contract * self.rate(sym.profit_ccy)
+
+    def add_deal(self, order, pos, deal_type, entry, volume, price, profit, reason, comment):
+        deal = TradeDeal(
+            self.ticket(), order, int(_now()), int(_now() * 1000), deal_type, entry,
+            pos["magic"], pos["identifier"], reason, volume, price,
+            -_config["commission_per_lot"] * volume, 0.0, round(profit, 2), 0.0,
+            pos["symbol"], comment, "",
+        )
+        self.deals.append(deal)
+        return deal
+
+    def open_position(self, order_ticket, symbol, side, volume, price, sl, tp, magic, comment, reason):
+        now = _now()
+        pos = {
+            "ticket": order_ticket, "identifier": order_ticket, "time": int(now),
+            "time_msc": int(now * 1000), "type": side, "magic": magic, "reason": reason,
+            "volume": volume, "price_open": price, "sl": sl or 0.0, "tp": tp or 0.0,
+            "symbol": symbol, "comment": comment[:31],
+        }
+        self.positions[order_ticket] = pos
+        deal_type = DEAL_TYPE_BUY if side == POSITION_TYPE_BUY else DEAL_TYPE_SELL
+        return self.add_deal(order_ticket, pos, deal_type, DEAL_ENTRY_IN, volume, price, 0.0, reason, comment)
+
+    def close_position(self, pos, volume, price, reason, comment, order_ticket=None):
+        order_ticket = order_ticket or self.ticket()
+        sym = self.symbols[pos["symbol"]]
+        if pos["type"] == POSITION_TYPE_BUY:
+            diff = price - pos["price_open"]
+            deal_type = DEAL_TYPE_SELL
+        else:
+            diff = pos["price_open"] - price
+            deal_type = DEAL_TYPE_BUY
+        profit = diff * volume * sym.contract * self.rate(sym.profit_ccy)
+        self.balance += profit - _config["commission_per_lot"] * volume
+        deal = self.add_deal(order_ticket, pos, deal_type, DEAL_ENTRY_OUT, volume, price, profit, reason, comment)
+        pos["volume"] = round(pos["volume"] - volume, 8)
+        if pos["volume"] <= 1e-9:
+            del self.positions[pos["ticket"]]
+        return deal
+
+    def _match_orders(self):
+        for ticket, order in list(self.orders.items()):
+            sym = self.symbols[order["symbol"]]
+            tick = sym.tick()
+            if order["type"] == ORDER_TYPE_BUY_LIMIT and tick.ask <= order["price_open"]:
+                side, price = POSITION_TYPE_BUY, tick.ask
+            elif order["type"] == ORDER_TYPE_SELL_LIMIT and tick.bid >= order["price_open"]:
+                side, price = POSITION_TYPE_SELL, tick.bid
+            else:
+                continue
+            del self.orders[ticket]
+            order["state"] = ORDER_STATE_FILLED
+            order["position_id"] = ticket
+            order["time_done"] = int(_now())
+            self.history_orders[ticket] = order
+            self.open_position(ticket, order["symbol"], side, order["volume"], price,
+                               order["sl"], order["tp"], order["magic"], order["comment"], DEAL_REASON_CLIENT)
+
+    def _check_stops(self):
+        for pos in list(self.positions.values()):
+            tick = self.symbols[pos["symbol"]].tick()
+            price = tick.bid if pos["type"] == POSITION_TYPE_BUY else tick.ask
+            buy = pos["type"] == POSITION_TYPE_BUY
+            if pos["sl"] and (price <= pos["sl"] if buy else price >= pos["sl"]):
+                self.close_position(pos, pos["volume"], price, DEAL_REASON_SL, f"[sl {pos['sl']}]")
+            elif pos["tp"] and (price >= pos["tp"] if buy else price <= pos["tp"]):
+                self.close_position(pos, pos["volume"], price, DEAL_REASON_TP, f"[tp {pos['tp']}]")
+
+
+def _ensure_state():
+    global _state
+    if _state is None:
+        _state = _Broker()
+    _state.advance()
+    return _state
+
+
+def _result(retcode, request, comment, order=0, deal=0, volume=0.0, price=0.0):
+    global _last_error
+    _last_error = (1, "Success") if retcode == TRADE_RETCODE_DONE else (-2, comment)
+    tick = None
+    symbol = request.get("symbol") if isinstance(request, dict) else None
+    if symbol in _state.symbols:
+        tick = _state.symbols[symbol].tick()
+    return OrderSendResult(
+        retcode, deal, order, volume, price,
+        tick.bid if tick else 0.0, tick.ask if tick else 0.0,
+        comment, 0, 0, request,
+    )
+
+
+def _position_record(pos):
+    sym = _state.symbols[pos["symbol"]]
+    tick = sym.tick()
+    current = tick.bid if pos["type"] == POSITION_TYPE_BUY else tick.ask
+    return TradePosition(
+        pos["ticket"], pos["time"], pos["time_msc"], pos["time"], pos["time_msc"],
+        pos["type"], pos["magic"], pos["identifier"], pos["reason"], pos["volume"],
+        pos["price_open"], pos["sl"], pos["tp"], current, 0.0,
+        round(_state.position_profit(pos, tick), 2), pos["symbol"], pos["comment"], "",
+    )
+
+
+def _order_record(order):
+    tick = _state.symbols[order["symbol"]].tick()
+    current = tick.ask if order["type"] in (ORDER_TYPE_BUY_LIMIT, ORDER_TYPE_BUY_STOP) else tick.bid
+    return TradeOrder(
+        order["ticket"], order["time_setup"], order["time_setup"] * 1000,
+        order.get("time_done", 0), order.get("time_done", 0) * 1000, 0,
+        order["type"], ORDER_TIME_GTC, order["type_filling"], order["state"],
+        order["magic"], order.get("position_id", 0), 0, DEAL_REASON_CLIENT,
+        order["volume"], order["volume"], order["price_open"], order["sl"],
+        order["tp"], current, 0.0, order["symbol"], order["comment"], "",
+    )
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+def initialize(*args, **kwargs):
+    """Connect to the simulated terminal."""
+    _latency("initialize")
+    with _lock:
+        _ensure_state().connected = True
+    return True
+
+
+def login(*args, **kwargs):
+    return initialize()
+
+
+def shutdown():
+    with _lock:
+        if _state is not None:
+            _state.connected = False
+
+
+def last_error():
+    return _last_error
+
+
+def version():
+    return (500, 4000, "simulator")
+
+
+@_api
+def account_info():
+    profit = sum(_state.position_profit(pos) for pos in _state.positions.values())
+    margin = 0.0
+    for pos in _state.positions.values():
+        sym = _state.symbols[pos["symbol"]]
+        margin += pos["volume"] * sym.contract * pos["price_open"] * _state.rate(sym.profit_ccy) / _config["leverage"]
+    equity = _state.balance + profit
+    return AccountInfo(
+        _config["login"], 0, _config["leverage"], 0, 0, True, True, 2, 2, False,
+        round(_state.balance, 2), 0.0, round(profit, 2), round(equity, 2),
+        round(margin, 2), round(equity - margin, 2),
+        round(equity / margin * 100, 2) if margin else 0.0,
+        50.0, 30.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+        "Simulated Account", _config["server"], "USD", "Blueprint Simulator",
+    )
+
+
+@_api
+def symbols_get(group=None):
+    return tuple(symbol_info(name) for name in _state.symbols)
+
+
+@_api
+def symbol_select(symbol, enable=True):
+    return symbol in _state.symbols
+
+
+@_api
+def symbol_info(symbol):
+    sym = _state.symbols.get(symbol)
+    if sym is None:
+        return None
+    tick = sym.tick()
+    tick_value = sym.contract * sym.point * _state.rate(sym.profit_ccy)
+    return SymbolInfo(
+        sym.name, sym.base, True, True, sym.digits, sym.point,
+        int(round(sym.spread / sym.point)), 1 | 2, float(sym.contract),
+        tick_value, tick_value, tick_value, sym.point, 0.01, 100.0, 0.01,
+        sym.base[:3], sym.profit_ccy, sym.base[:3], tick.bid, tick.ask, tick.time,
+    )
+
+
+
+@_api
+def symbol_info_tick(symbol):
+    sym = _state.symbols.get(symbol)
+    return sym.tick() if sym else None
+
+
+@_api
+def copy_rates_from_pos(symbol, timeframe, start_pos, count):
+    sym = _state.symbols.get(symbol)
+    if sym is None or timeframe not in TIMEFRAME_SECONDS or count <= 0:
+        return None
+    rates = sym.rates(timeframe, sym.last_time, start_pos + count)
+    return rates[:len(rates) - start_pos] if start_pos else rates
+
+
+@_api
+def copy_rates_from(symbol, timeframe, date_from, count):
+    sym = _state.symbols.get(symbol)
+    if sym is None or timeframe not in TIMEFRAME_SECONDS or count <= 0:
+        return None
+    return sym.rates(timeframe, min(_to_seconds(date_from), sym.last_time), count)
+
+
+@_api
+def copy_rates_range(symbol, timeframe, date_from, date_to):
+    sym = _state.symbols.get(symbol)
+    if sym is None or timeframe not in TIMEFRAME_SECONDS:
+        return None
+    seconds = TIMEFRAME_SECONDS[timeframe]
+    start, end = _to_seconds(date_from), min(_to_seconds(date_to), sym.last_time)
+    count = max(0, int(end // seconds - start // seconds) + 1)
+    return sym.rates(timeframe, end, count) if count else np.zeros(0, dtype=RATES_DTYPE)
+
+
+@_api
+def copy_ticks_from(symbol, date_from, count, flags=COPY_TICKS_ALL):
+    sym = _state.symbols.get(symbol)
+    if sym is None:
+        return None
+    start_msc = _to_seconds(date_from) * 1000
+    if isinstance(date_from, (int, float)) and not isinstance(date_from, bool):
+        start_msc = int(date_from * 1000)
+    lo = int(np.searchsorted(sym.tick_time, start_msc))
+    chunk = slice(lo, lo + count)
+    ticks = np.zeros(len(sym.tick_time[chunk]), dtype=TICKS_DTYPE)
+    ticks["time_msc"] = sym.tick_time[chunk]
+    ticks["time"] = ticks["time_msc"] // 1000
+    ticks["bid"] = sym.tick_bid[chunk]
+    ticks["ask"] = sym.tick_ask[chunk]
+    ticks["flags"] = 6
+    return ticks
+
+
+@_api
+def positions_total():
+    return len(_state.positions)
+
+
+@_api
+def positions_get(symbol=None, group=None, ticket=None):
+    if ticket is not None:
+        pos = _state.positions.get(ticket)
+        return (_position_record(pos),) if pos else ()
+    return tuple(
+        _position_record(pos) for pos in _state.positions.values()
+        if symbol is None or pos["symbol"] == symbol
+    )
+
+
+@_api
+def orders_total():
+    return len(_state.orders)
+
+
+@_api
+def orders_get(symbol=None, group=None, ticket=None):
+    if ticket is not None:
+        order = _state.orders.get(ticket)
+        return (_order_record(order),) if order else ()
+    return tuple(
+        _order_record(order) for order in _state.orders.values()
+        if symbol is None or order["symbol"] == symbol
+    )
+
+
+@_api
+def history_deals_get(date_from=None, date_to=None, group=None, ticket=None, position=None):
+    if ticket is not None:
+        return tuple(d for d in _state.deals if d.ticket == ticket)
+    if position is not None:
+        return tuple(d for d in _state.deals if d.position_id == position)
+    start, end = _to_seconds(date_from), _to_seconds(date_to)
+    return tuple(d for d in _state.deals if start <= d.time < end)
+
+
+@_api
+def history_orders_get(date_from=None, date_to=None, group=None, ticket=None, position=None):
+    orders = list(_state.history_orders.values())
+    if ticket is not None:
+        return tuple(_order_record(o) for o in orders if o["ticket"] == ticket)
+    if position is not None:
+        return tuple(_order_record(o) for o in orders if o.get("position_id") == position)
+    start, end = _to_seconds(date_from), _to_seconds(date_to)
+    return tuple(_order_record(o) for o in orders if start <= o["time_setup"] < end)
+
+
+@_api
+def order_send(request):
+    action = request.get("action")
+    symbol = request.get("symbol")
+    volume = float(request.get("volume", 0) or 0)
+    magic = request.get("magic", 0)
+    comment = request.get("comment", "")
+
+    if action == TRADE_ACTION_DEAL:
+        sym = _state.symbols.get(symbol)
+        if sym is None:
+            return _result(TRADE_RETCODE_INVALID, request, "Invalid symbol")
+        tick = sym.tick()
+        if volume <= 0:
+            return _result(TRADE_RETCODE_INVALID_VOLUME, request, "Invalid volume")
+        side = POSITION_TYPE_BUY if request.get("type") == ORDER_TYPE_BUY else POSITION_TYPE_SELL
+        price = tick.ask if side == POSITION_TYPE_BUY else tick.bid
+        requested = request.get("price")
+        if requested and abs(requested - price) > request.get("deviation", 0) * 10 ** -sym.digits + 1e-12:
+            return _result(TRADE_RETCODE_REQUOTE, request, "Requote")
+        ticket = request.get("position")
+        if ticket:
+            pos = _state.positions.get(ticket)
+            if pos is None:
+                return _result(TRADE_RETCODE_POSITION_CLOSED, request, "Position closed")
+            if pos["type"] == side or volume > pos["volume"] + 1e-9:
+                return _result(TRADE_RETCODE_INVALID, request, "Invalid request")
+            order = _state.ticket()
+            deal = _state.close_position(pos, volume, price, DEAL_REASON_CLIENT, comment, order)
+            return _result(TRADE_RETCODE_DONE, request, "Request executed", order, deal.ticket, volume, price)
+        order = _state.ticket()
+        deal = _state.open_position(order, symbol, side, volume, price, request.get("sl", 0.0),
+                                    request.get("tp", 0.0), magic, comment, DEAL_REASON_CLIENT)
+        return _result(TRADE_RETCODE_DONE, request, "Request executed", order, deal.ticket, volume, price)
+
+    if action == TRADE_ACTION_PENDING:
+        if symbol not in _state.symbols:
+            return _result(TRADE_RETCODE_INVALID, request, "Invalid symbol")
+        if volume <= 0:
+            return _result(TRADE_RETCODE_INVALID_VOLUME, request, "Invalid volume")
+        price = float(request.get("price", 0) or 0)
+        if price <= 0:
+            return _result(TRADE_RETCODE_INVALID_PRICE, request, "Invalid price")
+        ticket = _state.ticket()
+        _state.orders[ticket] = {
+            "ticket": ticket, "time_setup": int(_now()), "type": request.get("type"),
+            "type_filling": request.get("type_filling", ORDER_FILLING_RETURN),
+            "state": ORDER_STATE_PLACED, "magic": magic, "volume": volume,
+            "price_open": price, "sl": float(request.get("sl", 0) or 0),
+            "tp": float(request.get("tp", 0) or 0), "symbol": symbol, "comment": comment[:31],
+        }
+        return _result(TRADE_RETCODE_DONE, request, "Request executed", ticket, 0, volume, price)
+
+    if action == TRADE_ACTION_SLTP:
+        pos = _state.positions.get(request.get("position"))
+        if pos is None:
+            return _result(TRADE_RETCODE_POSITION_CLOSED, request, "Position closed")
+        pos["sl"] = float(request.get("sl", 0) or 0)
+        pos["tp"] = float(request.get("tp", 0) or 0)
+        return _result(TRADE_RETCODE_DONE, request, "Request executed")
+
+    if action == TRADE_ACTION_REMOVE:
+        order = _state.orders.pop(request.get("order"), None)
+        if order is None:
+            return _result(TRADE_RETCODE_INVALID, request, "Invalid order")
+        order["state"] = ORDER_STATE_CANCELED
+        order["time_done"] = int(_now())
+        _state.history_orders[order["ticket"]] = order
+        return _result(TRADE_RETCODE_DONE, request, "Request executed", order["ticket"])
+
+    return _result(TRADE_RETCODE_INVALID, request, "Unsupported action")
+
+
+def seed_history(deals, days=365, symbols=None):
+    """Fill the deal history with closed round-trip trades for benchmarks."""
+    with _lock:
+        broker = _ensure_state()
+        rng = np.random.default_rng(_config["seed"])
+        names = symbols or list(broker.symbols)
+        end = int(_now())
+        start = end - days * 86400
+        trades = deals // 2
+        opens = np.sort(rng.integers(start, end - 3600, trades))
+        durations = rng.integers(60, 3 * 86400, trades)
+        sides = rng.integers(0, 2, trades)
+        reasons = rng.choice([DEAL_REASON_CLIENT, DEAL_REASON_SL, DEAL_REASON_TP, DEAL_REASON_EXPERT], trades)
+        for i in range(trades):
+            sym = broker.symbols[names[i % len(names)]]
+            identifier = broker.ticket()
+            price = round(sym.anchor * (1 + rng.normal(0, 0.01)), sym.digits)
+            close = round(price + rng.normal(0, sym.vol * 50), sym.digits)
+            volume = float(rng.choice([0.01, 0.05, 0.1, 0.5, 1.0]))
+            buy = sides[i] == 0
+            diff = (close - price) if buy else (price - close)
+            profit = round(diff * volume * sym.contract * broker.rate(sym.profit_ccy), 2)
+            t_in, t_out = int(opens[i]), int(min(opens[i] + durations[i], end - 1))
+            in_type, out_type = (DEAL_TYPE_BUY, DEAL_TYPE_SELL) if buy else (DEAL_TYPE_SELL, DEAL_TYPE_BUY)
+            reason = int(reasons[i])
+            comment = {DEAL_REASON_SL: f"[sl {close}]", DEAL_REASON_TP: f"[tp {close}]"}.get(reason, "")
+            broker.deals.append(TradeDeal(broker.ticket(), identifier, t_in, t_in * 1000, in_type, DEAL_ENTRY_IN,
+                                          12345, identifier, DEAL_REASON_CLIENT, volume, price, 0.0, 0.0, 0.0, 0.0,
+                                          sym.name, "Blueprint Market Order", ""))
+            broker.deals.append(TradeDeal(broker.ticket(), broker.ticket(), t_out, t_out * 1000, out_type,
+                                          DEAL_ENTRY_OUT, 12345, identifier, reason, volume, close,
+                                          -0.5 * volume, 0.0, profit, 0.0, sym.name, comment, ""))
+        broker.deals.sort(key=lambda d: d.time_msc)
@@ -1,20 +1,51 @@
 # ---------------------------------------------------------------------------
 # Начало файла: server.py (ЗАМЕНИТЕ ВЕСЬ ФАЙЛ ЭТИМ КОДОМ)
 # ---------------------------------------------------------------------------
-import MetaTrader5 as mt5
+import numpy as np
+import argparse
 import asyncio
+import bisect
 import websockets
 import platform
 import json
+import math
+import sqlite3
+import base64
 from datetime import datetime
 import logging
-import hashlib
 import time
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
 import os
+import sys
+import io
+import traceback
+import cProfile
+import pstats
+import tracemalloc
 import subprocess
 import threading
+import queue
+import itertools
+import concurrent.futures
 from flask import Flask, request, jsonify, send_file
+
+# Симулятор брокера вместо терминала: python server.py --simulate или MT5_SIMULATE=1
+SIMULATE = "--simulate" in sys.argv or os.environ.get("MT5_SIMULATE") == "1"
+if SIMULATE:
+    import mt5_sim as mt5
+else:
+    import MetaTrader5 as mt5
+
+# Необязательные ускорители протокола
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 from datetime import datetime, timedelta
 
 
@@ -31,12 +62,326 @@ connected_clients = set()
 position_monitors = {}
 symbol_subscriptions = {}
 pending_order_automation = {}
-last_positions_hash = {}
+pending_order_misses = {}
+client_features = {}
+client_codecs = {}
+tick_batches = {}
+client_tick_intervals = {}
+client_tick_modes = {}
+stream_cursors = {}
+last_ticks_sent = {}
 positions_cache = {}
-last_tick_time = {}
 positions_update_queue = defaultdict(list)
 is_processing_updates = defaultdict(bool)
 
+# Интервал опроса котировок общим сервисом рыночных данных (сек)
+TICK_INTERVAL = 0.5
+# Период опроса потока тиков (copy_ticks_from) для клиентов в режиме full
+TICK_STREAM_INTERVAL = 0.1
+# Шаг цикла рыночных данных: символы опрашиваются, когда подходит их период
+MARKET_DATA_STEP = 0.05
+# Интервал пересборки уровней срабатывания автоматизации (сек)
+AUTOMATION_INTERVAL = 2
+# Сколько циклов ждать истории ордера, ушедшего из списка отложенных, прежде чем забыть его настройки
+PENDING_HISTORY_MISSES = 30
+
+# Клиент с большим объемом неотправленных данных (байт) пропускает широковещательные кадры
+BROADCAST_BUFFER_LIMIT = 1024 * 1024
+
+# Границы корзин гистограмм задержки (сек)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Monotonic counter with one label, exported in Prometheus text format"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self.values[label_value] += amount
+
+    def forget(self, label_value):
+        with self._lock:
+            self.values.pop(label_value, None)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, {self.label: key}, value) for key, value in self.values.items()]
+
+class Histogram:
+    """Latency histogram with one label; observe() is safe from any thread"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self.series.get(label_value)
+            if series is None:
+                # Счетчики по корзинам (последняя - +Inf) и сумма
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(counts), total) for key, (counts, total) in self.series.items()]
+
+        samples = []
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for key, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {self.label: key, "le": bound}, cumulative))
+            samples.append((f"{self.name}_sum", {self.label: key}, total))
+            samples.append((f"{self.name}_count", {self.label: key}, cumulative))
+        return samples
+
+class Gauge:
+    """Gauge whose samples are collected at scrape time by a callback"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.collect()]
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics(metrics):
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {float(value)!r}" if label_text else f"{name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+mt5_call_seconds = Histogram("mt5_call_duration_seconds", "MT5 API call execution time on the gateway thread", "function")
+mt5_queue_wait_seconds = Histogram("mt5_queue_wait_seconds", "Time MT5 calls spend queued before execution", "priority")
+mt5_call_errors = Counter("mt5_call_errors_total", "MT5 API calls that raised an exception", "function")
+ws_message_seconds = Histogram("ws_message_duration_seconds", "WebSocket message handling time", "type")
+ws_message_errors = Counter("ws_message_errors_total", "WebSocket messages whose handler failed", "type")
+ws_frames_sent = Counter("ws_frames_sent_total", "Frames queued to each client", "client")
+ws_bytes_sent = Counter("ws_bytes_sent_total", "Payload bytes queued to each client", "client")
+ws_frames_skipped = Counter("ws_frames_skipped_total", "Broadcast frames skipped because the client's send buffer was full", "client")
+loop_lag_seconds = Histogram("event_loop_lag_seconds", "Delay of event loop heartbeats beyond their schedule", "loop")
+client_labels = {}
+
+def record_frame(websocket, frame):
+    label = client_labels.get(websocket)
+    if label is not None:
+        ws_frames_sent.inc(label)
+        # Для текстовых кадров считаем символы: совпадает с байтами для ASCII JSON
+        ws_bytes_sent.inc(label, len(frame))
+
+class JsonCodec:
+    """Default wire format: JSON text frames (orjson when installed)"""
+    name = "json"
+    binary = False
+
+    def encode(self, data):
+        if orjson is not None:
+            return orjson.dumps(data).decode()
+        return json.dumps(data)
+
+    def decode(self, message):
+        if orjson is not None:
+            return orjson.loads(message)
+        return json.loads(message)
+
+class MsgpackCodec:
+    """Binary MessagePack frames, enabled per connection with hello {codec: "msgpack"}"""
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, message):
+        return msgpack.unpackb(message, raw=False)
+
+JSON_CODEC = JsonCodec()
+CODECS = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+def get_codec(websocket):
+    """Codec negotiated by the connection's hello message (JSON by default)"""
+    return client_codecs.get(websocket, JSON_CODEC)
+
+def decode_message(message):
+    # Бинарные кадры - MessagePack, текстовые - JSON
+    if isinstance(message, bytes) and msgpack is not None:
+        return msgpack.unpackb(message, raw=False)
+    return JSON_CODEC.decode(message)
+
+async def send_message(websocket, data):
+    frame = get_codec(websocket).encode(data)
+    record_frame(websocket, frame)
+    await websocket.send(frame)
+
+# Приоритеты вызовов MT5: меньше - раньше
+MT5_PRIORITY_TRADE = 0
+MT5_PRIORITY_QUERY = 1
+MT5_PRIORITY_POLL = 2
+MT5_PRIORITY_HISTORY = 3
+MT5_PRIORITY_NAMES = {
+    MT5_PRIORITY_TRADE: "trade",
+    MT5_PRIORITY_QUERY: "query",
+    MT5_PRIORITY_POLL: "poll",
+    MT5_PRIORITY_HISTORY: "history",
+}
+
+class MT5Gateway:
+    """Dedicated worker thread that owns every call into the MetaTrader5 API.
+
+    The MetaTrader5 package is synchronous, so calling it from coroutines
+    blocks the event loop. Calls are queued here by priority (trading actions
+    first, history queries last) and awaited from the loop without blocking it.
+    """
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mt5-gateway", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            priority, _, queued_at, future, func, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            name = getattr(func, "__name__", type(func).__name__)
+            started = time.perf_counter()
+            mt5_queue_wait_seconds.observe(MT5_PRIORITY_NAMES.get(priority, str(priority)), started - queued_at)
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                mt5_call_errors.inc(name)
+                future.set_exception(e)
+            finally:
+                mt5_call_seconds.observe(name, time.perf_counter() - started)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, func, *args, priority=MT5_PRIORITY_QUERY, **kwargs):
+        """Queues a call and returns a concurrent.futures.Future with its result"""
+        self.start()
+        future = concurrent.futures.Future()
+        self._queue.put((priority, next(self._sequence), time.perf_counter(), future, func, args, kwargs))
+        return future
+
+    async def call(self, func, *args, priority=MT5_PRIORITY_QUERY, **kwargs):
+        """Runs func on the gateway thread and awaits its result"""
+        return await asyncio.wrap_future(self.submit(func, *args, priority=priority, **kwargs))
+
+    def call_sync(self, func, *args, priority=MT5_PRIORITY_QUERY, **kwargs):
+        """Blocking variant for non-async threads (Flask handlers, shutdown)"""
+        if threading.current_thread() is self._thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, priority=priority, **kwargs).result()
+
+mt5_gateway = MT5Gateway()
+
+async def mt5_call(func, *args, priority=MT5_PRIORITY_QUERY, **kwargs):
+    return await mt5_gateway.call(func, *args, priority=priority, **kwargs)
+
+# Период сердцебиения цикла событий и порог, после которого фиксируется зависание (сек)
+LOOP_HEARTBEAT_INTERVAL = 0.05
+LOOP_STALL_THRESHOLD = 0.25
+
+class LoopWatchdog:
+    """Detects event loop stalls and logs the code that is holding the loop.
+
+    A coroutine on the loop refreshes a heartbeat; a separate thread notices
+    when it goes stale and captures the loop thread's stack and current task
+    while the stall is still in progress.
+    """
+
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD):
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop = None
+        self.thread_id = None
+        self._thread = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+        
+        while True:
+            expected = time.monotonic() + LOOP_HEARTBEAT_INTERVAL
+            await asyncio.sleep(LOOP_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            loop_lag_seconds.observe("main", max(0.0, now - expected))
+            self.heartbeat = now
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < self.threshold:
+                if reported is not None:
+                    logger.warning(f"Event loop recovered after {heartbeat - reported:.3f}s stall")
+                    reported = None
+                continue
+            if reported == heartbeat:
+                continue
+            
+            # Снимаем стек, пока цикл еще занят; повторно об этом же зависании не сообщаем
+            reported = heartbeat
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)[-12:]) if frame is not None else "  <no frame>\n"
+            logger.warning(f"Event loop stalled for {stalled:.3f}s in {describe_task(current_loop_task(self.loop))}\n{stack.rstrip()}")
+
+def current_loop_task(loop):
+    # Вызывается из другого потока: только чтение, без изменений состояния цикла
+    try:
+        return asyncio.current_task(loop)
+    except RuntimeError:
+        return None
+
+def describe_task(task):
+    if task is None:
+        return "loop callback (no task)"
+    coro = task.get_coro()
+    return f"task {task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+
+loop_watchdog = LoopWatchdog()
+
 def find_terminal_by_login(login, server):
     """Finds MT5 terminal for both Windows and macOS"""
     
@@ -80,12 +425,30 @@ def find_terminal_by_login(login, server):
     else:
         return None, f"Unsupported OS: {platform.system()}"
 
+def connect_simulator():
+    """Connects to the built-in broker simulator (mt5_sim) without a terminal"""
+    global mt5_connected, mt5_initialized, SYMBOL_MAP
+    
+    if not mt5_gateway.call_sync(mt5.initialize):
+        return False, "Simulator failed to initialize"
+    account_info = mt5_gateway.call_sync(mt5.account_info)
+    mt5_connected = True
+    mt5_initialized = True
+    SYMBOL_MAP = mt5_gateway.call_sync(auto_detect_symbols)
+    logger.info(f"MT5 simulator connected: account {account_info.login}, balance ${account_info.balance:.2f}")
+    return True, "MT5 simulator connected"
+
 def start_mt5_with_credentials(login, password, server):
     """Launches MT5 with credentials on Windows and macOS"""
     global mt5_connected, mt5_initialized
     
     logger.info(f"Starting MT5 connection for login {login} on server {server}")
     
+    if SIMULATE:
+        # Терминал не запускаем: симулятор принимает любые учетные данные
+        mt5.configure(login=int(login), server=server)
+        return connect_simulator()
+    
     terminal_path, message = find_terminal_by_login(login, server)
     if not terminal_path:
         logger.error(f"Terminal search failed: {message}")
@@ -120,8 +483,8 @@ def start_mt5_with_credentials(login, password, server):
             logger.info(f"Connection attempt {attempt + 1}/25")
             
             # mt5.initialize() работает одинаково на обеих системах
-            if mt5.initialize():
-                account_info = mt5.account_info()
+            if mt5_gateway.call_sync(mt5.initialize):
+                account_info = mt5_gateway.call_sync(mt5.account_info)
                 if account_info and account_info.login == int(login):
                     mt5_connected = True
                     mt5_initialized = True
@@ -164,8 +527,15 @@ def connect_mt5_endpoint():
         
         if success:
             # Initialize symbols after successful connection
-            global SYMBOL_MAP
-            SYMBOL_MAP = auto_detect_symbols()
+            global SYMBOL_MAP, account_currency
+            SYMBOL_MAP = mt5_gateway.call_sync(auto_detect_symbols)
+            account_currency = None
+            # Состояние автоматизации и кэши рыночных данных принадлежат циклу событий - сбрасываем их там же
+            if loop_watchdog.loop is not None:
+                loop_watchdog.loop.call_soon_threadsafe(reset_account_automation)
+                loop_watchdog.loop.call_soon_threadsafe(reset_market_data)
+            else:
+                reset_market_data()
             return jsonify({"success": True, "message": message})
         else:
             return jsonify({"success": False, "error": message})
@@ -182,6 +552,170 @@ def get_status():
         "mt5_initialized": mt5_initialized
     })
 
+def collect_send_buffers():
+    # Глубина очереди отправки - байты, ожидающие записи в сокет клиента
+    samples = []
+    for client in list(connected_clients):
+        transport = getattr(client, "transport", None)
+        label = client_labels.get(client)
+        if transport is not None and label is not None:
+            samples.append(({"client": label}, transport.get_write_buffer_size()))
+    return samples
+
+METRICS = [
+    mt5_call_seconds,
+    mt5_queue_wait_seconds,
+    mt5_call_errors,
+    Gauge("mt5_queue_depth", "Calls waiting in the MT5 gateway queue", lambda: [({}, mt5_gateway.depth())]),
+    ws_message_seconds,
+    ws_message_errors,
+    Gauge("ws_clients", "Connected WebSocket clients", lambda: [({}, len(connected_clients))]),
+    Gauge("ws_send_buffer_bytes", "Bytes buffered for sending to each client", collect_send_buffers),
+    ws_frames_sent,
+    ws_bytes_sent,
+    ws_frames_skipped,
+    loop_lag_seconds,
+]
+
+@flask_app.route('/metrics')
+def serve_metrics():
+    """Prometheus scrape endpoint"""
+    return flask_app.response_class(render_metrics(METRICS), mimetype="text/plain; version=0.0.4")
+
+# Ограничения диагностических эндпоинтов
+PROFILE_MAX_SECONDS = 60
+SAMPLING_INTERVAL = 0.005
+profile_lock = threading.Lock()
+memory_snapshots = {}
+
+async def profile_loop(profiler, seconds):
+    # cProfile работает в потоке, где включен: включаем его внутри цикла событий
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+def profile_thread(target, seconds):
+    """Deterministic cProfile of the event loop or MT5 gateway thread"""
+    profiler = cProfile.Profile()
+    if target == "mt5":
+        mt5_gateway.call_sync(profiler.enable, priority=MT5_PRIORITY_TRADE)
+        time.sleep(seconds)
+        mt5_gateway.call_sync(profiler.disable, priority=MT5_PRIORITY_TRADE)
+    else:
+        asyncio.run_coroutine_threadsafe(profile_loop(profiler, seconds), loop_watchdog.loop).result()
+    return profiler
+
+def sample_threads(seconds, interval=SAMPLING_INTERVAL):
+    """Statistical profile of every thread: collapsed stacks with sample counts"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    names[loop_watchdog.thread_id] = "event-loop"
+    me = threading.get_ident()
+    stacks = defaultdict(int)
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            # Свернутый стек "поток;внешняя;...;внутренняя" - формат flamegraph.pl
+            path = []
+            while frame is not None:
+                path.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            path.append(names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(path))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+@flask_app.route('/admin/profile')
+def admin_profile():
+    """Profiles for ?seconds=N: mode=cprofile (target=loop|mt5) or mode=sampling (all threads)"""
+    seconds = min(float(request.args.get("seconds", 5)), PROFILE_MAX_SECONDS)
+    mode = request.args.get("mode", "cprofile")
+    limit = int(request.args.get("limit", 40))
+    if mode == "cprofile" and request.args.get("target", "loop") == "loop" and loop_watchdog.loop is None:
+        return "Event loop is not running", 503
+    if not profile_lock.acquire(blocking=False):
+        return "A profile is already running", 409
+
+    try:
+        output = io.StringIO()
+        if mode == "sampling":
+            samples, stacks = sample_threads(seconds)
+            output.write(f"# {samples} samples every {SAMPLING_INTERVAL * 1000:g}ms over {seconds:g}s\n")
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:limit]:
+                output.write(f"{stack} {count}\n")
+        else:
+            profiler = profile_thread(request.args.get("target", "loop"), seconds)
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats(request.args.get("sort", "cumulative")).print_stats(limit)
+        return flask_app.response_class(output.getvalue(), mimetype="text/plain")
+    finally:
+        profile_lock.release()
+
+def state_sizes():
+    """Entry counts of long-lived state containers that can grow with clients and symbols"""
+    containers = {
+        "positions_cache": positions_cache,
+        "position_monitors": position_monitors,
+        "pending_order_automation": pending_order_automation,
+        "pending_order_misses": pending_order_misses,
+        "symbol_subscriptions": symbol_subscriptions,
+        "tick_batches": tick_batches,
+        "stream_cursors": stream_cursors,
+        "last_ticks_sent": last_ticks_sent,
+        "client_labels": client_labels,
+        "chart_buffers": chart_buffers,
+        "chart_viewers": chart_viewers,
+        "tick_streams": tick_streams,
+        "symbol_specs": symbol_specs,
+        "session_opens": session_opens,
+        "positions_stream.client_versions": positions_stream.client_versions,
+        "orders_stream.client_versions": orders_stream.client_versions,
+    }
+    return {name: len(container) for name, container in containers.items()}
+
+def take_memory_snapshot():
+    # Собственные аллокации tracemalloc не интересны
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+@flask_app.route('/admin/memory')
+def admin_memory():
+    """tracemalloc diff against the previous call; the first call starts tracing"""
+    limit = int(request.args.get("limit", 25))
+    if request.args.get("stop"):
+        tracemalloc.stop()
+        memory_snapshots.clear()
+        return jsonify({"tracing": False, "sizes": state_sizes()})
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int(request.args.get("frames", 1)))
+        memory_snapshots["baseline"] = take_memory_snapshot()
+        return jsonify({"tracing": True, "message": "Tracing started, call again to diff", "sizes": state_sizes()})
+
+    snapshot = take_memory_snapshot()
+    previous = memory_snapshots.get("baseline", snapshot)
+    memory_snapshots["baseline"] = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    return jsonify({
+        "tracing": True,
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "sizes": state_sizes(),
+        "top": [
+            {
+                "where": str(stat.traceback),
+                "size_diff": stat.size_diff,
+                "size": stat.size,
+                "count_diff": stat.count_diff,
+            }
+            for stat in snapshot.compare_to(previous, "lineno")[:limit]
+        ]
+    })
+
 @flask_app.route('/terminal')
 def serve_terminal():
     """Serve the terminal HTML file"""
@@ -221,6 +755,7 @@ def start_flask_server():
     flask_app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False)
 
 def auto_detect_symbols():
+    # Выполняется целиком в потоке MT5 шлюза (mt5_gateway.call_sync)
     symbol_map = {}
     base_symbols = [
         "EURUSD", "GBPUSD", "USDJPY", "AUDUSD", "USDCAD", "USDCHF", "NZDUSD",
@@ -248,8 +783,86 @@ SYMBOL_MAP = {}
 def get_real_symbol(web_symbol):
     return SYMBOL_MAP.get(web_symbol, web_symbol)
 
-def get_filling_mode(symbol):
-    symbol_info = mt5.symbol_info(symbol)
+def get_web_symbol(mt5_symbol):
+    web_symbol = mt5_symbol
+    for suffix in ["+", ".", "m", "_raw", "pro", "#", ".a"]:
+        web_symbol = web_symbol.replace(suffix, "")
+    return web_symbol
+
+# Спецификация символа: данные, которые почти никогда не меняются
+SymbolSpec = namedtuple("SymbolSpec", [
+    "name", "digits", "point", "filling_mode",
+    "volume_min", "volume_max", "volume_step",
+    "trade_contract_size", "trade_tick_value", "trade_tick_size",
+    "currency_profit",
+])
+
+# Через сколько секунд спецификация обновляется в фоне
+SYMBOL_SPEC_TTL = 300
+
+symbol_specs = {}
+symbol_spec_requests = {}
+
+async def load_symbol_spec(symbol, priority=MT5_PRIORITY_QUERY):
+    info = await mt5_call(mt5.symbol_info, symbol, priority=priority)
+    if info is None:
+        return None
+    spec = SymbolSpec(
+        name=info.name,
+        digits=info.digits,
+        point=info.point,
+        filling_mode=info.filling_mode,
+        volume_min=info.volume_min,
+        volume_max=info.volume_max,
+        volume_step=info.volume_step,
+        trade_contract_size=info.trade_contract_size,
+        trade_tick_value=info.trade_tick_value,
+        trade_tick_size=info.trade_tick_size,
+        currency_profit=info.currency_profit,
+    )
+    symbol_specs[symbol] = (time.time(), spec)
+    return spec
+
+def refresh_symbol_spec(symbol, priority=MT5_PRIORITY_QUERY):
+    """Starts (or joins) a single background load of the symbol spec"""
+    task = symbol_spec_requests.get(symbol)
+    if task is None:
+        task = asyncio.ensure_future(load_symbol_spec(symbol, priority))
+        symbol_spec_requests[symbol] = task
+        task.add_done_callback(lambda _: symbol_spec_requests.pop(symbol, None))
+    return task
+
+async def get_symbol_spec(symbol, priority=MT5_PRIORITY_QUERY):
+    """Returns the cached SymbolSpec, loading it on first use (None for unknown symbols).
+
+    An expired entry is still served while a background refresh runs, so
+    the per-tick paths never wait for MT5 after the first load.
+    """
+    cached = symbol_specs.get(symbol)
+    if cached is None:
+        return await asyncio.shield(refresh_symbol_spec(symbol, priority))
+    
+    loaded_at, spec = cached
+    if time.time() - loaded_at > SYMBOL_SPEC_TTL:
+        refresh_symbol_spec(symbol, MT5_PRIORITY_POLL)
+    return spec
+
+# Коды отказа, после которых кэшированная спецификация считается устаревшей
+SPEC_RETCODES = {
+    mt5.TRADE_RETCODE_INVALID_VOLUME,
+    mt5.TRADE_RETCODE_INVALID_FILL,
+    mt5.TRADE_RETCODE_INVALID_STOPS,
+}
+
+def invalidate_symbol_spec(symbol=None):
+    """Drops one cached spec, or all of them when symbol is None"""
+    if symbol is None:
+        symbol_specs.clear()
+    else:
+        symbol_specs.pop(symbol, None)
+
+async def get_filling_mode(symbol):
+    symbol_info = await get_symbol_spec(symbol, priority=MT5_PRIORITY_TRADE)
     if symbol_info is None:
         return mt5.ORDER_FILLING_IOC
     
@@ -263,8 +876,8 @@ def get_filling_mode(symbol):
     else:
         return mt5.ORDER_FILLING_IOC
 
-def validate_volume(symbol, volume):
-    symbol_info = mt5.symbol_info(symbol)
+async def validate_volume(symbol, volume):
+    symbol_info = await get_symbol_spec(symbol, priority=MT5_PRIORITY_TRADE)
     if symbol_info is None:
         return volume
     
@@ -281,50 +894,283 @@ def validate_volume(symbol, volume):
     
     return round(volume, 2)
 
-def calculate_profit_universal(position, current_price, symbol_info):
-    if not current_price or not symbol_info:
-        return 0
-    
-    if position.type == mt5.POSITION_TYPE_BUY:
-        current = current_price.bid
-        price_diff = current - position.price_open
-    else:
-        current = current_price.ask
-        price_diff = position.price_open - current
-    
-    # Для золота и серебра - особый расчет
-    if "XAU" in position.symbol or "GOLD" in position.symbol:
-        profit = price_diff * position.volume * 100
-    elif "XAG" in position.symbol or "SILVER" in position.symbol:
-        profit = price_diff * position.volume * 5000
-    elif "BTC" in position.symbol or "ETH" in position.symbol or "LTC" in position.symbol:
-        profit = price_diff * position.volume
-    else:
-        # Для форекс пар (EURUSD, GBPUSD): движение на 0.001 = $1 при 0.01 лоте
-        profit = price_diff * position.volume * 100000
-    
-    return profit
+# Валюта счета: загружается при первом расчете прибыли после подключения
+account_currency = None
 
-def get_positions_hash(positions):
-    if not positions:
-        return ""
-    
-    positions_str = ""
+async def get_account_currency(priority=MT5_PRIORITY_QUERY):
+    global account_currency
+    if account_currency is None:
+        account = await mt5_call(mt5.account_info, priority=priority)
+        if account is not None:
+            account_currency = account.currency
+    return account_currency
+
+async def get_tick(symbol, ticks, priority=MT5_PRIORITY_QUERY):
+    """Quote of a symbol from this cycle's snapshot, fetched on first use"""
+    if symbol not in ticks:
+        ticks[symbol] = await mt5_call(mt5.symbol_info_tick, symbol, priority=priority)
+    return ticks[symbol]
+
+async def conversion_rate(currency, account_ccy, ticks, priority=MT5_PRIORITY_QUERY, via_usd=True):
+    """Value of one unit of currency in the account currency (None without a quote).
+
+    Uses the direct pair's bid (EURUSD for EUR -> USD) or one over the
+    inverse pair's ask (USDJPY for JPY -> USD), crossing through USD when
+    neither pair is available.
+    """
+    if currency == account_ccy:
+        return 1.0
+    
+    for pair, inverse in ((currency + account_ccy, False), (account_ccy + currency, True)):
+        tick = await get_tick(get_real_symbol(pair), ticks, priority)
+        if tick and tick.bid > 0 and tick.ask > 0:
+            return 1.0 / tick.ask if inverse else tick.bid
+    
+    if via_usd and "USD" not in (currency, account_ccy):
+        to_usd = await conversion_rate(currency, "USD", ticks, priority, via_usd=False)
+        from_usd = await conversion_rate("USD", account_ccy, ticks, priority, via_usd=False)
+        if to_usd and from_usd:
+            return to_usd * from_usd
+    return None
+
+async def price_values(symbols, ticks, priority=MT5_PRIORITY_QUERY):
+    """Account-currency value of a 1.0 price move for one lot, per symbol.
+
+    Symbols quoted in the account currency use tick_value / tick_size, which
+    is exact for every calculation mode (indices, futures). Otherwise the
+    contract size is converted from the profit currency at the current
+    rate, since the cached tick value of a cross goes stale with the rate.
+    """
+    account_ccy = await get_account_currency(priority)
+    values = {}
+    for symbol in symbols:
+        spec = await get_symbol_spec(symbol, priority=priority)
+        if spec is None:
+            continue
+        if spec.trade_tick_size > 0 and (account_ccy is None or spec.currency_profit == account_ccy):
+            values[symbol] = spec.trade_tick_value / spec.trade_tick_size
+            continue
+        
+        rate = await conversion_rate(spec.currency_profit, account_ccy, ticks, priority)
+        if rate is not None:
+            values[symbol] = spec.trade_contract_size * rate
+        elif spec.trade_tick_size > 0:
+            # Нет котировки для пересчета: последняя стоимость тика от брокера
+            values[symbol] = spec.trade_tick_value / spec.trade_tick_size
+    return values
+
+def calculate_profits(positions, ticks, values):
+    """Floating profit of every position in account currency, in one NumPy pass.
+
+    Returns (profits, current prices). Positions without a quote or price
+    value keep the profit and price MT5 reported for them.
+    """
+    count = len(positions)
+    if not count:
+        return np.zeros(0), np.zeros(0)
+    
+    # Котировки и стоимость пункта раскладываем по символам, позиции ссылаются на них индексом
+    symbols = {}
+    index = np.fromiter((symbols.setdefault(pos.symbol, len(symbols)) for pos in positions), dtype=np.int64, count=count)
+    quotes = np.full((len(symbols), 3), np.nan)
+    for symbol, i in symbols.items():
+        tick = ticks.get(symbol)
+        if tick:
+            quotes[i] = (tick.bid, tick.ask, values.get(symbol, np.nan))
+    
+    fields = np.array([(pos.type, pos.volume, pos.price_open, pos.price_current, pos.profit) for pos in positions], dtype=np.float64)
+    buy = fields[:, 0] == mt5.POSITION_TYPE_BUY
+    bid, ask, value = quotes[index].T
+    
+    current = np.where(buy, bid, ask)
+    profits = np.where(buy, current - fields[:, 2], fields[:, 2] - current) * fields[:, 1] * value
+    
+    missing = np.isnan(profits)
+    profits[missing] = fields[missing, 4]
+    current = np.where(np.isnan(current), fields[:, 3], current)
+    return profits, current
+
+def default_automation_settings():
+    return {
+        "trailing": False,
+        "trailing_profit": 10,
+        "trailing_distance": 5,
+        "trailing_steps": 0,
+        "breakeven": False,
+        "breakeven_profit": 5,
+        "breakeven_activated": False,
+        "partial_close": None,
+        "partial_close_profit": None,
+        "partial_closed": False,
+        "last_modified": 0
+    }
+
+def has_automation_rules(monitor):
+    return bool(monitor.get("trailing") or monitor.get("breakeven") or monitor.get("partial_close"))
+
+async def resolve_pending_automation(orders, priority=MT5_PRIORITY_POLL):
+    """Settles saved automation of orders that left the pending list"""
+    pending = {order.ticket for order in orders}
+    for ticket in [ticket for ticket in pending_order_misses if ticket in pending or ticket not in pending_order_automation]:
+        del pending_order_misses[ticket]
+    
+    for ticket in [ticket for ticket in pending_order_automation if ticket not in pending]:
+        history = await mt5_call(mt5.history_orders_get, ticket=ticket, priority=priority)
+        if ticket not in pending_order_automation:
+            # Позиция уже забрала настройки, пока ждали историю
+            pending_order_misses.pop(ticket, None)
+            continue
+        
+        if not history:
+            # История ордера еще не пришла - следующий цикл, но не бесконечно: ордер вне истории
+            # терминала или сохранен под другим счетом
+            misses = pending_order_misses[ticket] = pending_order_misses.get(ticket, 0) + 1
+            if misses >= PENDING_HISTORY_MISSES:
+                del pending_order_automation[ticket]
+                del pending_order_misses[ticket]
+                journal_order(ticket)
+                logger.warning(f"Order #{ticket} not found in history after {misses} cycles, automation settings dropped")
+            continue
+        
+        pending_order_misses.pop(ticket, None)
+        settings = pending_order_automation.pop(ticket)
+        journal_order(ticket)
+        position_id = history[0].position_id
+        # Отмененный или истекший ордер позиции не открыл
+        if not position_id:
+            logger.info(f"Order #{ticket} left without a position, automation settings dropped")
+        elif position_id in position_monitors:
+            # Неттинг: исполнение долило уже открытую позицию
+            if not has_automation_rules(position_monitors[position_id]):
+                position_monitors[position_id] = settings
+                journal_position(position_id)
+                logger.info(f"Automation settings transferred from order #{ticket} to position #{position_id}")
+        else:
+            # Позиции еще нет в списке - sync_position_monitors заберет настройки по ее идентификатору
+            pending_order_automation[position_id] = settings
+            journal_order(position_id)
+
+def sync_position_monitors(positions):
+    """Attaches automation settings to new positions and drops monitors of closed ones"""
     for pos in positions:
-        positions_str += f"{pos.ticket}_{pos.sl:.5f}_{pos.tp:.5f}_{pos.profit:.2f}_{pos.volume}_{pos.price_current:.5f}_"
+        positions_cache[pos.ticket] = pos
+        
+        # Проверяем, не из лимитного ли ордера эта позиция
+        if pos.ticket not in position_monitors:
+            # identifier позиции - тикет открывшего ее ордера: настройки забираются ровно один раз
+            settings = pending_order_automation.pop(pos.identifier, None)
+            if settings is not None:
+                position_monitors[pos.ticket] = settings
+                journal_order(pos.identifier)
+                journal_position(pos.ticket)
+                logger.info(f"Automation settings transferred from order #{pos.identifier} to position #{pos.ticket}")
+                logger.info(f"Settings: trailing={settings.get('trailing')}, trailing_distance=${settings.get('trailing_distance')}")
+            else:
+                position_monitors[pos.ticket] = default_automation_settings()
     
-    return hashlib.md5(positions_str.encode()).hexdigest()
+    current_tickets = {pos.ticket for pos in positions}
+    for ticket in list(positions_cache.keys()):
+        if ticket not in current_tickets:
+            del positions_cache[ticket]
+            if ticket in position_monitors:
+                del position_monitors[ticket]
+                journal_position(ticket)
+
+# Возможности протокола, которые клиент может включить сообщением hello
+SUPPORTED_FEATURES = {"positions_delta", "orders_delta", "ticks_batch"}
+
+class DeltaStream:
+    """Versioned list of rows keyed by ticket, delivered as snapshots or deltas.
+
+    update() compares the new rows with the previous ones field by field;
+    when something changed the version is bumped. Clients that enabled the
+    stream's feature and already hold the previous version receive only the
+    delta, everyone else receives a full snapshot. Each frame is serialized
+    once for all its recipients (see broadcast()).
+    """
+
+    def __init__(self, feature, key, snapshot_type, items_field, delta_type):
+        self.feature = feature
+        self.key = key
+        self.snapshot_type = snapshot_type
+        self.items_field = items_field
+        self.delta_type = delta_type
+        self.version = 0
+        self.rows = {}
+        self.client_versions = {}
+        self.lock = asyncio.Lock()
+
+    def update(self, rows):
+        """Replaces the rows and returns the delta (None if nothing changed)"""
+        new_rows = {row[self.key]: row for row in rows}
+        old_rows = self.rows
+        
+        added = [row for key, row in new_rows.items() if key not in old_rows]
+        removed = [key for key in old_rows if key not in new_rows]
+        changed = []
+        for key, row in new_rows.items():
+            old = old_rows.get(key)
+            if old is None or old == row:
+                continue
+            fields = {field: value for field, value in row.items() if old.get(field) != value}
+            fields[self.key] = key
+            changed.append(fields)
+        
+        self.rows = new_rows
+        if not (added or removed or changed):
+            return None
+        
+        self.version += 1
+        return {"added": added, "removed": removed, "changed": changed}
+
+    def snapshot_message(self):
+        return {
+            "type": self.snapshot_type,
+            "version": self.version,
+            self.items_field: list(self.rows.values())
+        }
+
+    def delta_message(self, delta):
+        return {
+            "type": self.delta_type,
+            "version": self.version,
+            "base": self.version - 1,
+            **delta
+        }
+
+    def publish(self, delta):
+        """Delivers the latest change to every connected client"""
+        delta_clients = []
+        snapshot_clients = []
+        for client in list(connected_clients):
+            if self.feature in client_features.get(client, ()) and self.client_versions.get(client) == self.version - 1:
+                delta_clients.append(client)
+            else:
+                snapshot_clients.append(client)
+            self.client_versions[client] = self.version
+        
+        skipped = broadcast(delta_clients, self.delta_message(delta)) + broadcast(snapshot_clients, self.snapshot_message())
+        # Пропустившие кадр получат снимок при следующем изменении
+        for client in skipped:
+            self.client_versions.pop(client, None)
+
+    async def send_snapshot(self, websocket):
+        self.client_versions[websocket] = self.version
+        await send_message(websocket, self.snapshot_message())
+
+    def forget(self, websocket):
+        self.client_versions.pop(websocket, None)
+
+positions_stream = DeltaStream("positions_delta", "id", "positions", "positions", "positions_delta")
+orders_stream = DeltaStream("orders_delta", "ticket", "pending_orders", "orders", "pending_orders_delta")
 
 async def handle_client(websocket):
     client_ip = websocket.remote_address[0]
     logger.info(f"Client connected: {client_ip}")
     connected_clients.add(websocket)
-    last_positions_hash[websocket] = ""
+    client_labels[websocket] = f"{client_ip}:{websocket.remote_address[1]}"
     
     try:
-        price_task = asyncio.create_task(price_updater(websocket))
-        monitor_task = asyncio.create_task(position_monitor(websocket))
-        
         async for message in websocket:
             await process_message(websocket, message)
             
@@ -334,23 +1180,43 @@ async def handle_client(websocket):
         logger.error(f"Error with client {client_ip}: {e}")
     finally:
         connected_clients.discard(websocket)
-        price_task.cancel()
-        monitor_task.cancel()
+        label = client_labels.pop(websocket, None)
+        ws_frames_sent.forget(label)
+        ws_bytes_sent.forget(label)
+        ws_frames_skipped.forget(label)
         if websocket in symbol_subscriptions:
             del symbol_subscriptions[websocket]
-        if websocket in last_positions_hash:
-            del last_positions_hash[websocket]
+        tick_batches.pop(websocket, None)
+        client_tick_intervals.pop(websocket, None)
+        client_tick_modes.pop(websocket, None)
+        stream_cursors.pop(websocket, None)
+        last_ticks_sent.pop(websocket, None)
+        if websocket in client_features:
+            del client_features[websocket]
+        if websocket in client_codecs:
+            del client_codecs[websocket]
+        if websocket in chart_viewers:
+            del chart_viewers[websocket]
+        positions_stream.forget(websocket)
+        orders_stream.forget(websocket)
 
 async def process_message(websocket, message):
     try:
-        data = json.loads(message)
+        data = decode_message(message)
+    except ValueError:
+        logger.error(f"Message parse error: {message!r}")
+        return
+    
+    try:
         msg_type = data.get("type")
         
         logger.info(f"Received: {msg_type}")
         
         handlers = {
+            "hello": handle_hello,
             "request": handle_request,
             "subscribe": handle_subscribe,
+            "unsubscribe": handle_unsubscribe,
             "order": process_order,
             "close": close_position,
             "closeAll": close_all_positions,
@@ -366,16 +1232,48 @@ async def process_message(websocket, message):
         
         handler = handlers.get(msg_type)
         if handler:
-            await handler(websocket, data)
+            started = time.perf_counter()
+            try:
+                await handler(websocket, data)
+            except Exception:
+                ws_message_errors.inc(msg_type)
+                raise
+            finally:
+                ws_message_seconds.observe(msg_type, time.perf_counter() - started)
         else:
             logger.warning(f"Unknown message type: {msg_type}")
             
-    except json.JSONDecodeError:
-        logger.error(f"JSON parse error: {message}")
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         await send_error(websocket, str(e))
 
+async def handle_hello(websocket, data):
+    """Negotiates optional protocol features and the wire codec for this connection.
+
+    The reply and every later frame use the selected codec: text frames
+    carry JSON, binary frames carry MessagePack.
+    """
+    requested = set(data.get("features", []))
+    accepted = requested & SUPPORTED_FEATURES
+    client_features[websocket] = accepted
+    
+    # Кодек: JSON по умолчанию, MessagePack если клиент его запросил и он установлен
+    codec = CODECS.get(data.get("codec"), JSON_CODEC)
+    client_codecs[websocket] = codec
+    logger.info(f"Client features: {', '.join(sorted(accepted)) or 'none'}, codec: {codec.name}")
+    
+    await send_message(websocket, {
+        "type": "hello",
+        "features": sorted(accepted),
+        "codec": get_codec(websocket).name
+    })
+    
+    # Начальный снимок, от которого клиент дальше применяет дельты
+    if "positions_delta" in accepted:
+        await send_positions(websocket, force=True)
+    if "orders_delta" in accepted:
+        await send_pending_orders(websocket, force=True)
+
 async def handle_request(websocket, data):
     request_type = data.get("data")
     
@@ -387,25 +1285,93 @@ async def handle_request(websocket, data):
         await send_positions(websocket, force=True)
         await send_pending_orders(websocket, force=True)
     elif request_type == "account":
-        await send_account_data(websocket)
+        await send_account_data(websocket, data.get("id"))
 
 async def handle_subscribe(websocket, data):
-    symbol = get_real_symbol(data.get("symbol", "EURUSD"))
-    symbol_subscriptions[websocket] = symbol
-    logger.info(f"Client subscribed to {symbol}")
-    await send_price(websocket, symbol, data.get("symbol"))
+    """subscribe {symbol} replaces the client's subscription, subscribe {symbols: [...]} adds to its watchlist.
+
+    mode "conflated" (default) delivers the latest quote of every changed
+    symbol at most max_rate times per second (2 by default); mode "full"
+    delivers every tick from the symbol's tick stream as tick_stream frames.
+    """
+    if data.get("max_rate"):
+        client_tick_intervals[websocket] = 1.0 / float(data["max_rate"])
+    if data.get("mode") in ("full", "conflated"):
+        client_tick_modes[websocket] = data["mode"]
+    
+    if "symbols" in data:
+        symbols = {get_real_symbol(symbol) for symbol in data["symbols"]}
+        subscribed = symbol_subscriptions.setdefault(websocket, set())
+        added = symbols - subscribed
+        subscribed.update(symbols)
+        logger.info(f"Client subscribed to {', '.join(sorted(added)) or 'nothing new'} ({len(subscribed)} symbols)")
+    else:
+        added = {get_real_symbol(data.get("symbol", "EURUSD"))}
+        symbol_subscriptions[websocket] = set(added)
+        tick_batches.pop(websocket, None)
+        stream_cursors.pop(websocket, None)
+        logger.info(f"Client subscribed to {next(iter(added))}")
+    
+    # Полный поток начинается с текущего тика
+    cursors = stream_cursors.setdefault(websocket, {})
+    for symbol in added:
+        stream = tick_streams.get(symbol)
+        cursors[symbol] = stream.seq if stream else 0
+    
+    await send_ticks(websocket, added)
+
+async def handle_unsubscribe(websocket, data):
+    symbols = data.get("symbols") or ([data["symbol"]] if data.get("symbol") else [])
+    subscribed = symbol_subscriptions.get(websocket, set())
+    pending = tick_batches.get(websocket, {})
+    cursors = stream_cursors.get(websocket, {})
+    for symbol in symbols:
+        symbol = get_real_symbol(symbol)
+        subscribed.discard(symbol)
+        pending.pop(get_web_symbol(symbol), None)
+        cursors.pop(symbol, None)
+    logger.info(f"Client unsubscribed from {', '.join(symbols)} ({len(subscribed)} symbols left)")
+
+async def send_ticks(websocket, symbols):
+    """Current quotes of the symbols: one ticks frame for batch clients, tick frames otherwise"""
+    ticks = []
+    for symbol in symbols:
+        data = await build_tick_data(symbol, get_web_symbol(symbol))
+        if data is not None:
+            ticks.append(data)
+    if not ticks:
+        return
+    
+    if "ticks_batch" in client_features.get(websocket, ()):
+        await send_message(websocket, {"type": "ticks", "ticks": ticks})
+    else:
+        for data in ticks:
+            await send_message(websocket, data)
 
-async def send_account_data(websocket):
+async def send_account_data(websocket, request_id=None):
     if not mt5_connected:
         await send_error(websocket, "MT5 not connected")
         return
         
-    account = mt5.account_info()
+    account = await mt5_call(mt5.account_info)
     if account is None:
         await send_error(websocket, "Failed to get account data")
         return
     
-    data = {
+    frame = build_account_data(account)
+    if request_id is not None:
+        # Тот же кадр рассылается всем после сделок - id отличает ответ на запрос
+        frame["id"] = request_id
+    await send_message(websocket, frame)
+
+async def broadcast_account_data():
+    """Sends the same account frame to every client (account state is shared)"""
+    account = await mt5_call(mt5.account_info)
+    if account is not None:
+        broadcast(connected_clients, build_account_data(account))
+
+def build_account_data(account):
+    return {
         "type": "account",
         "balance": account.balance,
         "equity": account.equity,
@@ -414,25 +1380,68 @@ async def send_account_data(websocket):
         "marginLevel": account.margin_level if account.margin > 0 else 0,
         "server": account.server # <-- ДОБАВЛЕН ЭТОТ СТРОК
     }
-    await websocket.send(json.dumps(data))
 
-async def send_price(websocket, mt5_symbol, web_symbol=None):
-    current_time = time.time()
-    if mt5_symbol in last_tick_time:
-        if current_time - last_tick_time[mt5_symbol] < 0.1:
-            return
-    last_tick_time[mt5_symbol] = current_time
+# Открытие текущего торгового дня: symbol -> (номер дня по времени сервера, open)
+session_opens = {}
+session_open_requests = {}
+
+def get_session_day(tick_time):
+    # Время тиков MT5 - это время сервера брокера, поэтому граница дня берется по нему
+    return int(tick_time) // 86400
+
+async def load_session_open(symbol, day, priority=MT5_PRIORITY_QUERY):
+    rates = await mt5_call(mt5.copy_rates_from_pos, symbol, mt5.TIMEFRAME_D1, 0, 1, priority=priority)
+    if rates is None or len(rates) == 0:
+        return
     
-    tick = mt5.symbol_info_tick(mt5_symbol)
+    cached = session_opens.get(symbol)
+    bar_day = get_session_day(rates[0]['time'])
+    # После смены дня D1 бар в терминале может появиться с задержкой - не затираем им новый день
+    if cached is None or cached[0] < day or bar_day == day:
+        session_opens[symbol] = (day, float(rates[0]['open']))
+
+def refresh_session_open(symbol, day, priority=MT5_PRIORITY_QUERY):
+    task = session_open_requests.get(symbol)
+    if task is None:
+        task = asyncio.ensure_future(load_session_open(symbol, day, priority))
+        session_open_requests[symbol] = task
+        task.add_done_callback(lambda _: session_open_requests.pop(symbol, None))
+    return task
+
+async def get_session_open(symbol, tick, priority=MT5_PRIORITY_QUERY):
+    """Returns the open of the broker's current trading day for the symbol.
+
+    The D1 bar is read once per day. On rollover the first bid of the new
+    day is used until the background reload of the D1 bar completes.
+    """
+    day = get_session_day(tick.time)
+    cached = session_opens.get(symbol)
+    
+    if cached is None:
+        await asyncio.shield(refresh_session_open(symbol, day, priority))
+        cached = session_opens.get(symbol)
+        if cached is None:
+            return tick.bid
+    
+    if cached[0] < day:
+        session_opens[symbol] = (day, tick.bid)
+        refresh_session_open(symbol, day, MT5_PRIORITY_POLL)
+        return tick.bid
+    
+    return cached[1]
+
+async def build_tick_data(mt5_symbol, web_symbol=None, tick=None, priority=MT5_PRIORITY_QUERY):
+    """Builds the tick message for a symbol (None if there are no quotes)"""
     if tick is None:
-        return
+        tick = await mt5_call(mt5.symbol_info_tick, mt5_symbol, priority=priority)
+    if tick is None:
+        return None
     
     display_symbol = web_symbol if web_symbol else mt5_symbol
     
-    rates = mt5.copy_rates_from_pos(mt5_symbol, mt5.TIMEFRAME_D1, 0, 1)
-    open_price = rates[0]['open'] if rates and len(rates) > 0 else tick.bid
+    open_price = await get_session_open(mt5_symbol, tick, priority=priority)
     
-    symbol_info = mt5.symbol_info(mt5_symbol)
+    symbol_info = await get_symbol_spec(mt5_symbol, priority=priority)
     if symbol_info:
         spread = (tick.ask - tick.bid) / symbol_info.point
     else:
@@ -445,45 +1454,27 @@ async def send_price(websocket, mt5_symbol, web_symbol=None):
         "ask": tick.ask,
         "spread": round(spread, 1),
         "open": open_price,
-        "time": int(tick.time) * 1000
+        "time": int(tick.time) * 1000,
+        "time_msc": tick.time_msc
     }
-    await websocket.send(json.dumps(data))
+    return data
 
-async def send_positions(websocket, force=False):
-    if not mt5_connected:
-        return
-        
-    positions = mt5.positions_get()
-    current_hash = get_positions_hash(positions)
-    
-    if not force and websocket in last_positions_hash:
-        if current_hash == last_positions_hash[websocket]:
-            return
-    
-    last_positions_hash[websocket] = current_hash
-    
-    if positions is None:
-        positions = []
-    
+async def position_profits(positions, ticks, priority=MT5_PRIORITY_POLL):
+    """Takes one quote snapshot for the positions' symbols and prices all of them at once"""
+    symbols = {pos.symbol for pos in positions}
+    for symbol in symbols:
+        await get_tick(symbol, ticks, priority)
+    values = await price_values(symbols, ticks, priority)
+    profits, current = calculate_profits(positions, ticks, values)
+    return profits.tolist(), current.tolist(), values
+
+async def build_position_rows(positions, priority=MT5_PRIORITY_POLL):
+    profits, prices, _ = await position_profits(positions, {}, priority)
     positions_data = []
-    for pos in positions:
-        current_price = mt5.symbol_info_tick(pos.symbol)
-        symbol_info = mt5.symbol_info(pos.symbol)
-        
-        profit = calculate_profit_universal(pos, current_price, symbol_info)
-        
-        if current_price:
-            current = current_price.bid if pos.type == mt5.POSITION_TYPE_BUY else current_price.ask
-        else:
-            current = pos.price_current
-        
-        web_symbol = pos.symbol
-        for suffix in ["+", ".", "m", "_raw", "pro", "#", ".a"]:
-            web_symbol = web_symbol.replace(suffix, "")
-        
+    for pos, profit, current in zip(positions, profits, prices):
         position_data = {
             "id": pos.ticket,
-            "symbol": web_symbol,
+            "symbol": get_web_symbol(pos.symbol),
             "type": "buy" if pos.type == mt5.POSITION_TYPE_BUY else "sell",
             "volume": pos.volume,
             "openPrice": pos.price_open,
@@ -497,75 +1488,54 @@ async def send_positions(websocket, force=False):
         }
         
         positions_data.append(position_data)
-        positions_cache[pos.ticket] = pos
-        
-        # НОВЫЙ КОД: Проверяем, не из лимитного ли ордера эта позиция
-        if pos.ticket not in position_monitors:
-            # Пытаемся найти настройки автоматизации по комментарию
-            position_comment = getattr(pos, 'comment', '')
-            settings_found = False
-            
-            # Ищем в сохраненных настройках лимитных ордеров
-            for order_id, settings in list(pending_order_automation.items()):
-                if str(order_id) in position_comment:
-                    # Переносим настройки на позицию
-                    position_monitors[pos.ticket] = settings
-                    logger.info(f"Automation settings transferred from order #{order_id} to position #{pos.ticket}")
-                    logger.info(f"Settings: trailing={settings.get('trailing')}, trailing_distance=${settings.get('trailing_distance')}")
-                    
-                    # Удаляем использованные настройки
-                    del pending_order_automation[order_id]
-                    settings_found = True
-                    break
-            
-            # Если настроек не нашли, создаем дефолтные
-            if not settings_found:
-                position_monitors[pos.ticket] = {
-                    "trailing": False,
-                    "trailing_profit": 10,
-                    "trailing_distance": 5,
-                    "breakeven": False,
-                    "breakeven_profit": 5,
-                    "breakeven_activated": False,
-                    "partial_close": None,
-                    "partial_close_profit": None,
-                    "partial_closed": False,
-                    "last_modified": 0
-                }
-    
-    current_tickets = [pos.ticket for pos in positions]
-    for ticket in list(positions_cache.keys()):
-        if ticket not in current_tickets:
-            del positions_cache[ticket]
-            if ticket in position_monitors:
-                del position_monitors[ticket]
     
-    data = {
-        "type": "positions",
-        "positions": positions_data
-    }
-    await websocket.send(json.dumps(data))
+    return positions_data
 
-async def send_pending_orders(websocket, force=False):
-    if not mt5_connected:
+async def update_positions_stream(priority=MT5_PRIORITY_POLL):
+    """Polls positions once and publishes the changes to every client (caller holds the lock)"""
+    positions = await mt5_call(mt5.positions_get, priority=priority)
+    if positions is None:
         return
     
-    # Получаем все pending ордера
-    orders = mt5.orders_get()
+    rows = await build_position_rows(positions, priority)
+    sync_position_monitors(positions)
     
-    if orders is None:
-        orders = []
+    delta = positions_stream.update(rows)
+    if delta:
+        positions_stream.publish(delta)
+
+async def send_positions(websocket, force=False):
+    if not mt5_connected:
+        return
     
+    priority = MT5_PRIORITY_QUERY if force else MT5_PRIORITY_POLL
+    async with positions_stream.lock:
+        await update_positions_stream(priority)
+        if force:
+            await positions_stream.send_snapshot(websocket)
+
+async def trade_state_service():
+    """Single positions and pending orders poller for all clients"""
+    while True:
+        try:
+            if mt5_connected and connected_clients:
+                async with positions_stream.lock:
+                    await update_positions_stream()
+                async with orders_stream.lock:
+                    await update_orders_stream()
+            
+            await asyncio.sleep(TICK_INTERVAL)
+            
+        except Exception as e:
+            logger.error(f"Trade state service error: {e}")
+            await asyncio.sleep(1)
+
+def build_order_rows(orders):
     orders_data = []
     for order in orders:
-        # Преобразуем символ для веба
-        web_symbol = order.symbol
-        for suffix in ["+", ".", "m", "_raw", "pro", "#", ".a"]:
-            web_symbol = web_symbol.replace(suffix, "")
-        
         order_data = {
             "ticket": order.ticket,
-            "symbol": web_symbol,
+            "symbol": get_web_symbol(order.symbol),
             "type": "buy_limit" if order.type == mt5.ORDER_TYPE_BUY_LIMIT else "sell_limit",
             "volume": order.volume_current,
             "price": order.price_open,
@@ -575,12 +1545,28 @@ async def send_pending_orders(websocket, force=False):
             "comment": order.comment
         }
         orders_data.append(order_data)
+    return orders_data
+
+async def update_orders_stream(priority=MT5_PRIORITY_POLL):
+    """Polls pending orders once and publishes the changes to every client (caller holds the lock)"""
+    orders = await mt5_call(mt5.orders_get, priority=priority)
+    if orders is None:
+        return
     
-    data = {
-        "type": "pending_orders",
-        "orders": orders_data
-    }
-    await websocket.send(json.dumps(data))
+    delta = orders_stream.update(build_order_rows(orders))
+    if delta:
+        orders_stream.publish(delta)
+
+async def send_pending_orders(websocket, force=False):
+    """Publishes pending order changes; with force=True always sends this client a full list"""
+    if not mt5_connected:
+        return
+    
+    priority = MT5_PRIORITY_QUERY if force else MT5_PRIORITY_POLL
+    async with orders_stream.lock:
+        await update_orders_stream(priority)
+        if force:
+            await orders_stream.send_snapshot(websocket)
 
 async def process_order(websocket, data):
     """Processes market and pending orders."""
@@ -596,16 +1582,16 @@ async def process_order(websocket, data):
 
     logger.info(f"Processing order: {order_mode} {action} {volume} {mt5_symbol}")
 
-    symbol_info = mt5.symbol_info(mt5_symbol)
+    symbol_info = await get_symbol_spec(mt5_symbol, priority=MT5_PRIORITY_TRADE)
     if not symbol_info:
         await send_error(websocket, f"Symbol {mt5_symbol} not found")
         return
 
-    volume = validate_volume(mt5_symbol, volume)
+    volume = await validate_volume(mt5_symbol, volume)
     request = {}
     
     # Получаем tick для всех типов ордеров
-    tick = mt5.symbol_info_tick(mt5_symbol)
+    tick = await mt5_call(mt5.symbol_info_tick, mt5_symbol, priority=MT5_PRIORITY_TRADE)
     if not tick:
         await send_error(websocket, f"No quotes for {mt5_symbol}")
         return
@@ -631,7 +1617,7 @@ async def process_order(websocket, data):
             "price": limit_price,
             "magic": 12345,
             "comment": "Blueprint Limit Order",
-            "type_filling": get_filling_mode(mt5_symbol),
+            "type_filling": await get_filling_mode(mt5_symbol),
             "type_time": mt5.ORDER_TIME_GTC,
         }
         current_price_for_stops = limit_price # SL/TP считаем от цены лимита
@@ -648,7 +1634,7 @@ async def process_order(websocket, data):
             "deviation": 20,
             "magic": 12345,
             "comment": "Blueprint Market Order",
-            "type_filling": get_filling_mode(mt5_symbol),
+            "type_filling": await get_filling_mode(mt5_symbol),
             "type_time": mt5.ORDER_TIME_GTC,
         }
         current_price_for_stops = request["price"]
@@ -661,86 +1647,51 @@ async def process_order(websocket, data):
     
     # Используем current_price_for_stops для расчета
     current_price = current_price_for_stops
+    
+    # Суммы в валюте счета переводим в движение цены по стоимости пункта символа
+    value = None
+    if (sl_value and sl_unit == 'dollar') or (tp_value and tp_unit == 'dollar'):
+        value = (await price_values({mt5_symbol}, {}, MT5_PRIORITY_TRADE)).get(mt5_symbol)
+        if not value:
+            await send_error(websocket, f"Cannot convert dollar SL/TP for {mt5_symbol}")
+            return
 
     # Расчет Stop Loss
     if sl_value and sl_unit:
-        sl_price = 0
-        
-        # Специальная логика для золота
-        if "XAU" in mt5_symbol or "GOLD" in mt5_symbol:
-            if sl_unit == 'dollar':
-                # Для золота: $1 профита при 0.01 лоте = $1 движения цены
-                price_change = sl_value / (volume * 100)
-                if action == "buy":
-                    sl_price = current_price - price_change
-                else:
-                    sl_price = current_price + price_change
-            else:  # pips
-                # Для золота 1 pip = 0.1$ движения цены
-                price_change = sl_value * 0.1
-                if action == "buy":
-                    sl_price = current_price - price_change
-                else:
-                    sl_price = current_price + price_change
+        if sl_unit == 'dollar':
+            price_change = sl_value / (volume * value)
+        elif "XAU" in mt5_symbol or "GOLD" in mt5_symbol:
+            # Для золота 1 pip = 0.1$ движения цены
+            price_change = sl_value * 0.1
+        else:  # points (не pips!)
+            # 100 points = 0.001 движения цены
+            price_change = sl_value * 0.00001
+        
+        if action == "buy":
+            sl_price = current_price - price_change
         else:
-            # Логика для форекс пар (EURUSD, GBPUSD и др.)
-            if sl_unit == 'dollar':
-                # Для форекс: движение на 0.001 = $1 при 0.01 лоте
-                price_change = sl_value / (volume * 100000)
-                if action == "buy":
-                    sl_price = current_price - price_change
-                else:
-                    sl_price = current_price + price_change
-            else:  # points (не pips!)
-                # 100 points = 0.001 движения цены
-                price_change = sl_value * 0.00001
-                if action == "buy":
-                    sl_price = current_price - price_change
-                else:
-                    sl_price = current_price + price_change
-        
+            sl_price = current_price + price_change
         request["sl"] = round(sl_price, symbol_info.digits)
 
     # Расчет Take Profit
     if tp_value and tp_unit:
-        tp_price = 0
-        
-        # Специальная логика для золота
-        if "XAU" in mt5_symbol or "GOLD" in mt5_symbol:
-            if tp_unit == 'dollar':
-                price_change = tp_value / (volume * 100)
-                if action == "buy":
-                    tp_price = current_price + price_change
-                else:
-                    tp_price = current_price - price_change
-            else:  # pips
-                price_change = tp_value * 0.1
-                if action == "buy":
-                    tp_price = current_price + price_change
-                else:
-                    tp_price = current_price - price_change
+        if tp_unit == 'dollar':
+            price_change = tp_value / (volume * value)
+        elif "XAU" in mt5_symbol or "GOLD" in mt5_symbol:
+            price_change = tp_value * 0.1
+        else:  # points (не pips!)
+            # 100 points = 0.001 движения цены
+            price_change = tp_value * 0.00001
+        
+        if action == "buy":
+            tp_price = current_price + price_change
         else:
-            # Логика для форекс пар (EURUSD, GBPUSD и др.)
-            if tp_unit == 'dollar':
-                # Для форекс: движение на 0.001 = $1 при 0.01 лоте
-                price_change = tp_value / (volume * 100000)
-                if action == "buy":
-                    tp_price = current_price + price_change
-                else:
-                    tp_price = current_price - price_change
-            else:  # points (не pips!)
-                # 100 points = 0.001 движения цены
-                price_change = tp_value * 0.00001
-                if action == "buy":
-                    tp_price = current_price + price_change
-                else:
-                    tp_price = current_price - tp_value * 0.00001
-        
+            tp_price = current_price - price_change
         request["tp"] = round(tp_price, symbol_info.digits)
         
     # --- КОНЕЦ БЛОКА РАСЧЕТА SL/TP ---
     
-    result = mt5.order_send(request)
+    result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
         logger.info(f"Order executed: #{result.order}")
@@ -750,6 +1701,7 @@ async def process_order(websocket, data):
             "trailing": data.get("trailing", False),
             "trailing_profit": data.get("trailing_profit", 10),
             "trailing_distance": data.get("trailing_distance", 5),
+            "trailing_steps": 0,
             "breakeven": data.get("breakeven", False),
             "breakeven_profit": data.get("breakeven_profit", 5),
             "breakeven_activated": False,
@@ -766,14 +1718,16 @@ async def process_order(websocket, data):
             # Для лимитных ордеров сохраняем с ID ордера
             if has_automation:
                 pending_order_automation[result.order] = automation_settings
+                journal_order(result.order)
                 logger.info(f"Saved automation settings for limit order #{result.order}")
                 logger.info(f"Trailing: {automation_settings['trailing']}, Distance: ${automation_settings['trailing_distance']}")
         else:
             # Для рыночных ордеров применяем к позиции
             if has_automation:
-                # Пытаемся получить ID позиции из результата
-                position_id = result.deal if hasattr(result, 'deal') else result.order
+                # Тикет позиции совпадает с тикетом открывшего ее ордера (result.deal - тикет сделки)
+                position_id = result.order
                 position_monitors[position_id] = automation_settings
+                journal_position(position_id)
                 logger.info(f"Automation settings applied to market position #{position_id}")
                 logger.info(f"Trailing: {automation_settings['trailing']}, Breakeven: {automation_settings['breakeven']}")
         
@@ -789,14 +1743,17 @@ async def process_order(websocket, data):
     else:
         error_msg = f"Error {result.retcode if result else 'None'}: {result.comment if result else 'Unknown error'}"
         logger.error(error_msg)
+        if result and result.retcode in SPEC_RETCODES:
+            # Спецификация могла измениться у брокера - перечитаем при следующем обращении
+            invalidate_symbol_spec(mt5_symbol)
         response = { 
             "type": "execution", 
             "success": False, 
             "error": error_msg 
         }
     
-    await websocket.send(json.dumps(response))
-    await send_account_data(websocket)
+    await send_message(websocket, response)
+    await broadcast_account_data()
     await send_positions(websocket, force=True)
     await send_pending_orders(websocket, force=True)
     
@@ -807,13 +1764,13 @@ async def close_position(websocket, data):
         
     position_id = data.get("positionId")
     
-    position = mt5.positions_get(ticket=position_id)
+    position = await mt5_call(mt5.positions_get, ticket=position_id, priority=MT5_PRIORITY_TRADE)
     if not position:
         await send_error(websocket, "Position not found")
         return
     
     position = position[0]
-    tick = mt5.symbol_info_tick(position.symbol)
+    tick = await mt5_call(mt5.symbol_info_tick, position.symbol, priority=MT5_PRIORITY_TRADE)
     
     request = {
         "action": mt5.TRADE_ACTION_DEAL,
@@ -825,20 +1782,21 @@ async def close_position(websocket, data):
         "deviation": 20,
         "magic": 12345,
         "comment": "Close from Terminal",
-        "type_filling": get_filling_mode(position.symbol),
+        "type_filling": await get_filling_mode(position.symbol),
         "type_time": mt5.ORDER_TIME_GTC,
     }
     
-    result = mt5.order_send(request)
+    result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
         logger.info(f"Position #{position_id} closed")
         
         if position_id in position_monitors:
             del position_monitors[position_id]
+            journal_position(position_id)
         
         await send_positions(websocket, force=True)
-        await send_account_data(websocket)
+        await broadcast_account_data()
     else:
         await send_error(websocket, f"Close error: {result.comment if result else 'Unknown error'}")
 
@@ -850,19 +1808,35 @@ async def close_partial_position(websocket, data):
     position_id = data.get("positionId")
     close_volume = float(data.get("volume", 0))
     
-    position = mt5.positions_get(ticket=position_id)
+    success, result = await execute_partial_close(position_id, close_volume)
+    
+    if success:
+        notification = {
+            "type": "notification",
+            "message": f"Closed {result} lots of position #{position_id}",
+            "level": "success"
+        }
+        await send_message(websocket, notification)
+        
+        await send_positions(websocket, force=True)
+        await broadcast_account_data()
+    else:
+        await send_error(websocket, result)
+
+async def execute_partial_close(position_id, close_volume):
+    """Closes part of a position. Returns (True, closed volume) or (False, error message)"""
+    position = await mt5_call(mt5.positions_get, ticket=position_id, priority=MT5_PRIORITY_TRADE)
     if not position:
-        await send_error(websocket, "Position not found")
-        return
+        return False, "Position not found"
     
     position = position[0]
     
     if close_volume > position.volume:
         close_volume = position.volume
     
-    close_volume = validate_volume(position.symbol, close_volume)
+    close_volume = await validate_volume(position.symbol, close_volume)
     
-    tick = mt5.symbol_info_tick(position.symbol)
+    tick = await mt5_call(mt5.symbol_info_tick, position.symbol, priority=MT5_PRIORITY_TRADE)
     
     request = {
         "action": mt5.TRADE_ACTION_DEAL,
@@ -874,119 +1848,165 @@ async def close_partial_position(websocket, data):
         "deviation": 20,
         "magic": 12345,
         "comment": "Partial close",
-        "type_filling": get_filling_mode(position.symbol),
+        "type_filling": await get_filling_mode(position.symbol),
         "type_time": mt5.ORDER_TIME_GTC,
     }
     
-    result = mt5.order_send(request)
+    result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
         logger.info(f"Partial close #{position_id}: {close_volume} lots")
         
         if position_id in position_monitors:
             position_monitors[position_id]["partial_closed"] = True
+            journal_position(position_id)
         
-        notification = {
-            "type": "notification",
-            "message": f"Closed {close_volume} lots of position #{position_id}",
-            "level": "success"
+        return True, close_volume
+    
+    return False, f"Partial close error: {result.comment if result else 'Unknown error'}"
+
+# Реквоты при массовом закрытии: одна повторная попытка по свежей цене
+REQUOTE_RETCODES = {
+    mt5.TRADE_RETCODE_REQUOTE,
+    mt5.TRADE_RETCODE_PRICE_CHANGED,
+    mt5.TRADE_RETCODE_PRICE_OFF
+}
+
+def fetch_ticks(symbols):
+    # Выполняется целиком в потоке MT5 шлюза: все котировки за один проход
+    return {symbol: mt5.symbol_info_tick(symbol) for symbol in symbols}
+
+def send_close_request(request):
+    """Runs on the MT5 thread: sends a close, retrying once at a fresh price after a requote"""
+    started = time.perf_counter()
+    result = mt5.order_send(request)
+    if result is not None and result.retcode in REQUOTE_RETCODES:
+        tick = mt5.symbol_info_tick(request["symbol"])
+        if tick is not None:
+            request = dict(request, price=tick.bid if request["type"] == mt5.ORDER_TYPE_SELL else tick.ask)
+            result = mt5.order_send(request)
+    return result, time.perf_counter() - started
+
+async def bulk_close(websocket, tickets=None, comment="CloseAll", positions=None):
+    """Closes many positions at once and streams a close_result frame per ticket"""
+    started = time.perf_counter()
+    if positions is None:
+        positions = await mt5_call(mt5.positions_get, priority=MT5_PRIORITY_TRADE) or ()
+    
+    missing = []
+    if tickets is not None:
+        wanted = {int(ticket) for ticket in tickets}
+        positions = [position for position in positions if position.ticket in wanted]
+        missing = sorted(wanted - {position.ticket for position in positions})
+    
+    by_symbol = defaultdict(list)
+    for position in positions:
+        by_symbol[position.symbol].append(position)
+    ticks = await mt5_call(fetch_ticks, list(by_symbol), priority=MT5_PRIORITY_TRADE)
+    
+    results = [
+        {"ticket": ticket, "success": False, "error": "Position not found"}
+        for ticket in missing
+    ]
+    
+    pending = []
+    for symbol, group in by_symbol.items():
+        tick = ticks.get(symbol)
+        filling = await get_filling_mode(symbol)
+        for position in group:
+            if tick is None:
+                results.append({"ticket": position.ticket, "symbol": symbol, "success": False, "error": "No quotes"})
+                continue
+            
+            request = {
+                "action": mt5.TRADE_ACTION_DEAL,
+                "position": position.ticket,
+                "symbol": symbol,
+                "volume": position.volume,
+                "type": mt5.ORDER_TYPE_SELL if position.type == mt5.POSITION_TYPE_BUY else mt5.ORDER_TYPE_BUY,
+                "price": tick.bid if position.type == mt5.POSITION_TYPE_BUY else tick.ask,
+                "deviation": 20,
+                "magic": 12345,
+                "comment": comment,
+                "type_filling": filling,
+                "type_time": mt5.ORDER_TIME_GTC,
+            }
+            # Все запросы сразу в очередь шлюза - поток MT5 отправляет их подряд, без возврата в цикл событий
+            future = mt5_gateway.submit(send_close_request, request, priority=MT5_PRIORITY_TRADE)
+            pending.append(wait_close(position, future))
+    
+    for result in results:
+        await send_message(websocket, {"type": "close_result", **result})
+    
+    # Результаты в порядке исполнения, задержка считается от начала закрытия
+    for completed in asyncio.as_completed(pending):
+        position, result, send_time = await completed
+        entry = {
+            "ticket": position.ticket,
+            "symbol": position.symbol,
+            "success": bool(result and result.retcode == mt5.TRADE_RETCODE_DONE),
+            "retcode": result.retcode if result else None,
+            "price": result.price if result else None,
+            "send_ms": round(send_time * 1000, 2),
+            "latency_ms": round((time.perf_counter() - started) * 1000, 2)
         }
-        await websocket.send(json.dumps(notification))
-        
-        await send_positions(websocket, force=True)
-        await send_account_data(websocket)
-    else:
-        await send_error(websocket, f"Partial close error: {result.comment if result else 'Unknown error'}")
+        if entry["success"]:
+            position_monitors.pop(position.ticket, None)
+            journal_position(position.ticket)
+        else:
+            entry["error"] = result.comment if result else "Unknown error"
+            logger.error(f"Error closing #{position.ticket}: {entry['error']}")
+        results.append(entry)
+        await send_message(websocket, {"type": "close_result", **entry})
+    
+    closed = sum(1 for result in results if result["success"])
+    latencies = sorted(result["latency_ms"] for result in results if "latency_ms" in result)
+    summary = {
+        "type": "close_summary",
+        "requested": len(results),
+        "closed": closed,
+        "errors": len(results) - closed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "latency_ms": {
+            "first": latencies[0] if latencies else None,
+            "median": latencies[len(latencies) // 2] if latencies else None,
+            "last": latencies[-1] if latencies else None
+        },
+        "results": [
+            {"ticket": result["ticket"], "success": result["success"], "latency_ms": result.get("latency_ms")}
+            for result in results
+        ]
+    }
+    logger.info(f"{comment}: {closed} closed, {summary['errors']} errors in {summary['elapsed_ms']} ms")
+    await send_message(websocket, summary)
+    return summary
+
+async def wait_close(position, future):
+    result, send_time = await asyncio.wrap_future(future)
+    return position, result, send_time
 
 async def close_all_positions(websocket, data):
     if not mt5_connected:
         await send_error(websocket, "MT5 not connected")
         return
-        
-    positions = mt5.positions_get()
+    
+    positions = await mt5_call(mt5.positions_get, priority=MT5_PRIORITY_TRADE)
     if not positions:
         await send_error(websocket, "No open positions")
         return
     
-    closed = 0
-    errors = 0
-    
-    for position in positions:
-        tick = mt5.symbol_info_tick(position.symbol)
-        
-        request = {
-            "action": mt5.TRADE_ACTION_DEAL,
-            "position": position.ticket,
-            "symbol": position.symbol,
-            "volume": position.volume,
-            "type": mt5.ORDER_TYPE_SELL if position.type == mt5.POSITION_TYPE_BUY else mt5.ORDER_TYPE_BUY,
-            "price": tick.bid if position.type == mt5.POSITION_TYPE_BUY else tick.ask,
-            "deviation": 20,
-            "magic": 12345,
-            "comment": "CloseAll",
-            "type_filling": get_filling_mode(position.symbol),
-            "type_time": mt5.ORDER_TIME_GTC,
-        }
-        
-        result = mt5.order_send(request)
-        
-        if result and result.retcode == mt5.TRADE_RETCODE_DONE:
-            closed += 1
-            if position.ticket in position_monitors:
-                del position_monitors[position.ticket]
-        else:
-            errors += 1
-            logger.error(f"Error closing #{position.ticket}: {result.comment if result else 'Unknown'}")
-    
-    logger.info(f"Closed positions: {closed}, errors: {errors}")
+    await bulk_close(websocket, comment="CloseAll", positions=positions)
     await send_positions(websocket, force=True)
-    await send_account_data(websocket)
+    await broadcast_account_data()
 
 async def close_multiple_positions(websocket, data):
     if not mt5_connected:
         await send_error(websocket, "MT5 not connected")
         return
-        
-    position_ids = data.get("positionIds", [])
-    
-    closed = 0
-    errors = 0
-    
-    for position_id in position_ids:
-        position = mt5.positions_get(ticket=position_id)
-        if not position:
-            errors += 1
-            continue
-        
-        position = position[0]
-        tick = mt5.symbol_info_tick(position.symbol)
-        
-        request = {
-            "action": mt5.TRADE_ACTION_DEAL,
-            "position": position_id,
-            "symbol": position.symbol,
-            "volume": position.volume,
-            "type": mt5.ORDER_TYPE_SELL if position.type == mt5.POSITION_TYPE_BUY else mt5.ORDER_TYPE_BUY,
-            "price": tick.bid if position.type == mt5.POSITION_TYPE_BUY else tick.ask,
-            "deviation": 20,
-            "magic": 12345,
-            "comment": "Multiple close",
-            "type_filling": get_filling_mode(position.symbol),
-            "type_time": mt5.ORDER_TIME_GTC,
-        }
-        
-        result = mt5.order_send(request)
-        
-        if result and result.retcode == mt5.TRADE_RETCODE_DONE:
-            closed += 1
-            if position_id in position_monitors:
-                del position_monitors[position_id]
-        else:
-            errors += 1
     
-    logger.info(f"Multiple close: {closed} closed, {errors} errors")
+    await bulk_close(websocket, data.get("positionIds", []), comment="Multiple close")
     await send_positions(websocket, force=True)
-    await send_account_data(websocket)
+    await broadcast_account_data()
 
 async def cancel_pending_order(websocket, data):
     if not mt5_connected:
@@ -1000,20 +2020,22 @@ async def cancel_pending_order(websocket, data):
         "order": ticket,
     }
     
-    result = mt5.order_send(request)
+    result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
         logger.info(f"Pending order #{ticket} cancelled")
+        pending_order_automation.pop(ticket, None)
+        journal_order(ticket)
         
         notification = {
             "type": "notification",
             "message": f"Order #{ticket} cancelled",
             "level": "success"
         }
-        await websocket.send(json.dumps(notification))
+        await send_message(websocket, notification)
         
         await send_pending_orders(websocket, force=True)
-        await send_account_data(websocket)
+        await broadcast_account_data()
     else:
         error_msg = f"Cancel error: {result.comment if result else 'Unknown error'}"
         logger.error(error_msg)
@@ -1026,48 +2048,37 @@ async def modify_position(websocket, data):
         
     position_id = data.get("positionId")
     
-    position = mt5.positions_get(ticket=position_id)
+    position = await mt5_call(mt5.positions_get, ticket=position_id, priority=MT5_PRIORITY_TRADE)
     if not position:
         await send_error(websocket, "Position not found")
         return
     
     position = position[0]
-    symbol_info = mt5.symbol_info(position.symbol)
+    symbol_info = await get_symbol_spec(position.symbol, priority=MT5_PRIORITY_TRADE)
     
     # Получаем переданные цены напрямую
     new_sl_price = data.get("sl_price")
     new_tp_price = data.get("tp_price")
     
     # Если цены не переданы напрямую, проверяем передачу в долларах (из диалога Settings)
-    if new_sl_price is None:
-        sl_dollar = data.get("sl")
-        if sl_dollar and isinstance(sl_dollar, (int, float)):
-            # Специальный расчет для золота
-            if "XAU" in position.symbol or "GOLD" in position.symbol:
-                price_change = sl_dollar / (position.volume * 100)
-            else:
-                # Для форекс пар: движение на 0.001 = $1 при 0.01 лоте
-                price_change = sl_dollar / (position.volume * 100000)
-            
-            if position.type == mt5.POSITION_TYPE_BUY:
-                new_sl_price = position.price_open - price_change
-            else:
-                new_sl_price = position.price_open + price_change
-    
-    if new_tp_price is None:
-        tp_dollar = data.get("tp")
-        if tp_dollar and isinstance(tp_dollar, (int, float)):
-            # Специальный расчет для золота
-            if "XAU" in position.symbol or "GOLD" in position.symbol:
-                price_change = tp_dollar / (position.volume * 100)
-            else:
-                # Для форекс пар: движение на 0.001 = $1 при 0.01 лоте
-                price_change = tp_dollar / (position.volume * 100000)
-            
-            if position.type == mt5.POSITION_TYPE_BUY:
-                new_tp_price = position.price_open + price_change
-            else:
-                new_tp_price = position.price_open - price_change
+    sl_dollar = data.get("sl") if new_sl_price is None else None
+    tp_dollar = data.get("tp") if new_tp_price is None else None
+    sl_dollar = sl_dollar if sl_dollar and isinstance(sl_dollar, (int, float)) else None
+    tp_dollar = tp_dollar if tp_dollar and isinstance(tp_dollar, (int, float)) else None
+    if sl_dollar is not None or tp_dollar is not None:
+        # Сумма в валюте счета -> движение цены по стоимости пункта символа
+        value = (await price_values({position.symbol}, {}, MT5_PRIORITY_TRADE)).get(position.symbol)
+        if not value:
+            await send_error(websocket, f"Cannot convert dollar SL/TP for {position.symbol}")
+            return
+        
+        buy = position.type == mt5.POSITION_TYPE_BUY
+        if sl_dollar is not None:
+            price_change = sl_dollar / (position.volume * value)
+            new_sl_price = position.price_open - price_change if buy else position.price_open + price_change
+        if tp_dollar is not None:
+            price_change = tp_dollar / (position.volume * value)
+            new_tp_price = position.price_open + price_change if buy else position.price_open - price_change
     
     request = {
         "action": mt5.TRADE_ACTION_SLTP,
@@ -1084,7 +2095,7 @@ async def modify_position(websocket, data):
         request["sl"] = round(request["sl"], symbol_info.digits) if request["sl"] else 0
         request["tp"] = round(request["tp"], symbol_info.digits) if request["tp"] else 0
     
-    result = mt5.order_send(request)
+    result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
         logger.info(f"Position #{position_id} modified")
@@ -1100,23 +2111,14 @@ async def update_automation(websocket, data):
     automation_type = data.get("automationType")
     
     if position_id not in position_monitors:
-        position_monitors[position_id] = {
-            "trailing": False,
-            "trailing_profit": 10,
-            "trailing_distance": 5,
-            "breakeven": False,
-            "breakeven_profit": 5,
-            "breakeven_activated": False,
-            "partial_close": None,
-            "partial_close_profit": None,
-            "partial_closed": False,
-            "last_modified": 0
-        }
+        position_monitors[position_id] = default_automation_settings()
     
     if automation_type == "trailing":
         position_monitors[position_id]["trailing"] = settings.get("enabled", False)
         position_monitors[position_id]["trailing_profit"] = settings.get("profitTrigger", 10)
         position_monitors[position_id]["trailing_distance"] = settings.get("distance", 5)
+        # Шаги в новых единицах заново выводятся из текущего SL
+        position_monitors[position_id]["trailing_steps"] = 0
         
     elif automation_type == "breakeven":
         position_monitors[position_id]["breakeven"] = settings.get("enabled", False)
@@ -1129,7 +2131,176 @@ async def update_automation(websocket, data):
             if key in position_monitors[position_id]:
                 position_monitors[position_id][key] = value
     
+    journal_position(position_id)
     logger.info(f"Automation updated for position #{position_id}")
+    # Уровни срабатывания пересчитываются сразу, не дожидаясь очередного цикла
+    automation_wakeup.set()
+
+# Таймфреймы графика: константа MT5 и длительность бара в секундах
+CHART_TIMEFRAMES = {
+    "M1": (mt5.TIMEFRAME_M1, 60),
+    "M5": (mt5.TIMEFRAME_M5, 300),
+    "M15": (mt5.TIMEFRAME_M15, 900),
+    "M30": (mt5.TIMEFRAME_M30, 1800),
+    "H1": (mt5.TIMEFRAME_H1, 3600),
+    "H4": (mt5.TIMEFRAME_H4, 14400),
+    "D1": (mt5.TIMEFRAME_D1, 86400),
+    "W1": (mt5.TIMEFRAME_W1, 604800),
+    "MN": (mt5.TIMEFRAME_MN1, 2419200)
+}
+CANDLE_CACHE_MAX = 100000
+
+chart_buffers = {}
+chart_viewers = {}
+
+class CandleBuffer:
+    """Bounded in-memory history of bars for one (symbol, timeframe).
+
+    load() reads the last `count` bars from MT5. sync() then asks only for
+    the bars that can have appeared since the previous sync and merges
+    them over the cached tail, so the forming bar is replaced and closed
+    bars are appended. The buffer keeps at most `capacity` newest bars.
+    """
+
+    def __init__(self, symbol, timeframe):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.mt5_timeframe, self.period = CHART_TIMEFRAMES[timeframe]
+        self.rates = None
+        self.capacity = 0
+        self.complete = False
+        self.synced_at = 0
+        self.lock = asyncio.Lock()
+
+    async def load(self, count, priority=MT5_PRIORITY_HISTORY):
+        rates = await mt5_call(mt5.copy_rates_from_pos, self.symbol, self.mt5_timeframe, 0, count, priority=priority)
+        if rates is None or len(rates) == 0:
+            return False
+        
+        self.rates = rates
+        self.capacity = count
+        # У брокера нет более старых баров - глубже не запрашиваем
+        self.complete = len(rates) < count
+        self.synced_at = time.time()
+        return True
+
+    async def sync(self, priority=MT5_PRIORITY_POLL):
+        """Fetches the bars newer than the cache, returns the ones that changed"""
+        missing = int((time.time() - self.synced_at) // self.period) + 2
+        if missing >= self.capacity:
+            await self.load(self.capacity, priority)
+            return self.rates
+        
+        rates = await mt5_call(mt5.copy_rates_from_pos, self.symbol, self.mt5_timeframe, 0, missing, priority=priority)
+        if rates is None or len(rates) == 0:
+            return None
+        self.synced_at = time.time()
+        
+        times = self.rates['time']
+        if rates['time'][0] > times[-1]:
+            # Новые бары не стыкуются с кэшем - перечитываем целиком
+            await self.load(self.capacity, priority)
+            return self.rates
+        
+        start = int(np.searchsorted(times, rates['time'][0]))
+        cached = self.rates[start:]
+        same = 0
+        while same < min(len(cached), len(rates)) and cached[same] == rates[same]:
+            same += 1
+        if same == len(rates):
+            return rates[:0]
+        
+        self.rates = np.concatenate((self.rates[:start], rates))[-self.capacity:]
+        return rates[same:]
+
+    def tail(self, count):
+        return self.rates[-count:]
+
+async def get_candles(symbol, timeframe, count, priority=MT5_PRIORITY_HISTORY):
+    """Returns the last `count` bars, from memory whenever the cache is deep enough"""
+    key = (symbol, timeframe)
+    buffer = chart_buffers.get(key)
+    if buffer is None:
+        buffer = chart_buffers[key] = CandleBuffer(symbol, timeframe)
+    
+    async with buffer.lock:
+        if buffer.rates is None or (len(buffer.rates) < count and not buffer.complete):
+            if not await buffer.load(min(max(count, buffer.capacity), CANDLE_CACHE_MAX), priority):
+                return None
+        elif time.time() - buffer.synced_at >= TICK_INTERVAL:
+            await buffer.sync(priority)
+        return buffer.tail(count)
+
+CHART_FORMATS = {"rows", "columns", "compact"}
+
+def build_candles(rates):
+    candles = []
+    for rate in rates:
+        candles.append({
+            "time": int(rate['time']) * 1000,
+            "open": float(rate['open']),
+            "high": float(rate['high']),
+            "low": float(rate['low']),
+            "close": float(rate['close']),
+            "volume": float(rate['tick_volume'])
+        })
+    return candles
+
+def build_candle_columns(rates):
+    """Columnar candles converted from the MT5 structured array in bulk, without a loop per bar"""
+    return {
+        "time": (rates['time'].astype(np.int64) * 1000).tolist(),
+        "open": rates['open'].tolist(),
+        "high": rates['high'].tolist(),
+        "low": rates['low'].tolist(),
+        "close": rates['close'].tolist(),
+        "volume": rates['tick_volume'].astype(np.float64).tolist()
+    }
+
+def build_compact_candles(rates, digits, point, binary=False):
+    """Little-endian int32 columns: seconds from time0 and points from price0.
+
+    A client restores time = (time0 + value) * 1000 and
+    price = price0 + value * point. Columns are raw bytes for binary codecs
+    and base64 for JSON. Returns None when a value does not fit into int32.
+    """
+    time0 = int(rates['time'][0])
+    price0 = round(float(rates['open'][0]), digits)
+    
+    columns = {"time": rates['time'].astype(np.int64) - time0}
+    for field in ("open", "high", "low", "close"):
+        columns[field] = np.rint((rates[field] - price0) / point).astype(np.int64)
+    columns["volume"] = rates['tick_volume'].astype(np.int64)
+    
+    limits = np.iinfo(np.int32)
+    packed = {}
+    for name, values in columns.items():
+        if values.min() < limits.min or values.max() > limits.max:
+            return None
+        raw = values.astype('<i4').tobytes()
+        packed[name] = raw if binary else base64.b64encode(raw).decode('ascii')
+    
+    return {
+        "time0": time0,
+        "price0": price0,
+        "point": point,
+        "digits": digits,
+        "columns": packed
+    }
+
+async def build_chart_payload(symbol, rates, chart_format="rows", binary=False):
+    """Candles in the format the client asked for: rows (default), columns or compact"""
+    if chart_format == "compact":
+        spec = await get_symbol_spec(symbol)
+        compact = build_compact_candles(rates, spec.digits, spec.point, binary) if spec else None
+        if compact is not None:
+            return {"format": "compact", **compact}
+        chart_format = "columns"
+    
+    if chart_format == "columns":
+        return {"format": "columns", "columns": build_candle_columns(rates)}
+    
+    return {"candles": build_candles(rates)}
 
 async def send_chart_data(websocket, data):
     if not mt5_connected:
@@ -1138,51 +2309,419 @@ async def send_chart_data(websocket, data):
         
     symbol = get_real_symbol(data.get("symbol", "EURUSD"))
     timeframe = data.get("timeframe", "H1")
-    count = data.get("count", 500)
+    count = min(int(data.get("count", 500)), CANDLE_CACHE_MAX)
+    chart_format = data.get("format", "rows")
     
     logger.info(f"Chart request: {symbol} {timeframe} ({count} candles)")
     
-    tf_map = {
-        "M1": mt5.TIMEFRAME_M1,
-        "M5": mt5.TIMEFRAME_M5,
-        "M15": mt5.TIMEFRAME_M15,
-        "M30": mt5.TIMEFRAME_M30,
-        "H1": mt5.TIMEFRAME_H1,
-        "H4": mt5.TIMEFRAME_H4,
-        "D1": mt5.TIMEFRAME_D1,
-        "W1": mt5.TIMEFRAME_W1,
-        "MN": mt5.TIMEFRAME_MN1
-    }
+    if timeframe not in CHART_TIMEFRAMES:
+        timeframe = "H1"
+    if chart_format not in CHART_FORMATS:
+        chart_format = "rows"
     
-    mt5_timeframe = tf_map.get(timeframe, mt5.TIMEFRAME_H1)
-    
-    rates = mt5.copy_rates_from_pos(symbol, mt5_timeframe, 0, count)
+    rates = await get_candles(symbol, timeframe, count)
     
     if rates is None or len(rates) == 0:
         logger.warning(f"No data for {symbol}")
         await send_error(websocket, f"No data for {symbol}")
         return
     
-    candles = []
-    for rate in rates:
-        candles.append({
-            "time": int(rate['time']) * 1000,
-            "open": float(rate['open']),
-            "high": float(rate['high']),
-            "low": float(rate['low']),
-            "close": float(rate['close']),
-            "volume": float(rate['tick_volume'])
-        })
+    # Клиент смотрит на этот график - будет получать обновления бара
+    chart_viewers[websocket] = (symbol, timeframe)
+    
+    payload = await build_chart_payload(symbol, rates, chart_format, get_codec(websocket).binary)
     
-    logger.info(f"Sent {len(candles)} candles")
+    logger.info(f"Sent {len(rates)} candles ({payload.get('format', 'rows')})")
     
     response = {
         "type": "chart",
-        "candles": candles
+        "symbol": get_web_symbol(symbol),
+        "timeframe": timeframe,
+        **payload
     }
-    await websocket.send(json.dumps(response))
+    await send_message(websocket, response)
+
+async def chart_update_service():
+    """Keeps the viewed charts in sync and pushes changed bars to their viewers"""
+    while True:
+        try:
+            if mt5_connected and chart_viewers:
+                viewers = defaultdict(list)
+                for websocket, key in list(chart_viewers.items()):
+                    viewers[key].append(websocket)
+                
+                for (symbol, timeframe), clients in viewers.items():
+                    buffer = chart_buffers.get((symbol, timeframe))
+                    if buffer is None:
+                        continue
+                    
+                    async with buffer.lock:
+                        if buffer.rates is None:
+                            continue
+                        updated = await buffer.sync(MT5_PRIORITY_POLL)
+                    
+                    # Обновление - один-два бара, всегда построчно
+                    if updated is not None and len(updated) > 0:
+                        broadcast(clients, {
+                            "type": "chart_update",
+                            "symbol": get_web_symbol(symbol),
+                            "timeframe": timeframe,
+                            "candles": build_candles(updated)
+                        })
+            
+            await asyncio.sleep(TICK_INTERVAL)
+            
+        except Exception as e:
+            logger.error(f"Chart update service error: {e}")
+            await asyncio.sleep(1)
+
+# Локальная копия истории сделок (SQLite, по файлу на счет)
+DEALS_DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# Перекрытие при досинхронизации: покрывает разницу часовых поясов сервера
+DEAL_SYNC_OVERLAP = 86400
+
+DEAL_FIELDS = [
+    "ticket", "order", "time", "time_msc", "type", "entry", "magic", "position_id",
+    "reason", "volume", "price", "commission", "swap", "profit", "fee",
+    "symbol", "comment", "external_id"
+]
+StoredDeal = namedtuple("StoredDeal", DEAL_FIELDS)
+DEAL_DEFAULTS = {"fee": 0.0, "comment": "", "external_id": ""}
+
+DEAL_COLUMNS = ", ".join(f'"{field}"' for field in DEAL_FIELDS)
+DEALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deals (
+    ticket INTEGER PRIMARY KEY,
+    "order" INTEGER, time INTEGER, time_msc INTEGER, type INTEGER, entry INTEGER,
+    magic INTEGER, position_id INTEGER, reason INTEGER, volume REAL, price REAL,
+    commission REAL, swap REAL, profit REAL, fee REAL,
+    symbol TEXT, comment TEXT, external_id TEXT
+);
+CREATE INDEX IF NOT EXISTS deals_time ON deals (time);
+CREATE INDEX IF NOT EXISTS deals_position ON deals (position_id, time);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS trades (
+    position_id INTEGER PRIMARY KEY,
+    open_key INTEGER, close_key INTEGER, profit_key REAL
+);
+CREATE INDEX IF NOT EXISTS trades_open ON trades (open_key, position_id);
+CREATE INDEX IF NOT EXISTS trades_close ON trades (close_key, position_id);
+CREATE INDEX IF NOT EXISTS trades_profit ON trades (profit_key, position_id);
+"""
+
+# Ключи сортировки истории: агрегаты по позиции, вычисляемые в SQLite
+HISTORY_SORT_KEYS = {
+    "closeTime": "close_key",
+    "openTime": "open_key",
+    "profit": "profit_key"
+}
+HISTORY_CHUNK_SIZE = 500
+HISTORY_PAGE_MAX = 5000
+
+# Сводка по позиции для постраничной выдачи: пересчитывается при вставке сделок.
+# Позиция попадает в период по времени первого входа, как и в build_trades()
+TRADES_VERSION = 2
+TRADES_REFRESH = f"""
+INSERT OR REPLACE INTO trades (position_id, open_key, close_key, profit_key)
+SELECT position_id,
+    MIN(CASE WHEN entry = {mt5.DEAL_ENTRY_IN} THEN time END) AS open_key,
+    COALESCE(
+        MAX(CASE WHEN entry IN ({mt5.DEAL_ENTRY_OUT}, {mt5.DEAL_ENTRY_OUT_BY}) THEN time END),
+        MIN(CASE WHEN entry = {mt5.DEAL_ENTRY_IN} THEN time END)
+    ),
+    SUM(profit)
+FROM deals
+WHERE type IN ({mt5.DEAL_TYPE_BUY}, {mt5.DEAL_TYPE_SELL}) AND position_id IN (SELECT position_id FROM temp.changed)
+GROUP BY position_id
+HAVING open_key IS NOT NULL
+"""
+
+deal_stores = {}
+
+class DealStore:
+    """Local SQLite copy of one account's deal history, keyed by deal ticket.
+
+    MT5 is asked only for the part of a requested range that has never been
+    stored and for the deals newer than the last stored one; the history
+    itself is answered by indexed range queries. All database work runs on
+    the store's own thread so the event loop is never blocked by disk I/O.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = asyncio.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="deal-store")
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def ensure_open(self):
+        # Вызывается под self.lock
+        if self.db is None:
+            await self.run(self._open)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(DEALS_SCHEMA)
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS changed (position_id INTEGER PRIMARY KEY)")
+        
+        # Сводка из старой версии (или ее нет) - строим по всем сохраненным сделкам
+        if self._get_meta("trades_version") != TRADES_VERSION:
+            self.db.execute("DELETE FROM trades")
+            self._refresh_trades("SELECT DISTINCT position_id FROM deals")
+            self._set_meta("trades_version", TRADES_VERSION)
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        self.db.commit()
+
+    def _insert(self, deals):
+        rows = [tuple(getattr(deal, field, DEAL_DEFAULTS.get(field, 0)) for field in DEAL_FIELDS) for deal in deals]
+        placeholders = ", ".join("?" * len(DEAL_FIELDS))
+        self.db.executemany(f"INSERT OR REPLACE INTO deals ({DEAL_COLUMNS}) VALUES ({placeholders})", rows)
+        self.db.executemany("INSERT OR IGNORE INTO temp.changed (position_id) VALUES (?)", {(deal.position_id,) for deal in deals})
+        self._refresh_trades()
+
+    def _refresh_trades(self, positions_query=None):
+        if positions_query is not None:
+            self.db.execute(f"INSERT OR IGNORE INTO temp.changed (position_id) {positions_query}")
+        self.db.execute(TRADES_REFRESH)
+        self.db.execute("DELETE FROM temp.changed")
+        self.db.commit()
+
+    def _last_deal_time(self):
+        return self.db.execute("SELECT MAX(time) FROM deals").fetchone()[0]
+
+    def _query(self, start, end):
+        cursor = self.db.execute(
+            f"SELECT {DEAL_COLUMNS} FROM deals WHERE time >= ? AND time < ? ORDER BY time, ticket",
+            (start, end)
+        )
+        return [StoredDeal(*row) for row in cursor]
+
+    def _select_keys(self, start, end, sort_column, descending, cursor, limit):
+        """Keyset scan over the positions opened in range, in sort order"""
+        direction, compare = ("DESC", "<") if descending else ("ASC", ">")
+        query = f"SELECT position_id, {sort_column} FROM trades WHERE open_key >= ? AND open_key < ?"
+        params = [start, end]
+        if cursor is not None:
+            query += f" AND ({sort_column}, position_id) {compare} (?, ?)"
+            params += list(cursor)
+        query += f" ORDER BY {sort_column} {direction}, position_id {direction} LIMIT ?"
+        params.append(limit)
+        return self.db.execute(query, params)
+
+    def _load_page(self, keys, start, end, limit):
+        """Reads the next `limit` keys and the deals of those positions"""
+        keys = keys.fetchmany(limit)
+        if not keys:
+            return [], [], None
+        
+        position_ids = [position_id for position_id, _ in keys]
+        placeholders = ", ".join("?" * len(position_ids))
+        rows = self.db.execute(
+            f"SELECT {DEAL_COLUMNS} FROM deals WHERE position_id IN ({placeholders}) "
+            f"AND time >= ? AND time < ? ORDER BY time, ticket",
+            position_ids + [start, end]
+        )
+        deals = [StoredDeal(*row) for row in rows]
+        next_cursor = [keys[-1][1], keys[-1][0]] if len(keys) == limit else None
+        return deals, position_ids, next_cursor
+
+    def _trade_page(self, start, end, sort_column, descending, cursor, limit):
+        keys = self._select_keys(start, end, sort_column, descending, cursor, limit)
+        return self._load_page(keys, start, end, limit)
+
+    async def trade_page(self, from_date, to_date, sort_key="closeTime", descending=True, cursor=None, limit=HISTORY_CHUNK_SIZE):
+        """One page of trades in sort order and the cursor of the next page (None at the end)"""
+        start, end = get_broker_timestamp(from_date), get_broker_timestamp(to_date)
+        async with self.lock:
+            # Продолжение с cursor приходит без sync - после рестарта база еще не открыта
+            await self.ensure_open()
+            deals, position_ids, next_cursor = await self.run(
+                self._trade_page, start, end, HISTORY_SORT_KEYS[sort_key], descending, cursor, limit
+            )
+        return order_trades(deals, position_ids), next_cursor
+
+    async def iter_trade_pages(self, from_date, to_date, sort_key="closeTime", descending=True, cursor=None, limit=HISTORY_CHUNK_SIZE):
+        """Yields (trades, next_cursor) pages of one ordered keyset scan, one page in memory at a time.
+
+        Every page is a fresh query from the previous page's cursor, read
+        under the store lock, so a sync that rebuilds trades between pages
+        can neither skip nor repeat rows.
+        """
+        while True:
+            trades, cursor = await self.trade_page(from_date, to_date, sort_key, descending, cursor, limit)
+            yield trades, cursor
+            if cursor is None:
+                return
+
+    async def sync(self, from_date):
+        """Stores the deals from from_date up to now that are not stored yet"""
+        async with self.lock:
+            await self.ensure_open()
+            
+            upper = datetime.now() + timedelta(days=1)
+            synced_from = await self.run(self._get_meta, "synced_from")
+            
+            # Раньше этот период не загружали - догружаем только недостающую часть
+            if synced_from is None or from_date.timestamp() < synced_from:
+                to_date = upper if synced_from is None else datetime.fromtimestamp(synced_from + DEAL_SYNC_OVERLAP)
+                deals = await mt5_call(mt5.history_deals_get, from_date, to_date, priority=MT5_PRIORITY_HISTORY)
+                if deals is None:
+                    return False
+                await self.run(self._insert, deals)
+                synced_from = from_date.timestamp()
+                await self.run(self._set_meta, "synced_from", synced_from)
+            
+            # Новые сделки - начиная с последней сохраненной
+            last_time = await self.run(self._last_deal_time)
+            since = datetime.fromtimestamp(last_time - DEAL_SYNC_OVERLAP) if last_time else datetime.fromtimestamp(synced_from)
+            deals = await mt5_call(mt5.history_deals_get, since, upper, priority=MT5_PRIORITY_HISTORY)
+            if deals:
+                await self.run(self._insert, deals)
+            return True
+
+    async def query(self, from_date, to_date):
+        """Deals with from_date <= time < to_date, in broker time like deal.time"""
+        async with self.lock:
+            await self.ensure_open()
+            return await self.run(self._query, get_broker_timestamp(from_date), get_broker_timestamp(to_date))
+
+def get_broker_timestamp(date):
+    # deal.time - время сервера, записанное как секунды от эпохи
+    return int((date - datetime(1970, 1, 1)).total_seconds())
+
+async def get_deal_store():
+    account = await mt5_call(mt5.account_info)
+    if account is None:
+        return None
+    
+    store = deal_stores.get(account.login)
+    if store is None:
+        store = deal_stores[account.login] = DealStore(os.path.join(DEALS_DB_DIR, f"deals_{account.login}.sqlite3"))
+    return store
+
+# Тип закрытия по причине исходящей сделки
+EXIT_TYPES_BY_REASON = {
+    mt5.DEAL_REASON_TP: "tp",
+    mt5.DEAL_REASON_SL: "sl",
+    mt5.DEAL_REASON_SO: "sl"
+}
+
+DEALS_DTYPE = np.dtype([
+    (field, object if field in ("symbol", "comment", "external_id")
+     else np.float64 if field in ("volume", "price", "commission", "swap", "profit", "fee")
+     else np.int64)
+    for field in DEAL_FIELDS
+])
+
+def build_trades(deals):
+    """Groups deals into round-trip trades by position, newest close first.
+
+    The group-by is vectorized: deals are sorted by position (stable, so
+    time order is kept inside a position), profit/commission/swap are summed
+    with reduceat and the first entry and last exit deal of every position
+    are picked by index. A position without an entry deal in the list is
+    skipped.
+    """
+    # MT5 TradeDeal и StoredDeal - кортежи с одинаковым порядком полей
+    deals = np.array(list(deals), dtype=DEALS_DTYPE)
+    # Пропускаем балансовые операции
+    trading = np.flatnonzero(np.isin(deals["type"], (mt5.DEAL_TYPE_BUY, mt5.DEAL_TYPE_SELL)))
+    if len(trading) == 0:
+        return []
+    
+    order = trading[np.argsort(deals["position_id"][trading], kind="stable")]
+    col = deals[order]
+    position_ids = col["position_id"]
+    
+    starts = np.flatnonzero(np.r_[True, position_ids[1:] != position_ids[:-1]])
+    index = np.arange(len(order))
+    
+    # Первая входящая и последняя исходящая сделка каждой позиции
+    entries = col["entry"]
+    is_in = entries == mt5.DEAL_ENTRY_IN
+    is_out = (entries == mt5.DEAL_ENTRY_OUT) | (entries == mt5.DEAL_ENTRY_OUT_BY)
+    first_in = np.minimum.reduceat(np.where(is_in, index, len(index)), starts)
+    last_out = np.maximum.reduceat(np.where(is_out, index, -1), starts)
+    last_comment = np.maximum.reduceat(np.where(col["comment"] != "", index, -1), starts)
+    
+    profit = np.add.reduceat(col["profit"], starts)
+    commission = np.add.reduceat(col["commission"], starts)
+    swap = np.add.reduceat(col["swap"], starts)
+    
+    # Позиции без входящей сделки в выборке пропускаем
+    opened = first_in < len(index)
+    starts, first_in, last_out, last_comment = starts[opened], first_in[opened], last_out[opened], last_comment[opened]
+    profit, commission, swap = profit[opened], commission[opened], swap[opened]
+    closed = last_out >= 0
+    out = np.where(closed, last_out, first_in)
+    
+    exit_types = np.full(len(starts), "manual", dtype=object)
+    for reason, exit_type in EXIT_TYPES_BY_REASON.items():
+        exit_types[closed & (col["reason"][out] == reason)] = exit_type
+    
+    # Новые сверху; при равном времени - в порядке появления позиции
+    close_time = col["time"][out] * 1000
+    ranking = np.lexsort((order[starts], -close_time))
+    
+    starts, first_in, out, last_comment = starts[ranking], first_in[ranking], out[ranking], last_comment[ranking]
+    open_price = col["price"][first_in].tolist()
+    rows = zip(
+        position_ids[starts].tolist(),
+        col["symbol"][starts].tolist(),
+        np.where(col["type"][first_in] == mt5.DEAL_TYPE_BUY, "buy", "sell").tolist(),
+        col["volume"][first_in].tolist(),
+        (col["time"][first_in] * 1000).tolist(),
+        close_time[ranking].tolist(),
+        open_price,
+        col["price"][out].tolist(),
+        profit[ranking].tolist(),
+        commission[ranking].tolist(),
+        swap[ranking].tolist(),
+        np.where(last_comment >= 0, col["comment"][last_comment], "").tolist(),
+        exit_types[ranking].tolist()
+    )
+    
+    return [
+        {
+            "id": position_id,
+            "ticket": position_id,
+            "symbol": symbol,
+            "type": side,
+            "volume": volume,
+            "openTime": open_time,
+            "closeTime": close_time,
+            "price": price,
+            "openPrice": price,
+            "closePrice": close_price,
+            "profit": profit,
+            "commission": commission,
+            "swap": swap,
+            "comment": comment,
+            "exit_type": exit_type
+        }
+        for (position_id, symbol, side, volume, open_time, close_time, price,
+             close_price, profit, commission, swap, comment, exit_type) in rows
+    ]
+
+def order_trades(deals, position_ids):
+    """Trades of a page in the order of its position ids"""
+    order = {position_id: index for index, position_id in enumerate(position_ids)}
+    trades = build_trades(deals)
+    trades.sort(key=lambda trade: order[trade["id"]])
+    return trades
 
 async def send_history(websocket, data):
+    """Full history, one page (limit/cursor) or a stream of history_chunk frames (stream: true)"""
     if not mt5_connected:
         await send_error(websocket, "MT5 not connected")
         return
@@ -1192,244 +2731,782 @@ async def send_history(websocket, data):
     # Добавляем день к to_date чтобы включить сегодняшние сделки
     to_date = to_date + timedelta(days=1)
     
-    # Получаем историю сделок
-    history = mt5.history_deals_get(from_date, to_date)
+    sort_key = data.get("sort", "closeTime")
+    if sort_key not in HISTORY_SORT_KEYS:
+        await send_error(websocket, f"Unknown history sort key: {sort_key}")
+        return
+    descending = data.get("order", "desc") != "asc"
+    cursor = data.get("cursor")
     
-    trades = []
-    positions_map = {}
+    store = await get_deal_store()
+    # Продолжение постраничного чтения - досинхронизация уже сделана первой страницей
+    if store is None or (cursor is None and not await store.sync(from_date)):
+        await send_error(websocket, "Failed to load deal history")
+        return
     
-    if history is not None:
-        # Группируем сделки по позициям
-        for deal in history:
-            # Пропускаем балансовые операции
-            if deal.type not in [mt5.DEAL_TYPE_BUY, mt5.DEAL_TYPE_SELL]:
-                continue
-            
-            position_id = deal.position_id
-            
-            # Проверяем есть ли уже эта позиция в словаре
-            if position_id not in positions_map:
-                positions_map[position_id] = {
-                    "id": position_id,
-                    "symbol": deal.symbol,
-                    "in_deal": None,
-                    "out_deal": None,
-                    "profit": 0,
-                    "commission": 0,
-                    "swap": 0,
-                    "exit_type": "manual"  # По умолчанию manual
-                }
-            
-            # DEAL_ENTRY_IN - открытие позиции
-            if deal.entry == mt5.DEAL_ENTRY_IN:
-                positions_map[position_id]["in_deal"] = deal
-                positions_map[position_id]["type"] = "buy" if deal.type == mt5.DEAL_TYPE_BUY else "sell"
-                positions_map[position_id]["volume"] = deal.volume
-                positions_map[position_id]["openTime"] = int(deal.time) * 1000
-                positions_map[position_id]["openPrice"] = deal.price
-            
-            # DEAL_ENTRY_OUT или DEAL_ENTRY_OUT_BY - закрытие позиции
-            elif deal.entry in [mt5.DEAL_ENTRY_OUT, mt5.DEAL_ENTRY_OUT_BY]:
-                positions_map[position_id]["out_deal"] = deal
-                positions_map[position_id]["closeTime"] = int(deal.time) * 1000
-                positions_map[position_id]["closePrice"] = deal.price
-            
-            # Суммируем profit, commission и swap
-            positions_map[position_id]["profit"] += getattr(deal, 'profit', 0)
-            positions_map[position_id]["commission"] += getattr(deal, 'commission', 0)
-            positions_map[position_id]["swap"] += getattr(deal, 'swap', 0)
-            
-            # Сохраняем comment от последней сделки и определяем тип закрытия
-            if hasattr(deal, 'comment') and deal.comment:
-                positions_map[position_id]["comment"] = deal.comment
-                
-                # Определяем тип закрытия по comment
-                comment_lower = deal.comment.lower()
-                if '[tp]' in comment_lower or 'take profit' in comment_lower or 'tp' in comment_lower:
-                    positions_map[position_id]["exit_type"] = "tp"
-                elif '[sl]' in comment_lower or 'stop loss' in comment_lower or 'sl' in comment_lower:
-                    positions_map[position_id]["exit_type"] = "sl"
-                elif 'so' in comment_lower:  # Stop Out
-                    positions_map[position_id]["exit_type"] = "sl"
-                else:
-                    positions_map[position_id]["exit_type"] = "manual"
+    if data.get("stream"):
+        limit = max(1, min(int(data.get("limit", HISTORY_CHUNK_SIZE)), HISTORY_PAGE_MAX))
+        index = 0
+        async for trades, next_cursor in store.iter_trade_pages(from_date, to_date, sort_key, descending, cursor, limit):
+            await send_message(websocket, {
+                "type": "history_chunk",
+                "index": index,
+                "trades": trades,
+                "cursor": next_cursor,
+                "done": next_cursor is None
+            })
+            index += 1
+        return
     
-    # Преобразуем словарь позиций в список для отправки
-    for position_id, pos_data in positions_map.items():
-        # Пропускаем незакрытые позиции если нет out_deal
-        if pos_data["in_deal"] is None:
-            continue
-            
-        trade = {
-            "id": position_id,
-            "ticket": position_id,
-            "symbol": pos_data["symbol"],
-            "type": pos_data.get("type", "unknown"),
-            "volume": pos_data.get("volume", 0),
-            "openTime": pos_data.get("openTime", 0),
-            "closeTime": pos_data.get("closeTime", pos_data.get("openTime", 0)),
-            "price": pos_data.get("openPrice", 0),
-            "openPrice": pos_data.get("openPrice", 0),
-            "closePrice": pos_data.get("closePrice", pos_data.get("openPrice", 0)),
-            "profit": pos_data["profit"],
-            "commission": pos_data["commission"],
-            "swap": pos_data["swap"],
-            "comment": pos_data.get("comment", ""),
-            "exit_type": pos_data.get("exit_type", "manual")  # Добавляем exit_type
-        }
-        
-        trades.append(trade)
+    if "limit" in data:
+        limit = max(1, min(int(data["limit"]), HISTORY_PAGE_MAX))
+        trades, next_cursor = await store.trade_page(from_date, to_date, sort_key, descending, cursor, limit)
+        await send_message(websocket, {
+            "type": "history",
+            "trades": trades,
+            "cursor": next_cursor,
+            "sort": sort_key,
+            "order": "desc" if descending else "asc"
+        })
+        return
     
-    # Сортируем по времени закрытия (новые сверху)
-    trades.sort(key=lambda x: x.get("closeTime", 0), reverse=True)
+    deals = await store.query(from_date, to_date)
+    trades = build_trades(deals)
     
     response = {
         "type": "history",
         "trades": trades
     }
-    await websocket.send(json.dumps(response))
+    await send_message(websocket, response)
 
 async def send_error(websocket, error_message):
     response = {
         "type": "error",
         "message": error_message
     }
-    await websocket.send(json.dumps(response))
+    await send_message(websocket, response)
+
+def broadcast(clients, data):
+    """Serializes data once per codec and queues the same frame on every client.
+
+    websockets.broadcast writes without awaiting each connection and has no
+    backpressure, so clients whose send buffer already holds more than
+    BROADCAST_BUFFER_LIMIT bytes skip the frame instead of piling it up.
+    Returns the skipped clients.
+    """
+    skipped = []
+    if not clients:
+        return skipped
+    
+    by_codec = defaultdict(list)
+    for client in clients:
+        transport = getattr(client, "transport", None)
+        if transport is not None and transport.get_write_buffer_size() > BROADCAST_BUFFER_LIMIT:
+            skipped.append(client)
+            label = client_labels.get(client)
+            if label is not None:
+                ws_frames_skipped.inc(label)
+            continue
+        by_codec[get_codec(client)].append(client)
+    
+    for codec, group in by_codec.items():
+        frame = codec.encode(data)
+        for client in group:
+            record_frame(client, frame)
+        websockets.broadcast(group, frame)
+    return skipped
+
+StreamTick = namedtuple("StreamTick", ["time", "bid", "ask", "last", "volume", "time_msc", "flags", "volume_real"])
+TICK_BUFFER_SIZE = 5000
+TICK_FETCH_MAX = 1000
+
+tick_streams = {}
+
+class TickStream:
+    """Every tick of one symbol, pulled with copy_ticks_from since the last cursor.
+
+    The newest TICK_BUFFER_SIZE ticks are kept with increasing sequence
+    numbers, so every client reads the buffer from its own cursor. The MT5
+    cursor is the time_msc of the last tick plus how many ticks with that
+    time_msc were already taken, because copy_ticks_from starts at a whole
+    second and several ticks can share a millisecond.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.ticks = deque(maxlen=TICK_BUFFER_SIZE)
+        self.seq = 0
+        self.cursor_msc = None
+        self.taken_at_cursor = 0
+        self.polled_at = 0
+
+    async def poll(self, priority=MT5_PRIORITY_POLL):
+        """Appends the ticks that arrived since the last poll, returns how many"""
+        self.polled_at = time.time()
+        if self.cursor_msc is None:
+            tick = await mt5_call(mt5.symbol_info_tick, self.symbol, priority=priority)
+            if tick is None:
+                return 0
+            self.cursor_msc = tick.time_msc
+            self.taken_at_cursor = 1
+            self.append([tuple(tick)[:8]])
+            return 1
+        
+        ticks = await mt5_call(mt5.copy_ticks_from, self.symbol, self.cursor_msc // 1000, TICK_FETCH_MAX,
+                               mt5.COPY_TICKS_INFO, priority=priority)
+        if ticks is None or len(ticks) == 0:
+            return 0
+        
+        times = ticks['time_msc']
+        first = int(np.searchsorted(times, self.cursor_msc, side='left'))
+        at_cursor = int(np.searchsorted(times, self.cursor_msc, side='right')) - first
+        new = ticks[first + min(at_cursor, self.taken_at_cursor):]
+        if len(new) == 0:
+            return 0
+        
+        last = int(new['time_msc'][-1])
+        if last == self.cursor_msc:
+            self.taken_at_cursor += len(new)
+        else:
+            self.cursor_msc = last
+            self.taken_at_cursor = int(np.count_nonzero(new['time_msc'] == last))
+        self.append(new.tolist())
+        return len(new)
+
+    def append(self, rows):
+        for row in rows:
+            self.seq += 1
+            self.ticks.append((self.seq, StreamTick(*row)))
+
+    def latest(self):
+        return self.ticks[-1][1] if self.ticks else None
+
+    def since(self, seq):
+        """Ticks after the given sequence number (as many as are still buffered)"""
+        if not self.ticks or seq >= self.seq:
+            return []
+        skip = max(0, seq - self.ticks[0][0] + 1)
+        return [tick for _, tick in itertools.islice(self.ticks, skip, None)]
+
+def stream_message(web_symbol, ticks, open_price):
+    return {
+        "type": "tick_stream",
+        "symbol": web_symbol,
+        "open": open_price,
+        "time": [tick.time_msc for tick in ticks],
+        "bid": [tick.bid for tick in ticks],
+        "ask": [tick.ask for tick in ticks]
+    }
+
+def reset_market_data():
+    """Drops market data cached from the previous login"""
+    invalidate_symbol_spec()
+    session_opens.clear()
+    chart_buffers.clear()
+    # Курсор потока - время сервера прежнего брокера; клиенты начинают новые потоки с начала
+    tick_streams.clear()
+    stream_cursors.clear()
 
-async def price_updater(websocket):
+async def market_data_service():
+    """Pulls the tick stream of every subscribed symbol and delivers it to each client in its own mode"""
     while True:
         try:
-            if websocket in symbol_subscriptions:
-                symbol = symbol_subscriptions[websocket]
-                web_symbol = symbol
-                for suffix in ["+", ".", "m", "_raw", "pro", "#", ".a"]:
-                    web_symbol = web_symbol.replace(suffix, "")
-                await send_price(websocket, symbol, web_symbol)
-            
-            await send_positions(websocket, force=False)
-            await send_pending_orders(websocket, force=False)
+            if mt5_connected and (symbol_subscriptions or automation_triggers.entries):
+                now = time.time()
+                subscribers = defaultdict(list)
+                for websocket, symbols in list(symbol_subscriptions.items()):
+                    for symbol in symbols:
+                        subscribers[symbol].append(websocket)
+                
+                # Символы с взведенными уровнями автоматизации опрашиваются и без подписчиков
+                armed = automation_triggers.symbols()
+                for symbol in armed:
+                    subscribers.setdefault(symbol, [])
+                
+                for symbol, clients in subscribers.items():
+                    full = [client for client in clients if client_tick_modes.get(client) == "full"]
+                    conflated = [client for client in clients if client_tick_modes.get(client) != "full"]
+                    # Символ опрашивается так часто, как нужно самому требовательному подписчику
+                    if full or symbol in armed:
+                        interval = TICK_STREAM_INTERVAL
+                    else:
+                        interval = min(client_tick_intervals.get(client, TICK_INTERVAL) for client in conflated)
+                    
+                    stream = tick_streams.get(symbol)
+                    if stream is None:
+                        stream = tick_streams[symbol] = TickStream(symbol)
+                    elif now - stream.polled_at < interval:
+                        continue
+                    
+                    added = await stream.poll()
+                    if added == 0:
+                        continue
+                    
+                    if symbol in armed:
+                        fire_automation(symbol, stream.since(stream.seq - added))
+                    if not clients:
+                        continue
+                    
+                    data = await build_tick_data(symbol, get_web_symbol(symbol), stream.latest(), priority=MT5_PRIORITY_POLL)
+                    if data is None:
+                        continue
+                    # Пока шел опрос, счет сменился - номера старого потока не подходят к курсорам нового
+                    if tick_streams.get(symbol) is not stream:
+                        continue
+                    
+                    # Сжатым клиентам - только последняя котировка до их следующего кадра
+                    for client in conflated:
+                        tick_batches.setdefault(client, {})[data["symbol"]] = data
+                    
+                    # Клиенты с одинаковым курсором получают один и тот же кадр
+                    by_cursor = defaultdict(list)
+                    for client in full:
+                        cursors = stream_cursors.setdefault(client, {})
+                        by_cursor[cursors.get(symbol, 0)].append(client)
+                        cursors[symbol] = stream.seq
+                    for cursor, group in by_cursor.items():
+                        # Пропустившие кадр дочитают тики со старого курсора, пока они в буфере
+                        for client in broadcast(group, stream_message(data["symbol"], stream.since(cursor), data["open"])):
+                            stream_cursors[client][symbol] = cursor
+                
+                flush_tick_batches()
+                
+                # Забываем символы, на которые больше никто не подписан
+                for symbol in list(tick_streams):
+                    if symbol not in subscribers:
+                        del tick_streams[symbol]
             
-            await asyncio.sleep(0.5)
+            await asyncio.sleep(MARKET_DATA_STEP)
             
-        except websockets.exceptions.ConnectionClosed:
-            break
         except Exception as e:
-            logger.error(f"Price updater error: {e}")
+            logger.error(f"Market data service error: {e}")
             await asyncio.sleep(1)
 
-async def position_monitor(websocket):
+def flush_tick_batches():
+    """Sends every conflated client whose rate allows it the symbols changed since its last frame.
+
+    ticks_batch clients get one ticks frame, the others a tick frame per
+    symbol. Frames with the same content are serialized once.
+    """
+    now = time.time()
+    batches = {}
+    singles = defaultdict(list)
+    for client, pending in list(tick_batches.items()):
+        if not pending or now - last_ticks_sent.get(client, 0) < client_tick_intervals.get(client, TICK_INTERVAL):
+            continue
+        
+        ticks = list(pending.values())
+        if "ticks_batch" in client_features.get(client, ()):
+            key = tuple(id(data) for data in ticks)
+            batches.setdefault(key, (ticks, []))[1].append(client)
+        else:
+            for data in ticks:
+                singles[id(data)].append((data, client))
+        tick_batches[client] = {}
+        last_ticks_sent[client] = now
+    
+    for ticks, clients in batches.values():
+        broadcast(clients, {"type": "ticks", "ticks": ticks})
+    for recipients in singles.values():
+        broadcast([client for _, client in recipients], recipients[0][0])
+
+def broadcast_notification(message, level="info"):
+    """Sends a notification to every connected client"""
+    notification = {
+        "type": "notification",
+        "message": message,
+        "level": level
+    }
+    broadcast(connected_clients, notification)
+
+async def refresh_clients():
+    """Pushes fresh positions and account data to every connected client"""
+    async with positions_stream.lock:
+        await update_positions_stream(MT5_PRIORITY_QUERY)
+    await broadcast_account_data()
+
+def next_trigger_profit(pos, monitor, value):
+    """Smallest profit (account currency) at which one of the position's rules fires next, or None"""
+    candidates = []
+    if monitor["trailing"] and monitor["trailing_profit"] and monitor["trailing_profit"] > 0:
+        # Шаги, уже примененные к SL: следующий срабатывает на шаг дальше. Счетчик на мониторе
+        # точен; по SL, округленному до digits, шаг теряется при нецелой стоимости лота (кроссы JPY)
+        applied = monitor.get("trailing_steps", 0)
+        if pos.sl > 0 and monitor["trailing_distance"] > 0:
+            moved = pos.sl - pos.price_open if pos.type == mt5.POSITION_TYPE_BUY else pos.price_open - pos.sl
+            applied = max(applied, math.floor(moved * pos.volume * value / monitor["trailing_distance"] + 1e-9))
+        candidates.append((applied + 1) * monitor["trailing_profit"])
+    
+    if monitor["breakeven"] and not monitor["breakeven_activated"] and monitor["breakeven_profit"] is not None:
+        candidates.append(monitor["breakeven_profit"])
+    
+    if monitor.get("partial_close") and not monitor.get("partial_closed") and monitor.get("partial_close_profit") is not None:
+        candidates.append(monitor["partial_close_profit"])
+    
+    return min(candidates) if candidates else None
+
+class TriggerIndex:
+    """Price levels at which the automation rules of monitored positions fire next, sorted per symbol.
+
+    Buys fire when the bid rises to their level and sells when the ask
+    falls to it, so a new quote only looks at the crossed end of two sorted
+    lists instead of at every position.
+    """
+
+    def __init__(self):
+        self.rising = defaultdict(list)
+        self.falling = defaultdict(list)
+        self.entries = {}
+        # Стоимость движения цены на 1.0 для одного лота (price_values) на момент пересборки
+        self.values = {}
+        self.in_flight = set()
+
+    def arm(self, ticket, symbol, buy, level):
+        if self.entries.get(ticket) == (symbol, buy, level):
+            return
+        self.disarm(ticket)
+        bisect.insort((self.rising if buy else self.falling)[symbol], (level, ticket))
+        self.entries[ticket] = (symbol, buy, level)
+
+    def disarm(self, ticket):
+        entry = self.entries.pop(ticket, None)
+        if entry is None:
+            return
+        symbol, buy, level = entry
+        side = self.rising if buy else self.falling
+        levels = side[symbol]
+        i = bisect.bisect_left(levels, (level, ticket))
+        if i < len(levels) and levels[i] == (level, ticket):
+            del levels[i]
+        if not levels:
+            del side[symbol]
+
+    def symbols(self):
+        return set(self.rising) | set(self.falling)
+
+    def crossed(self, symbol, bid, ask):
+        """Removes and returns the tickets whose level this quote reached"""
+        fired = []
+        levels = self.rising.get(symbol)
+        if levels:
+            i = bisect.bisect_right(levels, (bid, math.inf))
+            fired.extend(ticket for _, ticket in levels[:i])
+            del levels[:i]
+            if not levels:
+                del self.rising[symbol]
+        
+        levels = self.falling.get(symbol)
+        if levels:
+            i = bisect.bisect_left(levels, (ask, -math.inf))
+            fired.extend(ticket for _, ticket in levels[i:])
+            del levels[i:]
+            if not levels:
+                del self.falling[symbol]
+        
+        for ticket in fired:
+            del self.entries[ticket]
+        return fired
+
+automation_triggers = TriggerIndex()
+automation_wakeup = asyncio.Event()
+automation_tasks = set()
+
+# Пауза после изменения SL, прежде чем правила позиции снова проверяются (сек)
+AUTOMATION_COOLDOWN = 5
+
+# Журнал сжимается, когда записей больше минимума и в RATIO раз больше живых настроек
+JOURNAL_COMPACT_MIN = 1000
+JOURNAL_COMPACT_RATIO = 4
+
+class AutomationJournal:
+    """Append-only log of one account's automation settings, kept on disk.
+
+    Every change of a position monitor or of a pending order's settings is
+    one JSON line: the full settings, or null once they are gone. The event
+    loop only updates an in-memory copy and hands the line to the journal's
+    own thread, which appends it. When dead lines outnumber live settings
+    the file is replaced by a snapshot of the live state.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {"position": {}, "order": {}}
+        self.records = 0
+        self.file = None
+        self.closed = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="automation-journal")
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def load(self):
+        """Replays the file into the settings it describes"""
+        state = {"position": {}, "order": {}}
+        if not os.path.exists(self.path):
+            return state
+        
+        records = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Строка, недописанная при падении процесса
+                    logger.warning(f"Skipping damaged automation journal line in {self.path}")
+                    continue
+                records += 1
+                entries = state[record["kind"]]
+                if record["settings"] is None:
+                    entries.pop(record["ticket"], None)
+                else:
+                    entries[record["ticket"]] = record["settings"]
+        self.records = records
+        return state
+
+    def record(self, kind, ticket, settings):
+        """Journals the settings of a position or pending order (None - removed)"""
+        entries = self.state[kind]
+        if settings is None:
+            if entries.pop(ticket, None) is None:
+                return
+        elif entries.get(ticket) == settings:
+            return
+        else:
+            settings = entries[ticket] = dict(settings)
+        
+        if self.closed:
+            return
+        self.records += 1
+        self.executor.submit(self._append, kind, ticket, settings)
+        
+        live = len(self.state["position"]) + len(self.state["order"])
+        if self.records > JOURNAL_COMPACT_MIN and self.records > JOURNAL_COMPACT_RATIO * live:
+            self.compact()
+
+    def reset(self, state):
+        """Replaces the journaled state and rewrites the file as its snapshot"""
+        self.state = {kind: {ticket: dict(settings) for ticket, settings in entries.items()}
+                      for kind, entries in state.items()}
+        self.compact()
+
+    def compact(self):
+        if self.closed:
+            return
+        # Настройки в state не меняются на месте, достаточно копии словарей верхнего уровня
+        snapshot = {kind: dict(entries) for kind, entries in self.state.items()}
+        self.records = sum(len(entries) for entries in snapshot.values())
+        self.executor.submit(self._write_snapshot, snapshot)
+
+    def close(self):
+        self.closed = True
+        self.executor.submit(self._close_file)
+        self.executor.shutdown(wait=False)
+
+    def _append(self, kind, ticket, settings):
+        try:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(json.dumps({"kind": kind, "ticket": ticket, "settings": settings}) + "\n")
+            self.file.flush()
+        except Exception as e:
+            logger.error(f"Automation journal write error: {e}")
+
+    def _write_snapshot(self, snapshot):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for kind, entries in snapshot.items():
+                    for ticket, settings in entries.items():
+                        f.write(json.dumps({"kind": kind, "ticket": ticket, "settings": settings}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_file()
+            # Замена атомарна: после падения на диске либо старый журнал, либо полный снимок
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.error(f"Automation journal compaction error: {e}")
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+automation_journal = None
+
+def journal_position(ticket):
+    """Journals the monitor of a position; monitors without changes from the defaults are not kept"""
+    journal = automation_journal
+    if journal is None:
+        return
+    monitor = position_monitors.get(ticket)
+    if monitor is not None and monitor == default_automation_settings():
+        monitor = None
+    journal.record("position", ticket, monitor)
+
+def journal_order(ticket):
+    journal = automation_journal
+    if journal is not None:
+        journal.record("order", ticket, pending_order_automation.get(ticket))
+
+def reset_account_automation():
+    """Forgets the previous login's automation state; the next cycle restores the new account's journal"""
+    global automation_journal
+    if automation_journal is not None:
+        automation_journal.close()
+        automation_journal = None
+    # Тикеты разных брокеров могут совпадать - настройки прежнего счета не должны достаться чужим позициям
+    position_monitors.clear()
+    pending_order_automation.clear()
+    pending_order_misses.clear()
+    positions_cache.clear()
+    for ticket in list(automation_triggers.entries):
+        automation_triggers.disarm(ticket)
+    automation_wakeup.set()
+
+async def restore_automation():
+    """Replays the connected account's automation journal and reconciles it with the terminal.
+
+    Monitors of positions that closed while the backend was down are
+    dropped. Settings of an order that is no longer pending are kept only
+    if the history knows the order opened one of the open positions;
+    sync_position_monitors and resolve_pending_automation hand them to
+    that position on the same cycle.
+    """
+    global automation_journal
+    account = await mt5_call(mt5.account_info, priority=MT5_PRIORITY_POLL)
+    if account is None:
+        return
+    
+    journal = AutomationJournal(os.path.join(DEALS_DB_DIR, f"automation_{account.login}.jsonl"))
+    started = time.perf_counter()
+    state = await journal.run(journal.load)
+    positions = await mt5_call(mt5.positions_get, priority=MT5_PRIORITY_POLL)
+    orders = await mt5_call(mt5.orders_get, priority=MT5_PRIORITY_POLL)
+    if positions is None or orders is None:
+        journal.close()
+        return
+    
+    open_positions = {pos.ticket for pos in positions}
+    restored = 0
+    for ticket, settings in state["position"].items():
+        if ticket in open_positions and not has_automation_rules(position_monitors.get(ticket, {})):
+            position_monitors[ticket] = settings
+            restored += 1
+    pending = {order.ticket for order in orders}
+    orders_restored = 0
+    for ticket, settings in state["order"].items():
+        if ticket not in pending:
+            history = await mt5_call(mt5.history_orders_get, ticket=ticket, priority=MT5_PRIORITY_POLL)
+            if not history or history[0].position_id not in open_positions:
+                continue
+        pending_order_automation.setdefault(ticket, settings)
+        orders_restored += 1
+    
+    # Снимок согласованного состояния заменяет журнал вместе с записями закрытых позиций
+    journal.reset({
+        "position": {ticket: monitor for ticket, monitor in position_monitors.items()
+                     if ticket in open_positions and monitor != default_automation_settings()},
+        "order": pending_order_automation
+    })
+    automation_journal = journal
+    logger.info(
+        f"Automation journal restored for account {account.login}: {restored} positions, "
+        f"{orders_restored} orders from {journal.path} in {(time.perf_counter() - started) * 1000:.1f}ms"
+    )
+
+def arm_position(pos, current_time):
+    """Puts the position at the price where its next rule fires; returns the level or None"""
+    monitor = position_monitors.get(pos.ticket)
+    value = automation_triggers.values.get(pos.symbol)
+    if (monitor is None or not value or pos.ticket in automation_triggers.in_flight
+            or current_time - monitor.get("last_modified", 0) < AUTOMATION_COOLDOWN):
+        automation_triggers.disarm(pos.ticket)
+        return None
+    
+    profit = next_trigger_profit(pos, monitor, value)
+    if profit is None:
+        automation_triggers.disarm(pos.ticket)
+        return None
+    
+    buy = pos.type == mt5.POSITION_TYPE_BUY
+    distance = profit / (pos.volume * value)
+    level = pos.price_open + distance if buy else pos.price_open - distance
+    automation_triggers.arm(pos.ticket, pos.symbol, buy, level)
+    return level
+
+async def automation_engine():
+    """Keeps the automation trigger index in sync with positions and settings.
+
+    Every AUTOMATION_INTERVAL, or right after settings change, positions
+    are reloaded, price values refreshed and every monitored position is
+    re-armed at the price where its next trailing step, breakeven or
+    partial close fires. The rules themselves run from market_data_service
+    as soon as a quote crosses a level (fire_automation). The first cycle
+    after connecting replays the account's automation journal.
+    """
     while True:
         try:
             if not mt5_connected:
-                await asyncio.sleep(5)
+                # Короткая пауза: после подключения журнал восстанавливается и позиции взводятся почти сразу
+                await asyncio.sleep(1)
                 continue
+            
+            if automation_journal is None:
+                await restore_automation()
                 
-            positions = mt5.positions_get()
-            current_time = datetime.now().timestamp()
+            positions = await mt5_call(mt5.positions_get, priority=MT5_PRIORITY_POLL)
             
-            if positions:
-                for pos in positions:
-                    if pos.ticket in position_monitors:
-                        monitor = position_monitors[pos.ticket]
-                        
-                        if current_time - monitor.get("last_modified", 0) < 5:
-                            continue
-                        
-                        tick = mt5.symbol_info_tick(pos.symbol)
-                        symbol_info = mt5.symbol_info(pos.symbol)
-                        if not tick or not symbol_info:
-                            continue
-                        
-                        profit_usd = calculate_profit_universal(pos, tick, symbol_info)
-                        
-                        # СТУПЕНЧАТЫЙ ТРЕЙЛИНГ
-                        if monitor["trailing"] and profit_usd >= monitor["trailing_profit"]:
-                            # Рассчитываем количество полных шагов
-                            steps_achieved = int(profit_usd / monitor["trailing_profit"])
-                            
-                            # Рассчитываем общее движение SL в долларах
-                            total_sl_movement_usd = steps_achieved * monitor["trailing_distance"]
-                            
-                            if "XAU" in pos.symbol or "GOLD" in pos.symbol:
-                                # Для золота: конвертируем доллары в движение цены
-                                sl_movement_price = total_sl_movement_usd / (pos.volume * 100)
-                                
-                            elif "XAG" in pos.symbol or "SILVER" in pos.symbol:
-                                sl_movement_price = total_sl_movement_usd / (pos.volume * 5000)
-                                
-                            elif "BTC" in pos.symbol or "ETH" in pos.symbol:
-                                sl_movement_price = total_sl_movement_usd / pos.volume
-                                
-                            else:
-                                # Для форекс (EURUSD, GBPUSD)
-                                sl_movement_price = total_sl_movement_usd / (pos.volume * 100000)
-                            
-                            # Рассчитываем целевой SL от цены входа
-                            if pos.type == mt5.POSITION_TYPE_BUY:
-                                target_sl = pos.price_open + sl_movement_price
-                            else:  # SELL
-                                target_sl = pos.price_open - sl_movement_price
-                            
-                            target_sl = round(target_sl, symbol_info.digits)
-                            
-                            # Обновляем только если SL изменился и движется в сторону прибыли
-                            need_update = False
-                            if pos.sl == 0:
-                                need_update = True
-                            elif pos.type == mt5.POSITION_TYPE_BUY and target_sl > pos.sl:
-                                need_update = True
-                            elif pos.type == mt5.POSITION_TYPE_SELL and target_sl < pos.sl:
-                                need_update = True
-                            
-                            if need_update:
-                                success = await modify_position_sl(pos.ticket, target_sl, pos.symbol)
-                                if success:
-                                    monitor["last_modified"] = current_time
-                                    direction = "UP" if pos.type == mt5.POSITION_TYPE_BUY else "DOWN"
-                                    logger.info(f"Stepped trailing: profit ${profit_usd:.2f}, step {steps_achieved}, SL moved {direction} to {target_sl}")
-                        
-                        # BREAKEVEN - тоже проверим правильность
-                        if monitor["breakeven"] and not monitor["breakeven_activated"] and profit_usd >= monitor["breakeven_profit"]:
-                            if pos.type == mt5.POSITION_TYPE_BUY:
-                                breakeven_price = pos.price_open + (1 * symbol_info.point)
-                            else:
-                                breakeven_price = pos.price_open - (1 * symbol_info.point)
-                            
-                            breakeven_price = round(breakeven_price, symbol_info.digits)
-                            
-                            success = await modify_position_sl(pos.ticket, breakeven_price, pos.symbol)
-                            if success:
-                                monitor["breakeven_activated"] = True
-                                monitor["last_modified"] = current_time
-                                logger.info(f"Position #{pos.ticket} moved to breakeven at {breakeven_price}")
-                                
-                                notification = {
-                                    "type": "notification",
-                                    "message": f"Position #{pos.ticket} moved to breakeven",
-                                    "level": "success"
-                                }
-                                await websocket.send(json.dumps(notification))
-                        
-                        # PARTIAL CLOSE при достижении цели
-                        if monitor.get("partial_close") and not monitor.get("partial_closed"):
-                            if profit_usd >= monitor.get("partial_close_profit", 0):
-                                close_volume = validate_volume(pos.symbol, pos.volume / 2)
-                                if close_volume > 0:
-                                    await close_partial_position(websocket, {
-                                        "positionId": pos.ticket,
-                                        "volume": close_volume
-                                    })
-                                    monitor["partial_closed"] = True
+            if positions is not None:
+                sync_position_monitors(positions)
+                
+                if pending_order_automation:
+                    orders = await mt5_call(mt5.orders_get, priority=MT5_PRIORITY_POLL)
+                    if orders is not None:
+                        await resolve_pending_automation(orders)
+                
+                monitored = [pos for pos in positions if pos.ticket in position_monitors]
+                automation_triggers.values = await price_values({pos.symbol for pos in monitored}, {}, MT5_PRIORITY_POLL)
+                current_time = datetime.now().timestamp()
+                for pos in monitored:
+                    arm_position(pos, current_time)
+                
+                current_tickets = {pos.ticket for pos in monitored}
+                for ticket in list(automation_triggers.entries):
+                    if ticket not in current_tickets:
+                        automation_triggers.disarm(ticket)
             
-            await asyncio.sleep(2)
+            automation_wakeup.clear()
+            try:
+                await asyncio.wait_for(automation_wakeup.wait(), AUTOMATION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
             
         except Exception as e:
-            logger.error(f"Position monitor error: {e}")
+            logger.error(f"Automation engine error: {e}")
             await asyncio.sleep(5)
 
+def fire_automation(symbol, ticks):
+    """Runs the rules of every position whose trigger level one of these quotes crossed"""
+    # Уровень, пересеченный и пройденный назад внутри одной пачки, тоже срабатывает: берем экстремумы
+    tick = ticks[-1]._replace(
+        bid=max(t.bid for t in ticks),
+        ask=min((t.ask for t in ticks if t.ask > 0), default=ticks[-1].ask)
+    )
+    for ticket in automation_triggers.crossed(symbol, tick.bid, tick.ask):
+        automation_triggers.in_flight.add(ticket)
+        task = asyncio.ensure_future(run_automation(ticket, tick))
+        automation_tasks.add(task)
+        task.add_done_callback(automation_tasks.discard)
+
+async def run_automation(ticket, tick):
+    try:
+        positions = await mt5_call(mt5.positions_get, ticket=ticket, priority=MT5_PRIORITY_TRADE)
+        monitor = position_monitors.get(ticket)
+        if not positions or monitor is None:
+            return
+        
+        pos = positions[0]
+        value = automation_triggers.values.get(pos.symbol)
+        symbol_info = await get_symbol_spec(pos.symbol, priority=MT5_PRIORITY_TRADE)
+        if not value or not symbol_info:
+            return
+        
+        buy = pos.type == mt5.POSITION_TYPE_BUY
+        price_diff = tick.bid - pos.price_open if buy else pos.price_open - tick.ask
+        await apply_automation(pos, monitor, price_diff * pos.volume * value, value, symbol_info,
+                               datetime.now().timestamp())
+        # Флаги breakeven_activated/partial_closed пишутся сразу, иначе после рестарта правило сработает повторно
+        journal_position(ticket)
+        
+        # Перевзводим по свежему состоянию; уровень, который цена уже прошла, ждет пересборки
+        positions = await mt5_call(mt5.positions_get, ticket=ticket, priority=MT5_PRIORITY_TRADE)
+        automation_triggers.in_flight.discard(ticket)
+        if positions:
+            level = arm_position(positions[0], datetime.now().timestamp())
+            if level is not None and (tick.bid >= level if buy else tick.ask <= level):
+                automation_triggers.disarm(ticket)
+    except Exception as e:
+        logger.error(f"Automation error for position #{ticket}: {e}")
+    finally:
+        automation_triggers.in_flight.discard(ticket)
+
+async def apply_automation(pos, monitor, profit_usd, value, symbol_info, current_time):
+    """Trailing stop, breakeven and partial close rules of one position at the given profit"""
+    # СТУПЕНЧАТЫЙ ТРЕЙЛИНГ
+    if monitor["trailing"] and profit_usd >= monitor["trailing_profit"]:
+        # Рассчитываем количество полных шагов
+        steps_achieved = int(profit_usd / monitor["trailing_profit"])
+        
+        # Рассчитываем общее движение SL в долларах
+        total_sl_movement_usd = steps_achieved * monitor["trailing_distance"]
+        
+        # Переводим сумму в валюте счета в движение цены по стоимости пункта символа
+        sl_movement_price = total_sl_movement_usd / (pos.volume * value)
+        
+        # Рассчитываем целевой SL от цены входа
+        if pos.type == mt5.POSITION_TYPE_BUY:
+            target_sl = pos.price_open + sl_movement_price
+        else:  # SELL
+            target_sl = pos.price_open - sl_movement_price
+        
+        target_sl = round(target_sl, symbol_info.digits)
+        
+        # Обновляем только если SL изменился и движется в сторону прибыли
+        need_update = False
+        if pos.sl == 0:
+            need_update = True
+        elif pos.type == mt5.POSITION_TYPE_BUY and target_sl > pos.sl:
+            need_update = True
+        elif pos.type == mt5.POSITION_TYPE_SELL and target_sl < pos.sl:
+            need_update = True
+        
+        if need_update:
+            success = await modify_position_sl(pos.ticket, target_sl, pos.symbol)
+            if success:
+                monitor["trailing_steps"] = max(monitor.get("trailing_steps", 0), steps_achieved)
+                monitor["last_modified"] = current_time
+                direction = "UP" if pos.type == mt5.POSITION_TYPE_BUY else "DOWN"
+                logger.info(f"Stepped trailing: profit ${profit_usd:.2f}, step {steps_achieved}, SL moved {direction} to {target_sl}")
+        else:
+            # SL уже на этом шаге или дальше - шаг засчитан, уровень не взводится повторно
+            monitor["trailing_steps"] = max(monitor.get("trailing_steps", 0), steps_achieved)
+    
+    # BREAKEVEN - тоже проверим правильность
+    if monitor["breakeven"] and not monitor["breakeven_activated"] and profit_usd >= monitor["breakeven_profit"]:
+        if pos.type == mt5.POSITION_TYPE_BUY:
+            breakeven_price = pos.price_open + (1 * symbol_info.point)
+        else:
+            breakeven_price = pos.price_open - (1 * symbol_info.point)
+        
+        breakeven_price = round(breakeven_price, symbol_info.digits)
+        
+        success = await modify_position_sl(pos.ticket, breakeven_price, pos.symbol)
+        if success:
+            monitor["breakeven_activated"] = True
+            monitor["last_modified"] = current_time
+            logger.info(f"Position #{pos.ticket} moved to breakeven at {breakeven_price}")
+            
+            broadcast_notification(f"Position #{pos.ticket} moved to breakeven", "success")
+    
+    # PARTIAL CLOSE при достижении цели
+    if monitor.get("partial_close") and not monitor.get("partial_closed"):
+        if profit_usd >= monitor.get("partial_close_profit", 0):
+            close_volume = await validate_volume(pos.symbol, pos.volume / 2)
+            if close_volume > 0:
+                success, result = await execute_partial_close(pos.ticket, close_volume)
+                if success:
+                    broadcast_notification(f"Closed {result} lots of position #{pos.ticket}", "success")
+                    await refresh_clients()
+                else:
+                    logger.error(result)
+                monitor["partial_closed"] = True
+
 async def modify_position_sl(ticket, new_sl, symbol):
     try:
-        position = mt5.positions_get(ticket=ticket)
+        position = await mt5_call(mt5.positions_get, ticket=ticket, priority=MT5_PRIORITY_TRADE)
         if not position:
             logger.error(f"Position #{ticket} not found")
             return False
@@ -1449,7 +3526,7 @@ async def modify_position_sl(ticket, new_sl, symbol):
             "comment": "Auto-SL"
         }
         
-        result = mt5.order_send(request)
+        result = await mt5_call(mt5.order_send, request, priority=MT5_PRIORITY_TRADE)
         
         if result is None:
             logger.error(f"SL modify error: result is None for position #{ticket}")
@@ -1476,22 +3553,24 @@ async def modify_pending_order(websocket, data):
     new_tp = data.get('tp', 0)
     
     # Получаем текущий ордер
-    orders = mt5.orders_get(ticket=ticket)
+    orders = await mt5_call(mt5.orders_get, ticket=ticket, priority=MT5_PRIORITY_TRADE)
     if not orders:
         await send_error(websocket, "Order not found")
         return
     
     order = orders[0]
     
-    # Отменяем старый ордер
+    # Отменяем старый ордер; его настройки автоматизации переезжают на новый
     cancel_request = {
         "action": mt5.TRADE_ACTION_REMOVE,
         "order": ticket
     }
+    automation_settings = pending_order_automation.pop(ticket, None)
     
-    result = mt5.order_send(cancel_request)
+    result = await mt5_call(mt5.order_send, cancel_request, priority=MT5_PRIORITY_TRADE)
     
     if result and result.retcode == mt5.TRADE_RETCODE_DONE:
+        journal_order(ticket)
         # Создаем новый ордер с новыми параметрами
         order_type = mt5.ORDER_TYPE_BUY_LIMIT if order.type == mt5.ORDER_TYPE_BUY_LIMIT else mt5.ORDER_TYPE_SELL_LIMIT
         
@@ -1505,26 +3584,31 @@ async def modify_pending_order(websocket, data):
             "tp": new_tp if new_tp > 0 else 0,
             "magic": 12345,
             "comment": "Modified order",
-            "type_filling": get_filling_mode(order.symbol),
+            "type_filling": await get_filling_mode(order.symbol),
             "type_time": mt5.ORDER_TIME_GTC,
         }
         
-        result = mt5.order_send(new_request)
+        result = await mt5_call(mt5.order_send, new_request, priority=MT5_PRIORITY_TRADE)
         
         if result and result.retcode == mt5.TRADE_RETCODE_DONE:
             logger.info(f"Order #{ticket} modified -> new order #{result.order}")
+            if automation_settings is not None:
+                pending_order_automation[result.order] = automation_settings
+                journal_order(result.order)
             
             notification = {
                 "type": "notification",
                 "message": f"Order modified successfully",
                 "level": "success"
             }
-            await websocket.send(json.dumps(notification))
+            await send_message(websocket, notification)
             
             await send_pending_orders(websocket, force=True)
         else:
             await send_error(websocket, f"Failed to place modified order: {result.comment if result else 'Unknown error'}")
     else:
+        if automation_settings is not None:
+            pending_order_automation[ticket] = automation_settings
         await send_error(websocket, f"Failed to cancel original order: {result.comment if result else 'Unknown error'}")
 async def main():
     global mt5_connected
@@ -1539,25 +3623,49 @@ async def main():
 
     print("Login Interface running at: http://127.0.0.1:5000")
     print("WebSocket Server running at: ws://127.0.0.1:8080")
-    print("Waiting for MT5 connection from login page...")
+    if SIMULATE:
+        print("MT5 simulator mode: connecting automatically")
+    else:
+        print("Waiting for MT5 connection from login page...")
     print("=" * 60)
     # --- КОНЕЦ ФИНАЛЬНОГО ИСПРАВЛЕНИЯ ---
 
     server = await websockets.serve(handle_client, "127.0.0.1", 8080)
+    mt5_gateway.start()
+    if SIMULATE:
+        # В режиме симуляции подключаемся сразу, без страницы входа
+        connect_simulator()
+    watchdog_task = asyncio.create_task(loop_watchdog.run())
+    market_data_task = asyncio.create_task(market_data_service())
+    automation_task = asyncio.create_task(automation_engine())
+    trade_state_task = asyncio.create_task(trade_state_service())
+    chart_update_task = asyncio.create_task(chart_update_service())
 
     await asyncio.Future()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blueprint FX trading terminal backend")
+    parser.add_argument("--simulate", action="store_true", help="run against the MT5 simulator (mt5_sim.py) instead of a terminal")
+    parser.add_argument("--sim-seed", type=int, default=42, help="random seed of simulated quotes")
+    parser.add_argument("--sim-latency", type=float, default=0.0, help="simulated MT5 call latency in seconds")
+    parser.add_argument("--sim-tick-interval", type=float, default=0.25, help="simulated seconds between ticks per symbol")
+    parser.add_argument("--sim-history", type=int, default=0, help="number of historical deals to seed")
+    args = parser.parse_args()
+    if SIMULATE:
+        mt5.configure(seed=args.sim_seed, latency=args.sim_latency, tick_interval=args.sim_tick_interval)
+        if args.sim_history:
+            mt5.seed_history(args.sim_history)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         print("\nBlueprint FX Terminal stopped")
         if mt5_initialized:
-            mt5.shutdown()
+            mt5_gateway.call_sync(mt5.shutdown)
     except Exception as e:
         logger.error(f"Critical error: {e}")
         if mt5_initialized:
-            mt5.shutdown()
+            mt5_gateway.call_sync(mt5.shutdown)
 
 # ---------------------------------------------------------------------------
 # Конец файла: server.py
@@ -0,0 +1,6 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без терминала MetaTrader5 сервер импортируется поверх симулятора
+os.environ.setdefault("MT5_SIMULATE", "1")
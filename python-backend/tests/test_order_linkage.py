@@ -0,0 +1,84 @@
+"""Pending order automation must reach the position its order opened, and only that one."""
+import asyncio
+from collections import namedtuple
+
+import pytest
+
+import server
+
+Position = namedtuple("Position", ["ticket", "identifier", "symbol", "comment"])
+Order = namedtuple("Order", ["ticket"])
+HistoryOrder = namedtuple("HistoryOrder", ["ticket", "position_id"])
+
+
+@pytest.fixture(autouse=True)
+def automation_state(monkeypatch):
+    for name in ("position_monitors", "pending_order_automation", "pending_order_misses", "positions_cache"):
+        monkeypatch.setattr(server, name, {})
+    monkeypatch.setattr(server, "automation_journal", None)
+
+
+def order_settings(ticket):
+    return dict(server.default_automation_settings(), trailing=True, order=ticket)
+
+
+def history(position_ids):
+    """history_orders_get answering from {order ticket: position_id}; unknown tickets have no history"""
+    def history_orders_get(ticket=None, **kwargs):
+        if ticket not in position_ids:
+            return None
+        return (HistoryOrder(ticket, position_ids[ticket]),)
+    return history_orders_get
+
+
+def test_sync_links_each_filled_order_to_its_own_position():
+    # Тикеты подряд: короткие номера встречаются подстрокой в длинных и в обрезанных комментариях
+    tickets = range(1000, 11000)
+    server.pending_order_automation.update({ticket: order_settings(ticket) for ticket in tickets})
+    filled = tickets[::2]
+    positions = [Position(ticket, ticket, "EURUSD", f"Blueprint Limit Order #{ticket}"[:31]) for ticket in filled]
+
+    server.sync_position_monitors(positions)
+    server.sync_position_monitors(positions)
+
+    for pos in positions:
+        assert server.position_monitors[pos.ticket]["order"] == pos.identifier
+    assert set(server.pending_order_automation) == set(tickets) - set(filled)
+
+
+def test_sync_leaves_positions_of_other_orders_on_defaults():
+    server.pending_order_automation[1000] = order_settings(1000)
+    # Позиция чужого ордера с тикетом 1000 в комментарии
+    server.sync_position_monitors([Position(5000, 5000, "EURUSD", "#1000")])
+
+    assert server.position_monitors[5000] == server.default_automation_settings()
+    assert 1000 in server.pending_order_automation
+
+
+def test_resolve_moves_netting_fill_and_drops_cancelled(monkeypatch):
+    server.position_monitors[700] = server.default_automation_settings()
+    server.pending_order_automation.update({1000: order_settings(1000), 1001: order_settings(1001), 1002: order_settings(1002)})
+    # 1000 долит существующую позицию 700, 1001 открыл позицию, которой еще нет в списке, 1002 отменен
+    monkeypatch.setattr(server.mt5, "history_orders_get", history({1000: 700, 1001: 900, 1002: 0}))
+
+    asyncio.run(server.resolve_pending_automation([]))
+
+    assert server.position_monitors[700]["order"] == 1000
+    assert server.pending_order_automation == {900: order_settings(1001)}
+
+
+def test_resolve_drops_orders_missing_from_history(monkeypatch):
+    server.pending_order_automation.update({1000: order_settings(1000), 1001: order_settings(1001)})
+    monkeypatch.setattr(server.mt5, "history_orders_get", history({}))
+
+    async def cycles(count):
+        for _ in range(count):
+            # 1001 все еще в списке отложенных - его история не запрашивается
+            await server.resolve_pending_automation([Order(1001)])
+
+    asyncio.run(cycles(server.PENDING_HISTORY_MISSES - 1))
+    assert 1000 in server.pending_order_automation
+
+    asyncio.run(cycles(1))
+    assert server.pending_order_automation == {1001: order_settings(1001)}
+    assert server.pending_order_misses == {}